@@ -0,0 +1,447 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import server # Используем протокол кадров и схему БД самого сервера
+
+# Нагрузочный тест сервера БД студентов.
+# Сервер запускается отдельным процессом (чтобы клиенты не делили с ним GIL) на временной БД,
+# заполненной детерминированными данными. M клиентов в потоках держат по постоянному соединению
+# и выполняют команды в заданной пропорции. Случайность задается --seed, поэтому одинаковые
+# параметры дают одинаковую последовательность запросов, и результаты разных коммитов сравнимы.
+
+HOST = '127.0.0.1'
+PORT = 65433                  # Отдельный порт, чтобы не мешать рабочему серверу
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+SERVER_START_TIMEOUT = 15.0   # Сколько ждать готовности сервера, с
+
+STUDENTS = 1000
+SUBJECTS = 20
+SUBJECTS_PER_STUDENT = 5
+CLIENTS = 8
+REQUESTS_PER_CLIENT = 2000
+SEED = 42
+
+GROUPS = ('ИС-21', 'ИС-22', 'ПИ-21', 'ПИ-22', 'БИ-21')
+
+# Смеси команд: команда -> вес
+MIXES = {
+    'read': {
+        'find_student': 30,
+        'get_student_average_grade': 20,
+        'list_students': 15,
+        'find_subjects_by_student': 15,
+        'get_subject_average_grade': 10,
+        'get_students_below_avg': 5,
+        'find_students_by_subject': 5,
+    },
+    'write': {
+        'add_grade': 45,
+        'update_student': 25,
+        'add_student': 20,
+        'delete_grade': 10,
+    },
+    'mixed': {
+        'find_student': 25,
+        'get_student_average_grade': 15,
+        'list_students': 15,
+        'find_subjects_by_student': 10,
+        'get_subject_average_grade': 10,
+        'get_students_below_avg': 5,
+        'add_grade': 12,
+        'update_student': 5,
+        'add_student': 3,
+    },
+}
+
+# --- Данные ---
+
+def student_name(student_id):
+    return f'Студент {student_id:06d}'
+
+def seed_database(path, students, subjects, per_student, seed):
+    """Создает БД со схемой сервера и заполняет ее детерминированными данными."""
+    server.DATABASE = path
+    server.init_db() # Схема, миграции и тестовые записи сервера
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA foreign_keys = ON;")
+    with conn:
+        conn.execute("DELETE FROM Students") # Каскадно удаляет назначения и оценки
+        conn.execute("DELETE FROM Subjects")
+        conn.executemany(
+            "INSERT INTO Students (id, full_name, age, group_name, course, average_grade) VALUES (?, ?, ?, ?, ?, ?)",
+            ((i, student_name(i), rng.randint(17, 25), rng.choice(GROUPS), rng.randint(1, 4), round(rng.uniform(2, 5), 2))
+             for i in range(1, students + 1)))
+        conn.executemany("INSERT INTO Subjects (id, subject_name, teacher) VALUES (?, ?, ?)",
+                         ((i, f'Предмет {i:03d}', f'Преподаватель {i:03d}') for i in range(1, subjects + 1)))
+        pairs = [(student_id, subject_id)
+                 for student_id in range(1, students + 1)
+                 for subject_id in rng.sample(range(1, subjects + 1), min(per_student, subjects))]
+        conn.executemany("INSERT INTO Student_Subjects (student_id, subject_id) VALUES (?, ?)", pairs)
+        conn.executemany("INSERT INTO Grades (student_id, subject_id, grade) VALUES (?, ?, ?)",
+                         ((student_id, subject_id, rng.randint(2, 5)) for student_id, subject_id in pairs))
+    conn.execute("ANALYZE")
+    conn.close()
+    return pairs
+
+# --- Команды ---
+
+class Workload:
+    """Генератор запросов одного клиента (свой генератор случайных чисел - своя воспроизводимая последовательность)."""
+
+    def __init__(self, mix, pairs, students, subjects, client_id, seed):
+        self.rng = random.Random(seed * 1000 + client_id)
+        self.commands = list(mix)
+        self.weights = [mix[name] for name in self.commands]
+        self.pairs = pairs
+        self.students = students
+        self.subjects = subjects
+        self.client_id = client_id
+        self.added = 0
+
+    def next_request(self):
+        command = self.rng.choices(self.commands, self.weights)[0]
+        return command, getattr(self, 'payload_' + command)()
+
+    def _student(self):
+        return self.rng.randint(1, self.students)
+
+    def payload_find_student(self):
+        return {'full_name': student_name(self._student())}
+
+    def payload_get_student_average_grade(self):
+        return {'student_id': self._student()}
+
+    def payload_list_students(self):
+        return {'limit': 50, 'group_name': self.rng.choice(GROUPS)}
+
+    def payload_list_students_subjects(self):
+        return {} # Все назначения целиком - большой ответ, нагрузка на сериализацию
+
+    def payload_find_subjects_by_student(self):
+        return {'student_id': self._student()}
+
+    def payload_find_students_by_subject(self):
+        return {'subject_id': self.rng.randint(1, self.subjects)}
+
+    def payload_get_subject_average_grade(self):
+        return {'subject_id': self.rng.randint(1, self.subjects)}
+
+    def payload_search_students(self):
+        # Префикс номера студента или название предмета - от узкой до широкой выборки
+        if self.rng.random() < 0.5:
+            return {'query': student_name(self._student())[:-self.rng.randint(1, 3)]}
+        return {'query': f'предмет {self.rng.randint(1, self.subjects):03d}', 'limit': 50}
+
+    def payload_get_students_below_avg(self):
+        return {'threshold': round(self.rng.uniform(2.5, 3.5), 2)}
+
+    def payload_add_grade(self):
+        student_id, subject_id = self.rng.choice(self.pairs)
+        return {'student_id': student_id, 'subject_id': subject_id, 'grade': self.rng.randint(2, 5)}
+
+    def payload_delete_grade(self):
+        student_id, subject_id = self.rng.choice(self.pairs)
+        return {'student_id': student_id, 'subject_id': subject_id}
+
+    def payload_update_student(self):
+        return {'full_name_to_update': student_name(self._student()), 'average_grade': round(self.rng.uniform(2, 5), 2)}
+
+    def payload_add_student(self):
+        self.added += 1
+        return {'full_name': f'Новый {self.client_id:03d}-{self.added:06d}', 'age': 18,
+                'group_name': self.rng.choice(GROUPS), 'course': 1, 'average_grade': 0.0}
+
+# --- Клиент ---
+
+def negotiate(sock, codec, columnar):
+    """Согласует формат ответов. Возвращает функцию разбора тел кадров."""
+    hello = json.dumps({'codecs': [codec], 'columnar': columnar}).encode('utf-8')
+    sock.sendall(server.encode_frame(server.FRAME_HELLO, hello))
+    frame_type, body = server.read_frame(sock)
+    chosen = json.loads(body.decode('utf-8'))['codec']
+    if chosen != codec:
+        raise RuntimeError(f"Сервер не поддерживает формат {codec}")
+    return server.CODECS[chosen].loads
+
+def request(sock, command, payload, loads):
+    """Отправляет запрос кадром и читает ответ (включая потоковый). Возвращает статус ответа."""
+    body = json.dumps({'command': command, 'payload': payload}).encode('utf-8')
+    sock.sendall(server.encode_frame(server.FRAME_REQUEST, body))
+    frame_type, body = server.read_frame(sock)
+    response = loads(body)
+    if response.get('stream'):
+        while True:
+            frame_type, body = server.read_frame(sock)
+            if frame_type == server.FRAME_END:
+                break
+            loads(body) # Разбор входит в измеряемое время, как у настоящего клиента
+    return response.get('status')
+
+def run_client(client_id, workload, requests, stop_event, start_barrier, results, codec='json', columnar=False):
+    """Выполняет запросы клиента (до requests штук или до stop_event) и складывает задержки в results[client_id].
+
+    Если клиент не смог подключиться, барьер старта ломается: остальные клиенты и main не ждут его вечно.
+    """
+    latencies = {} # команда -> список задержек, с
+    errors = {}
+    try:
+        sock = socket.create_connection((HOST, PORT))
+    except Exception:
+        start_barrier.abort()
+        raise
+    with sock:
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            loads = negotiate(sock, codec, columnar)
+        except Exception:
+            start_barrier.abort()
+            raise
+        try:
+            start_barrier.wait()
+        except threading.BrokenBarrierError:
+            return # Другой клиент не подключился - замер отменен
+        for _ in range(requests):
+            if stop_event.is_set():
+                break
+            command, payload = workload.next_request()
+            started = time.perf_counter()
+            status = request(sock, command, payload, loads)
+            latencies.setdefault(command, []).append(time.perf_counter() - started)
+            if status != 'успех':
+                errors[command] = errors.get(command, 0) + 1
+    results[client_id] = (latencies, errors)
+
+# --- Сервер ---
+
+def start_server_process(database, args):
+    """Запускает сервер отдельным процессом и ждет, пока он начнет принимать соединения."""
+    command = [sys.executable, SERVER_SCRIPT, '--database', database, '--port', str(PORT),
+               '--mode', args.mode, '--profile', args.profile, '--log-level', 'WARNING']
+    if args.cache_size is not None:
+        command += ['--cache-size', str(args.cache_size)]
+    if args.pool_size is not None:
+        command += ['--pool-size', str(args.pool_size)]
+    process = subprocess.Popen(command)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Сервер завершился при запуске (код {process.returncode}).")
+        try:
+            socket.create_connection((HOST, PORT), timeout=0.5).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Сервер не начал принимать соединения вовремя.")
+
+def stop_server_process(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+# --- Отчет ---
+
+def percentile(sorted_values, q):
+    """Квантиль по отсортированному списку (ближайший ранг)."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(q * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+def summarize(results, elapsed):
+    """Сводит задержки всех клиентов в отчет по командам."""
+    merged = {}
+    errors = {}
+    for latencies, client_errors in results.values():
+        for command, values in latencies.items():
+            merged.setdefault(command, []).extend(values)
+        for command, count in client_errors.items():
+            errors[command] = errors.get(command, 0) + count
+    commands = {}
+    for command, values in sorted(merged.items()):
+        values.sort()
+        commands[command] = {
+            'requests': len(values),
+            'errors': errors.get(command, 0),
+            'rps': round(len(values) / elapsed, 1),
+            'mean_ms': round(sum(values) / len(values) * 1000, 3),
+            'p50_ms': round(percentile(values, 0.50) * 1000, 3),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+            'max_ms': round(values[-1] * 1000, 3),
+        }
+    all_values = sorted(v for values in merged.values() for v in values)
+    total = {
+        'requests': len(all_values),
+        'errors': sum(errors.values()),
+        'rps': round(len(all_values) / elapsed, 1),
+        'p50_ms': round(percentile(all_values, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(all_values, 0.99) * 1000, 3),
+        'seconds': round(elapsed, 3),
+    }
+    return commands, total
+
+def git_revision():
+    """Коммит и наличие незафиксированных изменений (для сравнения результатов между коммитами)."""
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=cwd, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--', '.'], cwd=cwd, capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+def print_report(commands, total, baseline=None):
+    """Печатает таблицу результатов; при наличии baseline - изменение p50/p99/rps в процентах."""
+    def delta(command, key, value):
+        if not baseline:
+            return ''
+        old = (baseline['total'] if command is None else baseline['commands'].get(command, {})).get(key)
+        if not old:
+            return ''
+        return f' ({(value - old) / old * 100:+.0f}%)'
+
+    header = f"{'команда':<28}{'запросов':>9}{'ошибок':>8}{'rps':>16}{'p50, мс':>18}{'p99, мс':>18}"
+    print(header)
+    print('-' * len(header))
+    for command, row in commands.items():
+        print(f"{command:<28}{row['requests']:>9}{row['errors']:>8}"
+              f"{str(row['rps']) + delta(command, 'rps', row['rps']):>16}"
+              f"{str(row['p50_ms']) + delta(command, 'p50_ms', row['p50_ms']):>18}"
+              f"{str(row['p99_ms']) + delta(command, 'p99_ms', row['p99_ms']):>18}")
+    print('-' * len(header))
+    print(f"{'ВСЕГО':<28}{total['requests']:>9}{total['errors']:>8}"
+          f"{str(total['rps']) + delta(None, 'rps', total['rps']):>16}"
+          f"{str(total['p50_ms']) + delta(None, 'p50_ms', total['p50_ms']):>18}"
+          f"{str(total['p99_ms']) + delta(None, 'p99_ms', total['p99_ms']):>18}")
+
+def parse_mix(text):
+    """Смесь команд: имя из MIXES или список 'команда=вес,команда=вес'."""
+    if text in MIXES:
+        return MIXES[text]
+    mix = {}
+    for item in text.split(','):
+        command, _, weight = item.partition('=')
+        if not hasattr(Workload, 'payload_' + command.strip()):
+            raise argparse.ArgumentTypeError(f"Команда {command.strip()} не поддерживается нагрузочным тестом")
+        mix[command.strip()] = float(weight or 1)
+    return mix
+
+def main():
+    global PORT
+    parser = argparse.ArgumentParser(description="Нагрузочный тест сервера БД студентов")
+    parser.add_argument("--students", type=int, default=STUDENTS, help="Число студентов в тестовой БД")
+    parser.add_argument("--subjects", type=int, default=SUBJECTS, help="Число предметов")
+    parser.add_argument("--subjects-per-student", type=int, default=SUBJECTS_PER_STUDENT, help="Предметов (и оценок) на студента")
+    parser.add_argument("--clients", type=int, default=CLIENTS, help="Одновременных клиентов")
+    parser.add_argument("--requests", type=int, default=REQUESTS_PER_CLIENT, help="Запросов на клиента")
+    parser.add_argument("--duration", type=float, default=0, help="Ограничение по времени, с (0 - без ограничения)")
+    parser.add_argument("--mix", type=parse_mix, default='mixed',
+                        help=f"Смесь команд: {', '.join(MIXES)} или 'команда=вес,...'")
+    parser.add_argument("--seed", type=int, default=SEED, help="Начальное значение генератора случайных чисел")
+    parser.add_argument("--port", type=int, default=PORT, help="Порт тестового сервера")
+    parser.add_argument("--mode", choices=['threaded', 'async', 'prefork'], default='threaded', help="Режим сервера")
+    parser.add_argument("--profile", choices=sorted(server.DURABILITY_PROFILES), default=server.DURABILITY_PROFILE,
+                        help="Профиль надежности записи сервера")
+    parser.add_argument("--cache-size", type=int, help="Размер кэша результатов сервера (0 - отключить)")
+    parser.add_argument("--pool-size", type=int, help="Размер пула соединений сервера")
+    parser.add_argument("--codec", choices=sorted(server.CODECS), default='json', help="Формат ответов сервера")
+    parser.add_argument("--columnar", action='store_true', help="Списки строк в столбцовом формате")
+    parser.add_argument("--output", help="Сохранить результаты в JSON-файл")
+    parser.add_argument("--compare", help="JSON-файл предыдущего запуска для сравнения")
+    args = parser.parse_args()
+    PORT = args.port
+    logging.getLogger().setLevel(logging.WARNING) # Сообщения init_db сервера не нужны в отчете
+    if isinstance(args.mix, str):
+        args.mix = parse_mix(args.mix)
+
+    workdir = tempfile.mkdtemp(prefix='studentdb-bench-')
+    process = None
+    try:
+        database = os.path.join(workdir, 'bench.db')
+        print(f"Заполнение БД: {args.students} студентов, {args.subjects} предметов...")
+        pairs = seed_database(database, args.students, args.subjects, args.subjects_per_student, args.seed)
+        process = start_server_process(database, args)
+
+        barrier = threading.Barrier(args.clients + 1)
+        stop_event = threading.Event()
+        results = {}
+        threads = []
+        for client_id in range(args.clients):
+            workload = Workload(args.mix, pairs, args.students, args.subjects, client_id, args.seed)
+            thread = threading.Thread(target=run_client, daemon=True,
+                                      args=(client_id, workload, args.requests, stop_event, barrier, results,
+                                            args.codec, args.columnar))
+            threads.append(thread)
+            thread.start()
+        print(f"Нагрузка: {args.clients} клиентов по {args.requests} запросов, режим {args.mode}...")
+        try:
+            barrier.wait() # Все клиенты подключены - начинаем отсчет
+        except threading.BrokenBarrierError:
+            stop_event.set()
+            raise RuntimeError("Не все клиенты подключились к серверу, замер отменен.") from None
+        started = time.perf_counter()
+        timer = threading.Timer(args.duration, stop_event.set) if args.duration else None
+        if timer:
+            timer.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        if timer:
+            timer.cancel()
+    finally:
+        if process is not None:
+            stop_server_process(process)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if len(results) < args.clients:
+        print(f"Внимание: завершились с ошибкой {args.clients - len(results)} клиентов.")
+    commands, total = summarize(results, elapsed)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"Сравнение с {args.compare} (коммит {baseline['meta'].get('commit')}):")
+    print_report(commands, total, baseline)
+
+    if args.output:
+        commit, dirty = git_revision()
+        report = {
+            'meta': {
+                'commit': commit,
+                'dirty': dirty,
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'platform': platform.platform(),
+            },
+            'params': {
+                'students': args.students, 'subjects': args.subjects, 'subjects_per_student': args.subjects_per_student,
+                'clients': args.clients, 'requests': args.requests, 'duration': args.duration, 'mix': args.mix,
+                'seed': args.seed, 'mode': args.mode, 'profile': args.profile,
+                'codec': args.codec, 'columnar': args.columnar,
+                'cache_size': args.cache_size, 'pool_size': args.pool_size,
+            },
+            'total': total,
+            'commands': commands,
+        }
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,432 @@
 import socket
+import collections
+import concurrent.futures
+import csv
+import itertools
 import json
+import queue
+import struct
+import threading
+import time
 from tabulate import tabulate # Для красивого вывода таблиц
+try: # Необязательные ускорители разбора ответов
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 SERVER_HOST = '127.0.0.1'
 SERVER_PORT = 65432
 
-def send_request(request_data):
-    """Отправляет запрос на сервер и возвращает ответ."""
+# Протокол с кадрами (должен совпадать с серверным)
+PROTOCOL_MAGIC = b'SD'
+PROTOCOL_VERSION = 1
+FRAME_HEADER = struct.Struct('!2sBBI')   # Сигнатура, версия, тип кадра, длина тела
+FRAME_REQUEST = 1
+FRAME_RESPONSE = 2
+FRAME_CHUNK = 3
+FRAME_END = 4
+FRAME_HELLO = 5
+IMPORT_CHUNK_BYTES = 64 * 1024   # Размер куска файла при потоковом импорте
+STUDENTS_PAGE_SIZE = 20          # Студентов на одной странице списка
+REQUEST_TIMEOUT = 30.0           # Сколько ждать ответа на запрос, с
+CLIENT_POOL_SIZE = 4             # Соединений в ClientPool по умолчанию
+BACKUP_POLL_INTERVAL = 0.5       # Как часто спрашивать о ходе резервного копирования, с
+
+def encode_frame(frame_type, body=b''):
+    """Собирает кадр протокола из типа и тела."""
+    return FRAME_HEADER.pack(PROTOCOL_MAGIC, PROTOCOL_VERSION, frame_type, len(body)) + body
+
+def recv_exact(s, size):
+    """Читает ровно size байт из сокета."""
+    data = b''
+    while len(data) < size:
+        chunk = s.recv(min(65536, size - len(data)))
+        if not chunk:
+            raise ConnectionResetError("Сервер закрыл соединение посреди ответа.")
+        data += chunk
+    return data
+
+def read_frame(s):
+    """Читает один кадр. Возвращает (тип, тело)."""
+    magic, version, frame_type, length = FRAME_HEADER.unpack(recv_exact(s, FRAME_HEADER.size))
+    if magic != PROTOCOL_MAGIC or version != PROTOCOL_VERSION:
+        raise ValueError(f"Неподдерживаемый ответ сервера (версия протокола {version}).")
+    return frame_type, recv_exact(s, length) if length else b''
+
+# Форматы ответов сервера (согласуются кадром FRAME_HELLO), по убыванию предпочтения
+def decode_json(body):
+    return orjson.loads(body) if orjson is not None else json.loads(body.decode('utf-8'))
+
+DECODERS = {'json': decode_json}
+if msgpack is not None:
+    DECODERS = {'msgpack': lambda body: msgpack.unpackb(body, raw=False), **DECODERS}
+
+def hello_frame(columnar=False):
+    """Кадр согласования формата ответов. Запросы можно слать сразу за ним, не дожидаясь ответа."""
+    return encode_frame(FRAME_HELLO, json.dumps({'codecs': list(DECODERS), 'columnar': columnar}).encode('utf-8'))
+
+def read_hello(s):
+    """Читает ответ на FRAME_HELLO. Возвращает функцию разбора тел ответов."""
+    frame_type, body = read_frame(s)
+    if frame_type != FRAME_HELLO:
+        raise ValueError(f"Сервер не поддерживает согласование формата (кадр {frame_type}).")
+    return DECODERS[json.loads(body.decode('utf-8'))['codec']]
+
+def rows_to_dicts(response):
+    """Преобразует столбцовый ответ ('columns' + массивы значений в 'data') в список словарей."""
+    columns = response.pop('columns', None)
+    if columns is not None and isinstance(response.get('data'), list):
+        response['data'] = [dict(zip(columns, row)) for row in response['data']]
+    return response
+
+def read_response(s, on_batch=None, decode=decode_json):
+    """Читает ответ сервера, собирая потоковый ответ из пакетов строк.
+
+    Если задан on_batch(response, batch), пакеты передаются ему по мере прихода и не накапливаются.
+    decode - разбор тел кадров в согласованном формате (см. read_hello).
+    """
+    frame_type, body = read_frame(s)
+    if frame_type != FRAME_RESPONSE:
+        raise ValueError(f"Неожиданный тип кадра: {frame_type}")
+    response = decode(body)
+    if response.pop('stream', False):
+        data = []
+        while True:
+            frame_type, body = read_frame(s)
+            if frame_type == FRAME_END:
+                break
+            batch = decode(body)
+            if on_batch:
+                on_batch(response, batch)
+            else:
+                data.extend(batch)
+        if not on_batch:
+            response['data'] = data
+    return response
+
+# --- Клиент с постоянным соединением ---
+# Сервер обрабатывает запросы одного соединения строго по очереди, поэтому запросы можно слать,
+# не дожидаясь ответов (конвейер): ответы приходят в том же порядке и сопоставляются с
+# ожидающими Future по очереди FIFO. Ответы читает отдельный поток.
+
+class StudentDBClient:
+    """Постоянное соединение с сервером БД студентов: конвейерные запросы и переподключение.
+
+    submit() отправляет запрос сразу и возвращает concurrent.futures.Future с ответом,
+    request() - то же с ожиданием ответа. Если соединение оборвалось (например, сервер закрыл
+    его по таймауту бездействия), следующий запрос откроет новое. Запросы, ответ на которые не
+    успел прийти до обрыва, завершаются ConnectionError и повторно не отправляются: сервер мог
+    их уже выполнить.
+    """
+
+    def __init__(self, host=None, port=None, columnar=False, timeout=REQUEST_TIMEOUT):
+        self.host = host or SERVER_HOST
+        self.port = port or SERVER_PORT
+        self.columnar = columnar
+        self.timeout = timeout
+        self._lock = threading.Lock() # Отправка и очередь ожидания меняются вместе
+        self._sock = None
+        self._pending = None # Future текущего соединения в порядке отправки запросов
+
+    def _connect(self):
+        """Открывает соединение и согласует формат ответов (вызывается под self._lock)."""
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # Короткие запросы не ждут склейки
+            sock.sendall(hello_frame(self.columnar))
+            decode = read_hello(sock)
+        except Exception:
+            sock.close()
+            raise
+        sock.settimeout(None) # Поток чтения ждет ответов сколько угодно; таймаут - у Future
+        self._sock, self._pending = sock, collections.deque()
+        threading.Thread(target=self._read_loop, args=(sock, self._pending, decode), daemon=True).start()
+
+    def _read_loop(self, sock, pending, decode):
+        """Поток чтения: разбирает ответы по порядку и завершает соответствующие Future."""
+        try:
+            while True:
+                response = read_response(sock, decode=decode)
+                with self._lock:
+                    future = pending.popleft()
+                future.set_result(response)
+        except Exception as e: # Обрыв или мусор в потоке: соединение больше не годится
+            if not isinstance(e, (ConnectionError, ValueError)):
+                e = ConnectionResetError(f"Соединение с сервером потеряно: {e}")
+            with self._lock:
+                if self._sock is sock:
+                    self._sock = self._pending = None
+                failed = list(pending)
+                pending.clear()
+            sock.close()
+            for future in failed:
+                future.set_exception(e)
+
+    def _drop_connection(self):
+        """Закрывает текущее соединение (под self._lock); поток чтения завершит его запросы."""
+        sock, self._sock, self._pending = self._sock, None, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR) # Будит поток чтения
+            except OSError:
+                pass
+
+    def submit(self, command, payload=None):
+        """Отправляет команду, не дожидаясь ответа. Возвращает Future с ответом-словарем."""
+        return self.submit_request({'command': command, 'payload': payload or {}})
+
+    def submit_request(self, request_data):
+        """Отправляет готовый запрос {'command': ..., 'payload': ...}. Возвращает Future."""
+        frame = encode_frame(FRAME_REQUEST, json.dumps(request_data).encode('utf-8'))
+        future = concurrent.futures.Future()
+        with self._lock:
+            for attempt in range(2):
+                if self._sock is None:
+                    self._connect()
+                pending = self._pending
+                pending.append(future) # До отправки: ответ может прийти раньше, чем мы вернемся
+                try:
+                    self._sock.sendall(frame)
+                    return future
+                except OSError:
+                    # Запрос не ушел целиком - сервер его не выполнял, можно повторить на новом соединении
+                    pending.remove(future)
+                    self._drop_connection()
+                    if attempt:
+                        raise
+        return future
+
+    def request(self, command, payload=None):
+        """Выполняет команду и возвращает ответ сервера."""
+        return self.submit(command, payload).result(self.timeout)
+
+    def pipeline(self, requests):
+        """Отправляет список запросов (словарей) подряд и возвращает ответы в том же порядке."""
+        futures = [self.submit_request(request_data) for request_data in requests]
+        return [future.result(self.timeout) for future in futures]
+
+    def close(self):
+        """Закрывает соединение; ожидающие ответа запросы завершаются ConnectionError."""
+        with self._lock:
+            self._drop_connection()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ClientPool:
+    """Небольшой пул постоянных соединений для скриптов, выполняющих много команд.
+
+    Сервер выполняет запросы одного соединения по очереди, поэтому несколько соединений дают
+    параллельную обработку. submit() раздает запросы соединениям по кругу.
+    """
+
+    def __init__(self, size=CLIENT_POOL_SIZE, **client_options):
+        self._clients = [StudentDBClient(**client_options) for _ in range(size)]
+        self._next = itertools.cycle(self._clients)
+        self._next_lock = threading.Lock()
+        self._idle = queue.LifoQueue()
+        for client in self._clients:
+            self._idle.put(client)
+
+    def submit(self, command, payload=None):
+        with self._next_lock:
+            client = next(self._next)
+        return client.submit(command, payload)
+
+    def request(self, command, payload=None):
+        """Выполняет команду на свободном соединении (ждет, если все заняты)."""
+        client = self._idle.get()
+        try:
+            return client.request(command, payload)
+        finally:
+            self._idle.put(client)
+
+    def map(self, requests):
+        """Выполняет пары (команда, payload) на всех соединениях и возвращает ответы по порядку."""
+        futures = [self.submit(command, payload) for command, payload in requests]
+        return [future.result() for future in futures]
+
+    def close(self):
+        for client in self._clients:
+            client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_default_clients = {} # columnar -> StudentDBClient для send_request (меню работает через одно соединение)
+
+def get_default_client(columnar=False):
+    """Общее постоянное соединение модуля (создается при первом запросе)."""
+    client = _default_clients.get(columnar)
+    if client is None or (client.host, client.port) != (SERVER_HOST, SERVER_PORT):
+        if client is not None:
+            client.close()
+        client = _default_clients[columnar] = StudentDBClient(SERVER_HOST, SERVER_PORT, columnar=columnar)
+    return client
+
+def close_default_clients():
+    for client in _default_clients.values():
+        client.close()
+    _default_clients.clear()
+
+def error_to_response(e):
+    """Преобразует ошибку соединения в ответ в формате сервера."""
+    if isinstance(e, ConnectionRefusedError):
+        return {'status': 'ошибка', 'message': 'Статическая ошибка С-1: Соединение отклонено. Проверьте, запущен ли сервер.'}
+    if isinstance(e, (ConnectionResetError, ConnectionError)):
+        return {'status': 'ошибка', 'message': 'Статическая ошибка С-3: Соединение сброшено сервером.'}
+    if isinstance(e, (ValueError, struct.error)): # В т.ч. json.JSONDecodeError
+        return {'status': 'ошибка', 'message': 'Статическая ошибка С-5: Не удалось понять ответ сервера.'}
+    if isinstance(e, concurrent.futures.TimeoutError):
+        return {'status': 'ошибка', 'message': 'Статическая ошибка С-4: Сервер не ответил вовремя.'}
+    return {'status': 'ошибка', 'message': f'Произошла ошибка: {e}'}
+
+def send_request(request_data, columnar=False):
+    """Отправляет запрос на сервер и возвращает ответ.
+
+    Используется общее постоянное соединение (см. get_default_client).
+    columnar=True - списки строк приходят как 'columns' + массивы значений (см. rows_to_dicts).
+    """
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((SERVER_HOST, SERVER_PORT))
-            # Кодируем и отправляем JSON запрос
-            s.sendall(json.dumps(request_data).encode('utf-8'))
+        return get_default_client(columnar).submit_request(request_data).result(REQUEST_TIMEOUT)
+    except Exception as e:
+        return error_to_response(e)
 
-            # Получаем ответ (буфер может потребоваться увеличить для больших ответов)
-            response_data = s.recv(16384) # Увеличенный буфер
-            if not response_data:
-                return {'status': 'ошибка', 'message': 'Сервер не ответил.'}
+def iter_students(page_size=STUDENTS_PAGE_SIZE, **filters):
+    """Лениво перебирает страницы list_students (ответы сервера), следуя курсору next_cursor."""
+    payload = dict(filters, limit=page_size)
+    while True:
+        response = send_request({'command': 'list_students', 'payload': payload})
+        yield response
+        next_cursor = response.get('next_cursor')
+        if response.get('status') != 'успех' or not next_cursor:
+            return
+        payload = dict(payload, **next_cursor)
+
+def iter_changes(after_seq=None, heartbeat=None):
+    """Подписка на изменения БД: бесконечно выдает события {'seq', 'ts', 'command', 'payload'}.
+
+    after_seq - номер последнего обработанного события (без него - только новые события).
+    Подписка занимает отдельное соединение; чтобы отписаться, достаточно закрыть генератор.
+    Пустые пакеты сервера (heartbeat) не выдаются, но не дают соединению считаться зависшим.
+    """
+    payload = {}
+    if after_seq is not None:
+        payload['after_seq'] = after_seq
+    if heartbeat is not None:
+        payload['heartbeat'] = heartbeat
+    with socket.create_connection((SERVER_HOST, SERVER_PORT)) as s:
+        s.sendall(hello_frame() + encode_frame(FRAME_REQUEST, json.dumps({'command': 'subscribe', 'payload': payload}).encode('utf-8')))
+        decode = read_hello(s)
+        frame_type, body = read_frame(s)
+        response = decode(body)
+        if frame_type != FRAME_RESPONSE or not response.pop('stream', False):
+            raise ValueError(response.get('message', 'Сервер не начал поток изменений.'))
+        while True:
+            frame_type, body = read_frame(s)
+            if frame_type == FRAME_END:
+                return
+            yield from decode(body)
+
+def send_batch(commands, atomic=True):
+    """Отправляет пакет команд, выполняемый сервером в одной транзакции.
+
+    commands - список пар (команда, payload); atomic=False - выполнить все, что получится.
+    """
+    batch = [{'command': command, 'payload': payload or {}} for command, payload in commands]
+    return send_request({'command': 'batch', 'payload': {'commands': batch, 'atomic': atomic}})
+
+def send_pipelined(requests):
+    """Отправляет несколько запросов по одному соединению, не дожидаясь ответов, и возвращает список ответов."""
+    client = get_default_client()
+    futures = []
+    for request_data in requests:
+        try:
+            futures.append(client.submit_request(request_data))
+        except Exception as e:
+            futures.append(e)
+    responses = []
+    for future in futures:
+        try:
+            if isinstance(future, Exception):
+                raise future
+            responses.append(future.result(REQUEST_TIMEOUT))
+        except Exception as e:
+            responses.append(error_to_response(e))
+    return responses
+
+def import_file(command, path, fmt=None, on_conflict='abort', **options):
+    """Потоково загружает CSV/JSONL файл на сервер командой import_students/import_subjects/import_grades."""
+    if fmt is None:
+        fmt = 'jsonl' if path.lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+    payload = dict(options, format=fmt, on_conflict=on_conflict)
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s, open(path, 'rb') as f:
+            s.connect((SERVER_HOST, SERVER_PORT))
+            s.sendall(encode_frame(FRAME_REQUEST, json.dumps({'command': command, 'payload': payload, 'stream': True}).encode('utf-8')))
+            # Файл уходит кусками фиксированного размера, целиком в память не читается
+            while True:
+                chunk = f.read(IMPORT_CHUNK_BYTES)
+                if not chunk:
+                    break
+                s.sendall(encode_frame(FRAME_CHUNK, chunk))
+            s.sendall(encode_frame(FRAME_END))
+            return read_response(s)
+    except ConnectionRefusedError:
+        return {'status': 'ошибка', 'message': 'Статическая ошибка С-1: Соединение отклонено. Проверьте, запущен ли сервер.'}
+    except OSError as e:
+        return {'status': 'ошибка', 'message': f'Ошибка чтения файла или соединения: {e}'}
+    except Exception as e:
+        return {'status': 'ошибка', 'message': f'Произошла ошибка: {e}'}
 
-            # Декодируем и парсим JSON ответ
-            response = json.loads(response_data.decode('utf-8'))
+def export_to_file(command, path, fmt=None):
+    """Выгружает таблицу командой export_* и записывает строки в CSV/JSONL файл по мере получения."""
+    if fmt is None:
+        fmt = 'jsonl' if path.lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+    written = 0
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s, open(path, 'w', encoding='utf-8', newline='') as f:
+            s.connect((SERVER_HOST, SERVER_PORT))
+            s.sendall(hello_frame() + encode_frame(FRAME_REQUEST, json.dumps({'command': command}).encode('utf-8')))
+            decode = read_hello(s)
+            writer = csv.writer(f) if fmt == 'csv' else None
+            header_written = False
+
+            def write_batch(response, batch):
+                nonlocal written, header_written
+                columns = response['columns']
+                if writer and not header_written:
+                    writer.writerow(columns)
+                    header_written = True
+                for row in batch:
+                    if writer:
+                        writer.writerow(row)
+                    else:
+                        f.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n')
+                written += len(batch)
+
+            response = read_response(s, on_batch=write_batch, decode=decode)
+            if response.get('status') == 'успех' and writer and not header_written:
+                writer.writerow(response.get('columns', [])) # Пустая таблица: только заголовок
+            if response.get('status') == 'успех':
+                response['message'] = f'Выгружено строк: {written} в файл {path}.'
             return response
     except ConnectionRefusedError:
         return {'status': 'ошибка', 'message': 'Статическая ошибка С-1: Соединение отклонено. Проверьте, запущен ли сервер.'}
-    except ConnectionResetError:
-         return {'status': 'ошибка', 'message': 'Статическая ошибка С-3: Соединение сброшено сервером.'}
-    except json.JSONDecodeError:
-         return {'status': 'ошибка', 'message': 'Статическая ошибка С-5: Не удалось понять ответ сервера.'}
+    except OSError as e:
+        return {'status': 'ошибка', 'message': f'Ошибка записи файла или соединения: {e}'}
     except Exception as e:
         return {'status': 'ошибка', 'message': f'Произошла ошибка: {e}'}
 
@@ -68,6 +468,7 @@ def main_menu():
         print("  3. Обновить студента")
         print("  4. Показать всех студентов")
         print("  5. Найти студента по имени")
+        print(" 19. Поиск студентов (ФИО, группа, предмет, преподаватель)")
         print("Предметы:")
         print("  6. Добавить предмет")
         print("  7. Назначить предмет студенту")
@@ -81,6 +482,11 @@ def main_menu():
         print(" 14. Получить средний балл студента")
         print(" 15. Получить средний балл по предмету")
         print(" 16. Найти студентов с баллом ниже порогового значения")
+        print("Данные:")
+        print(" 17. Импорт из CSV/JSONL файла")
+        print(" 18. Экспорт в CSV/JSONL файл")
+        print(" 20. Следить за изменениями (Ctrl+C - остановить)")
+        print(" 21. Резервная копия БД (на сервере, без остановки)")
         print("  0. Выход")
         print("-----------------------------")
 
@@ -131,13 +537,24 @@ def main_menu():
 
 
         elif choice == '4':
-            # Список всех студентов
+            # Список всех студентов (постранично)
             print("\n-- Список всех студентов --")
-            response = send_request({'command': 'list_students'})
-            if response.get('status') == 'успех':
+            filters = {}
+            group_name = get_input("Фильтр по группе (пусто - все): ", allow_empty=True)
+            course = get_input("Фильтр по курсу (пусто - все): ", required_type=int, allow_empty=True)
+            if group_name: filters['group_name'] = group_name
+            if course is not None: filters['course'] = course
+            # Следующая страница запрашивается только по требованию пользователя
+            for page_number, response in enumerate(iter_students(**filters), start=1):
+                if response.get('status') != 'успех':
+                    print(f"Ошибка: {response.get('message', 'Неизвестная ошибка')}")
+                    break
+                print(f"Страница {page_number}:")
                 print_table(response.get('data', []))
-            else:
-                print(f"Ошибка: {response.get('message', 'Неизвестная ошибка')}")
+                if not response.get('next_cursor'):
+                    break
+                if input("Enter - следующая страница, q - закончить: ").strip().lower() == 'q':
+                    break
 
         elif choice == '5':
              # Найти студента по имени
@@ -222,7 +639,7 @@ def main_menu():
              grade = get_input("Введите оценку: ", required_type=float)
              response = send_request({'command': 'add_grade', 'payload': {'student_id': student_id, 'subject_id': subject_id, 'grade': grade}})
              print(f"Ответ сервера: {response.get('message', 'Сообщение не получено')}")
-             # Примечание: команда update_grade также существует, но add_grade с INSERT OR REPLACE охватывает оба случая
+             # Примечание: команда update_grade также существует, но add_grade (INSERT ... ON CONFLICT DO UPDATE) охватывает оба случая
 
         elif choice == '13':
              # Удалить оценку
@@ -273,8 +690,70 @@ def main_menu():
              else:
                  print(f"Ошибка: {response.get('message', 'Неизвестная ошибка')}")
 
+        elif choice == '17':
+             # Импорт из файла
+             print("\n-- Импорт из CSV/JSONL файла --")
+             kind = get_input("Что загружаем (students/subjects/grades): ")
+             path = get_input("Путь к файлу: ")
+             on_conflict = get_input("При совпадении (abort/ignore/update) [abort]: ", allow_empty=True) or 'abort'
+             options = {}
+             if kind == 'grades':
+                 options['assign'] = (get_input("Назначать предмет, если не назначен? (да/нет) [нет]: ", allow_empty=True) or '').lower() == 'да'
+             response = import_file(f'import_{kind}', path, on_conflict=on_conflict, **options)
+             print(f"Ответ сервера: {response.get('message', 'Сообщение не получено')}")
+
+        elif choice == '18':
+             # Экспорт в файл
+             print("\n-- Экспорт в CSV/JSONL файл --")
+             kind = get_input("Что выгружаем (students/subjects/student_subjects/grades): ")
+             path = get_input("Путь к файлу (.csv или .jsonl): ")
+             response = export_to_file(f'export_{kind}', path)
+             print(f"Ответ сервера: {response.get('message', 'Сообщение не получено')}")
+
+        elif choice == '19':
+             # Полнотекстовый поиск: начала слов, опечатки, результаты по релевантности
+             print("\n-- Поиск студентов --")
+             query = get_input("Что ищем (например, 'иванов ис-21' или 'базы данных'): ")
+             response = send_request({'command': 'search_students', 'payload': {'query': query}})
+             if response.get('status') == 'успех':
+                 print_table(response.get('data', []))
+             else:
+                 print(f"Ошибка: {response.get('message', 'Неизвестная ошибка')}")
+
+        elif choice == '20':
+             # Подписка на изменения: события печатаются по мере фиксации на сервере
+             print("\n-- Изменения в БД (Ctrl+C - остановить) --")
+             after_seq = get_input("Начать после события № (Enter - только новые): ", int, allow_empty=True)
+             last_seq = after_seq
+             try:
+                 for event in iter_changes(after_seq):
+                     last_seq = event['seq']
+                     print(f"[{event['seq']}] {event['command']}: {json.dumps(event['payload'], ensure_ascii=False)}")
+             except KeyboardInterrupt:
+                 print(f"\nПодписка остановлена. Последнее событие: {last_seq}")
+             except (OSError, ValueError) as e:
+                 print(f"Ошибка: {e}")
+
+        elif choice == '21':
+             # Резервная копия: сервер копирует БД в фоне, клиент показывает ход
+             print("\n-- Резервная копия БД --")
+             name = get_input("Имя файла снимка (Enter - по дате и времени): ", allow_empty=True)
+             response = send_request({'command': 'backup', 'payload': {'name': name} if name else {}})
+             print(f"Ответ сервера: {response.get('message', 'Сообщение не получено')}")
+             while response.get('status') == 'успех' and response['data']['состояние'] == 'выполняется':
+                 time.sleep(BACKUP_POLL_INTERVAL)
+                 response = send_request({'command': 'backup_status'})
+                 if response.get('status') == 'успех':
+                     print(f"  {response['data']['процент']}% ({response['data']['страниц']} страниц)")
+             if response.get('status') == 'успех':
+                 data = response['data']
+                 print(f"Состояние: {data['состояние']}, файл: {data['файл']}" + (f", ошибка: {data['ошибка']}" if data['ошибка'] else ''))
+             else:
+                 print(f"Ошибка: {response.get('message', 'Неизвестная ошибка')}")
+
         elif choice == '0':
             print("Завершение работы клиента.")
+            close_default_clients()
             break
 
         else:
@@ -1,9 +1,34 @@
 import socket
+import argparse
+import asyncio
+import codecs
+import collections
+import concurrent.futures
+import csv
+import difflib
 import threading
 import sqlite3
 import json
 import logging
+import logging.handlers
+import itertools
 import os # Added import
+import pathlib
+import queue
+import random
+import re
+import signal
+import struct
+import time
+
+try: # Необязательные ускорители формата обмена
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -14,21 +39,121 @@ DATABASE = os.path.join(SCRIPT_DIR, 'student_database.db')
 HOST = '127.0.0.1'  # Локалхост
 PORT = 65432
 
+# Параметры пула соединений с БД
+POOL_SIZE = 8               # Максимальное число одновременно открытых соединений
+POOL_TIMEOUT = 5.0          # Сколько секунд ждать освобождения соединения
+STATEMENT_CACHE_SIZE = 128  # Размер кэша подготовленных выражений на одно соединение
+
+# Кэш результатов читающих команд
+CACHE_MAX_ENTRIES = 1024    # Максимум записей (0 - кэш отключен)
+CACHE_TTL = 30.0            # Срок жизни записи, с
+
+# Профили надежности записи (выбираются при старте сервера)
+DURABILITY_PROFILES = {
+    # Текущее поведение: журнал отката, полный fsync на каждый коммит, писатель блокирует читателей
+    'safe': {'journal_mode': 'DELETE', 'synchronous': 'FULL'},
+    # WAL: читатели не блокируются писателем, fsync только при контрольных точках
+    'wal': {'journal_mode': 'WAL', 'synchronous': 'NORMAL'},
+    # Массовый импорт: без fsync, большой кэш страниц, временные данные в памяти.
+    # При сбое ОС последние транзакции могут быть потеряны!
+    'bulk': {'journal_mode': 'WAL', 'synchronous': 'OFF', 'cache_size': -65536, 'temp_store': 'MEMORY'},
+}
+DURABILITY_PROFILE = 'safe'     # Текущий профиль (меняется через set_durability_profile)
+WAL_CHECKPOINT_INTERVAL = 30.0  # Период фоновой контрольной точки WAL, с (0 - только автоматические)
+_checkpointer_active = False    # Фоновый поток контрольных точек запущен
+
+# Протокол с кадрами (см. раздел "Протокол обмена")
+PROTOCOL_MAGIC = b'SD'                   # Сигнатура кадра (старые клиенты начинают с '{')
+PROTOCOL_VERSION = 1
+FRAME_HEADER = struct.Struct('!2sBBI')   # Сигнатура, версия, тип кадра, длина тела
+FRAME_REQUEST = 1                        # Запрос клиента (JSON)
+FRAME_RESPONSE = 2                       # Ответ сервера (JSON)
+FRAME_CHUNK = 3                          # Пакет строк потокового ответа (JSON-массив)
+FRAME_END = 4                            # Конец потокового ответа
+FRAME_HELLO = 5                          # Согласование формата ответов (тело всегда JSON)
+MAX_FRAME_SIZE = 16 * 1024 * 1024        # Защита от огромных кадров
+STREAM_BATCH_ROWS = 500                  # Строк в одном пакете потокового ответа
+LEGACY_BUFFER_LIMIT = 1024 * 1024        # Максимальный размер незавершенного запроса старого клиента
+MAX_BATCH_SIZE = 10000                   # Максимум команд в одном пакете (команда batch)
+IMPORT_BATCH_ROWS = 5000                 # Строк в одном вызове executemany при импорте
+MAX_PAGE_SIZE = 1000                     # Максимальный размер страницы list_students
+
+# Полнотекстовый поиск студентов (search_students)
+SEARCH_LIMIT = 20               # Результатов по умолчанию
+SEARCH_FUZZY_TERMS = 3          # Сколько похожих слов словаря подставлять вместо слова с опечаткой
+SEARCH_FUZZY_CUTOFF = 0.7       # Минимальная похожесть слова (difflib, 0..1)
+SEARCH_FUZZY_CANDIDATES = 20000 # Предел слов словаря, просматриваемых для одного слова запроса
+
+# Лента изменений (команда subscribe)
+CHANGE_FEED_BATCH = 500            # Событий в одном пакете потока
+CHANGE_FEED_HEARTBEAT = 15.0       # Пустой пакет подписчику, если изменений нет дольше, с
+CHANGE_FEED_POLL_INTERVAL = 1.0    # Проверка журнала без уведомления (записи других процессов prefork), с
+CHANGE_LOG_RETENTION = 100000      # Сколько последних событий хранить в Change_Log
+CHANGE_LOG_TRIM_EVERY = 1000       # Чистить журнал раз в столько событий
+
+# Резервное копирование на ходу (команда backup)
+BACKUP_DIR = os.path.join(SCRIPT_DIR, 'backups')  # Куда складываются снимки БД
+BACKUP_PAGES = 256         # Страниц БД за один шаг копирования
+BACKUP_PAUSE = 0.05        # Пауза между шагами, с: писатели успевают зафиксировать свои транзакции
+BACKUP_MAX_RESTARTS = 5    # После стольких перезапусков из-за записи копия снимается за один шаг
+
+# Асинхронный режим сервера (--mode async)
+MAX_CONNECTIONS = 1000        # Предел одновременных соединений
+DB_WORKERS = POOL_SIZE        # Потоков для блокирующей работы с SQLite
+CLIENT_IDLE_TIMEOUT = 300.0   # Закрывать соединение, если клиент молчит дольше, с
+SHUTDOWN_TIMEOUT = 10.0       # Сколько ждать завершения текущих запросов при остановке, с
+
+# Журнал содержимого запросов и ответов (логгер PAYLOAD_LOGGER, уровень DEBUG; по умолчанию выключен)
+PAYLOAD_LOGGER = 'studentdb.payload'
+PAYLOAD_LOG_SAMPLE = 1.0       # Доля запросов, попадающих в журнал (0..1)
+PAYLOAD_LOG_MAX_CHARS = 1000   # Длина записи, после которой текст обрезается
+PAYLOAD_LOG_MAX_ROWS = 5       # Сколько строк списка 'data' показывать в записи ответа
+
 # --- Инициализация и работа с БД ---
 
-def get_db_connection():
-    """Создает соединение с БД."""
-    conn = sqlite3.connect(DATABASE)
+def get_db_connection(read_only=False):
+    """Создает соединение с БД (read_only=True - только для чтения, запись через него невозможна)."""
+    # check_same_thread=False: соединение из пула используется разными потоками (но не одновременно)
+    if read_only:
+        uri = pathlib.Path(DATABASE).absolute().as_uri() + '?mode=ro'
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+    else:
+        conn = sqlite3.connect(DATABASE, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
     conn.row_factory = sqlite3.Row # Возвращать строки как словари (объекты, похожие на словари)
     conn.execute("PRAGMA foreign_keys = ON;") # Включить поддержку внешних ключей для целостности данных
+    # Параметры профиля, действующие на уровне соединения (journal_mode хранится в самом файле БД, см. init_db)
+    profile = DURABILITY_PROFILES[DURABILITY_PROFILE]
+    for pragma, value in profile.items():
+        if pragma != 'journal_mode':
+            conn.execute(f"PRAGMA {pragma} = {value};")
+    if profile['journal_mode'] == 'WAL' and _checkpointer_active:
+        # Контрольные точки делает фоновый поток, а не коммит очередного запроса
+        conn.execute("PRAGMA wal_autocheckpoint = 0;")
     return conn
 
+def get_read_connection():
+    """Создает соединение только для чтения (фабрика пула читающих команд)."""
+    return get_db_connection(read_only=True)
+
+def set_durability_profile(name):
+    """Выбирает профиль надежности записи ('safe', 'wal' или 'bulk')."""
+    global DURABILITY_PROFILE
+    if name not in DURABILITY_PROFILES:
+        raise ValueError(f"Неизвестный профиль надежности: {name}")
+    DURABILITY_PROFILE = name
+    logging.info(f"Профиль надежности записи: {name} {DURABILITY_PROFILES[name]}")
+
 def init_db():
     """Инициализирует структуру БД и добавляет тестовые данные."""
     logging.info("Инициализация базы данных...")
     conn = get_db_connection()
     cursor = conn.cursor()
 
+    # Режим журнала сохраняется в файле БД, поэтому устанавливается один раз при старте
+    journal_mode = DURABILITY_PROFILES[DURABILITY_PROFILE]['journal_mode']
+    cursor.execute(f"PRAGMA journal_mode = {journal_mode};")
+    logging.info(f"Режим журнала БД: {cursor.fetchone()[0]}")
+
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS Students (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -109,315 +234,2637 @@ def init_db():
 
 
     conn.commit()
+    apply_migrations(conn)
     conn.close()
     logging.info("База данных успешно инициализирована.")
 
-# --- Функции обработки запросов ---
+# Полный пересчет агрегатов оценок (первичное заполнение и команда rebuild_aggregates)
+AGGREGATE_REBUILD_SQL = [
+    'DELETE FROM Student_Grade_Stats',
+    '''INSERT INTO Student_Grade_Stats (student_id, grade_sum, grade_count, avg_grade)
+       SELECT student_id, SUM(grade), COUNT(*), AVG(grade) FROM Grades GROUP BY student_id''',
+    'DELETE FROM Subject_Grade_Stats',
+    '''INSERT INTO Subject_Grade_Stats (subject_id, grade_sum, grade_count, avg_grade)
+       SELECT subject_id, SUM(grade), COUNT(*), AVG(grade) FROM Grades GROUP BY subject_id''',
+]
 
-def handle_request(data):
-    """Обрабатывает запрос от клиента и вызывает соответствующую функцию БД."""
-    command = data.get('command')
-    payload = data.get('payload', {})
-    conn = None # Инициализация переменной соединения
+# Текст предметов студента для поискового индекса: названия и преподаватели через пробел
+STUDENT_SUBJECTS_TEXT = """(SELECT group_concat(sub.subject_name || ' ' || ifnull(sub.teacher, ''), ' ')
+    FROM Student_Subjects ss JOIN Subjects sub ON sub.id = ss.subject_id WHERE ss.student_id = {student})"""
 
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+# Полное перестроение поискового индекса (первичное заполнение и команда rebuild_search_index)
+SEARCH_REBUILD_SQL = [
+    'DELETE FROM Student_Search',
+    f'''INSERT INTO Student_Search (rowid, full_name, group_name, subjects)
+       SELECT s.id, s.full_name, s.group_name, ifnull({STUDENT_SUBJECTS_TEXT.format(student='s.id')}, '')
+       FROM Students s''',
+    "INSERT INTO Student_Search (Student_Search) VALUES ('optimize')", # Слить сегменты индекса в один
+]
 
-        if command == 'add_student':
-            cursor.execute(
-                'INSERT INTO Students (full_name, age, group_name, course, average_grade) VALUES (?, ?, ?, ?, ?)',
-                (payload['full_name'], payload['age'], payload['group_name'], payload['course'], payload['average_grade'])
-            )
+# Миграции схемы: (версия, описание, SQL-команды). Номер последней примененной миграции
+# хранится в PRAGMA user_version, поэтому каждая миграция выполняется ровно один раз.
+SCHEMA_MIGRATIONS = [
+    (1, "Вторичные индексы по второму столбцу связей и оценок, по группе и курсу", [
+        # Поиск студентов по предмету и средний балл по предмету шли полным перебором
+        'CREATE INDEX IF NOT EXISTS idx_student_subjects_subject ON Student_Subjects(subject_id)',
+        'CREATE INDEX IF NOT EXISTS idx_grades_subject ON Grades(subject_id)',
+        'CREATE INDEX IF NOT EXISTS idx_students_group_course ON Students(group_name, course)',
+        'ANALYZE',
+    ]),
+    (2, "Материализованные агрегаты оценок по студентам и предметам", [
+        # Сумма, количество и среднее поддерживаются триггерами на Grades, поэтому
+        # средние баллы читаются одной строкой вместо AVG() по всей таблице оценок.
+        '''CREATE TABLE IF NOT EXISTS Student_Grade_Stats (
+            student_id INTEGER PRIMARY KEY,
+            grade_sum REAL NOT NULL DEFAULT 0,
+            grade_count INTEGER NOT NULL DEFAULT 0,
+            avg_grade REAL -- NULL, если оценок нет
+        )''',
+        '''CREATE TABLE IF NOT EXISTS Subject_Grade_Stats (
+            subject_id INTEGER PRIMARY KEY,
+            grade_sum REAL NOT NULL DEFAULT 0,
+            grade_count INTEGER NOT NULL DEFAULT 0,
+            avg_grade REAL
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_student_grade_stats_avg ON Student_Grade_Stats(avg_grade)',
+        '''CREATE TRIGGER IF NOT EXISTS trg_grades_insert AFTER INSERT ON Grades BEGIN
+            INSERT INTO Student_Grade_Stats (student_id, grade_sum, grade_count, avg_grade)
+            VALUES (NEW.student_id, NEW.grade, 1, NEW.grade)
+            ON CONFLICT(student_id) DO UPDATE SET grade_sum = grade_sum + excluded.grade_sum,
+                grade_count = grade_count + 1, avg_grade = (grade_sum + excluded.grade_sum) / (grade_count + 1);
+            INSERT INTO Subject_Grade_Stats (subject_id, grade_sum, grade_count, avg_grade)
+            VALUES (NEW.subject_id, NEW.grade, 1, NEW.grade)
+            ON CONFLICT(subject_id) DO UPDATE SET grade_sum = grade_sum + excluded.grade_sum,
+                grade_count = grade_count + 1, avg_grade = (grade_sum + excluded.grade_sum) / (grade_count + 1);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_grades_delete AFTER DELETE ON Grades BEGIN
+            UPDATE Student_Grade_Stats SET grade_sum = grade_sum - OLD.grade, grade_count = grade_count - 1,
+                avg_grade = CASE WHEN grade_count > 1 THEN (grade_sum - OLD.grade) / (grade_count - 1) END
+            WHERE student_id = OLD.student_id;
+            UPDATE Subject_Grade_Stats SET grade_sum = grade_sum - OLD.grade, grade_count = grade_count - 1,
+                avg_grade = CASE WHEN grade_count > 1 THEN (grade_sum - OLD.grade) / (grade_count - 1) END
+            WHERE subject_id = OLD.subject_id;
+        END''',
+        # Обновление оценки = удаление старого значения + добавление нового
+        '''CREATE TRIGGER IF NOT EXISTS trg_grades_update AFTER UPDATE OF student_id, subject_id, grade ON Grades BEGIN
+            UPDATE Student_Grade_Stats SET grade_sum = grade_sum - OLD.grade, grade_count = grade_count - 1,
+                avg_grade = CASE WHEN grade_count > 1 THEN (grade_sum - OLD.grade) / (grade_count - 1) END
+            WHERE student_id = OLD.student_id;
+            UPDATE Subject_Grade_Stats SET grade_sum = grade_sum - OLD.grade, grade_count = grade_count - 1,
+                avg_grade = CASE WHEN grade_count > 1 THEN (grade_sum - OLD.grade) / (grade_count - 1) END
+            WHERE subject_id = OLD.subject_id;
+            INSERT INTO Student_Grade_Stats (student_id, grade_sum, grade_count, avg_grade)
+            VALUES (NEW.student_id, NEW.grade, 1, NEW.grade)
+            ON CONFLICT(student_id) DO UPDATE SET grade_sum = grade_sum + excluded.grade_sum,
+                grade_count = grade_count + 1, avg_grade = (grade_sum + excluded.grade_sum) / (grade_count + 1);
+            INSERT INTO Subject_Grade_Stats (subject_id, grade_sum, grade_count, avg_grade)
+            VALUES (NEW.subject_id, NEW.grade, 1, NEW.grade)
+            ON CONFLICT(subject_id) DO UPDATE SET grade_sum = grade_sum + excluded.grade_sum,
+                grade_count = grade_count + 1, avg_grade = (grade_sum + excluded.grade_sum) / (grade_count + 1);
+        END''',
+        # Оценки удаляются каскадно, а строку агрегата студента/предмета убираем здесь
+        '''CREATE TRIGGER IF NOT EXISTS trg_students_delete_stats AFTER DELETE ON Students BEGIN
+            DELETE FROM Student_Grade_Stats WHERE student_id = OLD.id;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_subjects_delete_stats AFTER DELETE ON Subjects BEGIN
+            DELETE FROM Subject_Grade_Stats WHERE subject_id = OLD.id;
+        END''',
+    ] + AGGREGATE_REBUILD_SQL),
+    (3, "Полнотекстовый индекс FTS5 по ФИО, группе и предметам студента", [
+        # rowid строки индекса = id студента. unicode61 приводит регистр (в т.ч. кириллицы),
+        # prefix='2 3' - отдельные индексы коротких префиксов, чтобы "ив*" не перебирал весь словарь.
+        """CREATE VIRTUAL TABLE IF NOT EXISTS Student_Search USING fts5(
+            full_name, group_name, subjects, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')""",
+        # Ранжирование по умолчанию: совпадение в ФИО важнее группы, группа - важнее предметов
+        "INSERT INTO Student_Search (Student_Search, rank) VALUES ('rank', 'bm25(10.0, 5.0, 1.0)')",
+        # Словарь индекса: по нему подбираются похожие слова для нечеткого поиска
+        'CREATE VIRTUAL TABLE IF NOT EXISTS Student_Search_Vocab USING fts5vocab(Student_Search, row)',
+        '''CREATE TRIGGER IF NOT EXISTS trg_students_insert_search AFTER INSERT ON Students BEGIN
+            INSERT INTO Student_Search (rowid, full_name, group_name, subjects)
+            VALUES (NEW.id, NEW.full_name, NEW.group_name, '');
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_students_update_search AFTER UPDATE OF full_name, group_name ON Students BEGIN
+            UPDATE Student_Search SET full_name = NEW.full_name, group_name = NEW.group_name WHERE rowid = NEW.id;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_students_delete_search AFTER DELETE ON Students BEGIN
+            DELETE FROM Student_Search WHERE rowid = OLD.id;
+        END''',
+        # Назначение и снятие предмета (в т.ч. каскадное) пересобирает текст предметов одного студента
+        f'''CREATE TRIGGER IF NOT EXISTS trg_student_subjects_insert_search AFTER INSERT ON Student_Subjects BEGIN
+            UPDATE Student_Search SET subjects = ifnull({STUDENT_SUBJECTS_TEXT.format(student='NEW.student_id')}, '')
+            WHERE rowid = NEW.student_id;
+        END''',
+        f'''CREATE TRIGGER IF NOT EXISTS trg_student_subjects_delete_search AFTER DELETE ON Student_Subjects BEGIN
+            UPDATE Student_Search SET subjects = ifnull({STUDENT_SUBJECTS_TEXT.format(student='OLD.student_id')}, '')
+            WHERE rowid = OLD.student_id;
+        END''',
+        # Переименование предмета или смена преподавателя (импорт с on_conflict=update) - у всех его студентов
+        f'''CREATE TRIGGER IF NOT EXISTS trg_subjects_update_search AFTER UPDATE OF subject_name, teacher ON Subjects BEGIN
+            UPDATE Student_Search SET subjects = ifnull({STUDENT_SUBJECTS_TEXT.format(student='Student_Search.rowid')}, '')
+            WHERE rowid IN (SELECT student_id FROM Student_Subjects WHERE subject_id = NEW.id);
+        END''',
+    ] + SEARCH_REBUILD_SQL),
+    (4, "Журнал изменений для подписчиков (команда subscribe)", [
+        # AUTOINCREMENT: номера событий только растут и не переиспользуются после чистки журнала
+        '''CREATE TABLE IF NOT EXISTS Change_Log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts REAL NOT NULL,       -- Время фиксации (Unix, с)
+            command TEXT NOT NULL,  -- Пишущая команда
+            payload TEXT            -- Ее параметры (JSON)
+        )''',
+    ]),
+]
+
+def apply_migrations(conn):
+    """Применяет недостающие миграции схемы, каждую в своей транзакции."""
+    current = conn.execute("PRAGMA user_version;").fetchone()[0]
+    for version, description, statements in SCHEMA_MIGRATIONS:
+        if version <= current:
+            continue
+        logging.info(f"Миграция схемы {version}: {description}")
+        conn.execute("BEGIN")
+        try:
+            for sql in statements:
+                conn.execute(sql)
+            conn.execute(f"PRAGMA user_version = {version};")
             conn.commit()
-            return {'status': 'успех', 'message': 'Студент успешно добавлен.'}
+        except sqlite3.Error:
+            conn.rollback()
+            raise
 
-        elif command == 'delete_student':
-            cursor.execute('DELETE FROM Students WHERE full_name = ?', (payload['full_name'],))
-            if cursor.rowcount > 0:
-                conn.commit()
-                return {'status': 'успех', 'message': f'Студент {payload["full_name"]} удален.'}
-            else:
-                return {'status': 'ошибка', 'message': f'Студент {payload["full_name"]} не найден.'}
-
-        elif command == 'update_student':
-            # Собираем поля для обновления
-            fields_to_update = []
-            values = []
-            for key, value in payload.items():
-                if key != 'full_name_to_update' and value is not None:
-                    fields_to_update.append(f"{key} = ?")
-                    values.append(value)
-
-            if not fields_to_update:
-                 return {'status': 'ошибка', 'message': 'Не указаны поля для обновления.'}
-
-            values.append(payload['full_name_to_update']) # Добавляем имя студента в конец списка значений для условия WHERE
-            sql = f"UPDATE Students SET {', '.join(fields_to_update)} WHERE full_name = ?"
-            cursor.execute(sql, tuple(values))
-
-            if cursor.rowcount > 0: # Проверяем, была ли обновлена хотя бы одна строка
-                conn.commit()
-                return {'status': 'успех', 'message': f'Студент {payload["full_name_to_update"]} обновлен.'}
-            else:
-                return {'status': 'ошибка', 'message': f'Студент {payload["full_name_to_update"]} не найден или изменения не были внесены.'}
+# --- Контрольные точки WAL ---
+
+def _wal_checkpoint_loop(stop_event, interval):
+    """Периодически переносит WAL в основной файл БД, не блокируя читателей."""
+    conn = get_db_connection()
+    try:
+        while not stop_event.wait(interval):
+            try:
+                # PASSIVE не ждет читателей и писателей: копирует только то, что можно прямо сейчас
+                busy, log_frames, checkpointed = conn.execute("PRAGMA wal_checkpoint(PASSIVE);").fetchone()
+                logging.debug(f"Контрольная точка WAL: кадров в журнале {log_frames}, перенесено {checkpointed}, занято={busy}")
+            except sqlite3.Error as e:
+                logging.warning(f"Ошибка контрольной точки WAL: {e}")
+    finally:
+        conn.close()
+
+def start_wal_checkpointer(interval=WAL_CHECKPOINT_INTERVAL):
+    """Запускает фоновый поток контрольных точек WAL. Возвращает событие для его остановки."""
+    global _checkpointer_active
+    stop_event = threading.Event()
+    if interval <= 0 or DURABILITY_PROFILES[DURABILITY_PROFILE]['journal_mode'] != 'WAL':
+        return stop_event # В режиме журнала отката контрольные точки не нужны
+    _checkpointer_active = True
+    checkpoint_thread = threading.Thread(target=_wal_checkpoint_loop, args=(stop_event, interval), daemon=True)
+    checkpoint_thread.start()
+    logging.info(f"Фоновая контрольная точка WAL каждые {interval} с.")
+    return stop_event
+
+# --- Пул соединений ---
+
+class PoolTimeoutError(Exception):
+    """Не удалось получить соединение из пула за отведенное время."""
 
 
-        elif command == 'list_students':
-            cursor.execute('SELECT id, full_name, age, group_name, course, average_grade FROM Students ORDER BY full_name')
-            students = [dict(row) for row in cursor.fetchall()]
-            return {'status': 'успех', 'data': students}
+class ConnectionPool:
+    """Ограниченный пул соединений с БД (очередь выдачи/возврата).
 
-        elif command == 'find_student':
-            cursor.execute('SELECT id, full_name, age, group_name, course, average_grade FROM Students WHERE full_name = ?', (payload['full_name'],))
-            student = cursor.fetchone()
-            if student:
-                return {'status': 'успех', 'data': dict(student)}
+    Соединения создаются лениво, но не больше size штук. Соединения живут долго,
+    поэтому кэш подготовленных выражений sqlite3 переиспользуется между запросами.
+    """
+
+    def __init__(self, size=POOL_SIZE, timeout=POOL_TIMEOUT, factory=None):
+        self.size = size
+        self.timeout = timeout
+        self._factory = factory or get_db_connection
+        self._idle = queue.LifoQueue() # LIFO: чаще выдаем недавно использованные ("горячие") соединения
+        self._lock = threading.Lock()
+        self._created = 0
+        self._closed = False
+        # Метрики
+        self._checkouts = 0
+        self._timeouts = 0
+        self._in_use = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._hold_total = 0.0
+        self._checkout_times = {} # id(conn) -> момент выдачи
+
+    def acquire(self):
+        """Выдает соединение из пула, при необходимости создает новое или ждет освобождения."""
+        if self._closed:
+            raise PoolTimeoutError("Пул соединений закрыт.")
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self.size
+                if can_create:
+                    self._created += 1 # Резервируем место до создания, чтобы не превысить лимит
+            if can_create:
+                try:
+                    conn = self._factory()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
             else:
-                return {'status': 'ошибка', 'message': f'Студент {payload["full_name"]} не найден.'}
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self._timeouts += 1
+                    raise PoolTimeoutError(f"Нет свободных соединений в пуле (ожидание {self.timeout} с).")
 
-        elif command == 'add_subject':
-             cursor.execute(
-                 'INSERT INTO Subjects (subject_name, teacher) VALUES (?, ?)',
-                 (payload['subject_name'], payload['teacher'])
-             )
-             conn.commit()
-             return {'status': 'успех', 'message': 'Предмет успешно добавлен.'}
+        now = time.perf_counter()
+        wait = now - start
+        with self._lock:
+            self._checkouts += 1
+            self._in_use += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+            self._checkout_times[id(conn)] = now
+        return conn
 
-        elif command == 'assign_subject':
-            try:
-                cursor.execute('INSERT INTO Student_Subjects (student_id, subject_id) VALUES (?, ?)',
-                               (payload['student_id'], payload['subject_id']))
-                conn.commit()
-                return {'status': 'успех', 'message': 'Предмет успешно назначен.'}
-            except sqlite3.IntegrityError as e:
-                 # Проверяем тип ошибки целостности
-                 if 'FOREIGN KEY constraint failed' in str(e): # Ошибка внешнего ключа (несуществующий студент или предмет)
-                     return {'status': 'ошибка', 'message': 'ID студента или ID предмета не найден.'}
-                 elif 'UNIQUE constraint failed' in str(e): # Ошибка уникальности (попытка добавить существующую связь)
-                     return {'status': 'ошибка', 'message': 'Этот предмет уже назначен этому студенту.'}
-                 else:
-                     raise # Перебросить другие (неожиданные) ошибки целостности
-
-        elif command == 'unassign_subject':
-             cursor.execute('DELETE FROM Student_Subjects WHERE student_id = ? AND subject_id = ?',
-                            (payload['student_id'], payload['subject_id']))
-             if cursor.rowcount > 0:
-                 conn.commit()
-                 return {'status': 'успех', 'message': 'Предмет успешно отменен.'}
-             else:
-                 return {'status': 'ошибка', 'message': 'Назначение не найдено (проверьте ID студента/предмета).'}
-
-        elif command == 'list_students_subjects':
-            sql = """
-            SELECT s.full_name, sub.subject_name, sub.teacher
-            FROM Students s
-            JOIN Student_Subjects ss ON s.id = ss.student_id
-            JOIN Subjects sub ON ss.subject_id = sub.id
-            ORDER BY s.full_name, sub.subject_name;
-            """
-            cursor.execute(sql)
-            results = [dict(row) for row in cursor.fetchall()]
-            return {'status': 'успех', 'data': results}
-
-        elif command == 'find_students_by_subject':
-             sql = """
-             SELECT s.full_name, s.group_name, s.course
-             FROM Students s
-             JOIN Student_Subjects ss ON s.id = ss.student_id
-             JOIN Subjects sub ON ss.subject_id = sub.id
-             WHERE sub.id = ? OR sub.subject_name = ?
-             ORDER BY s.full_name;
-             """
-             cursor.execute(sql, (payload.get('subject_id'), payload.get('subject_name')))
-             results = [dict(row) for row in cursor.fetchall()]
-             return {'status': 'успех', 'data': results}
-
-        elif command == 'find_subjects_by_student':
-             sql = """
-             SELECT sub.subject_name, sub.teacher
-             FROM Subjects sub
-             JOIN Student_Subjects ss ON sub.id = ss.subject_id
-             JOIN Students s ON ss.student_id = s.id
-             WHERE s.id = ? OR s.full_name = ?
-             ORDER BY sub.subject_name;
-             """
-             cursor.execute(sql, (payload.get('student_id'), payload.get('student_name')))
-             results = [dict(row) for row in cursor.fetchall()]
-             return {'status': 'успех', 'data': results}
-
-        elif command == 'add_grade':
-            try:
-                 # Проверим, изучает ли студент этот предмет
-                 cursor.execute("SELECT 1 FROM Student_Subjects WHERE student_id = ? AND subject_id = ?",
-                                (payload['student_id'], payload['subject_id']))
-                 if not cursor.fetchone(): # Если запрос ничего не вернул, значит студент не изучает этот предмет
-                     return {'status': 'ошибка', 'message': 'Невозможно добавить оценку. Студент не назначен на этот предмет.'}
-
-                 # Добавляем или обновляем оценку (используем INSERT OR REPLACE для простоты: если запись существует, она заменяется)
-                 cursor.execute(
-                     'INSERT OR REPLACE INTO Grades (student_id, subject_id, grade) VALUES (?, ?, ?)',
-                     (payload['student_id'], payload['subject_id'], payload['grade'])
-                 )
-                 conn.commit()
-                 return {'status': 'успех', 'message': 'Оценка успешно добавлена/обновлена.'}
-            except sqlite3.IntegrityError as e:
-                 if 'FOREIGN KEY constraint failed' in str(e):
-                      return {'status': 'ошибка', 'message': 'ID студента или ID предмета не найден.'}
-                 else:
-                      raise # Перебросить другие ошибки целостности
-
-        elif command == 'update_grade': # Явное обновление оценки (в отличие от add_grade, не создаст запись, если ее нет)
-             cursor.execute(
-                 'UPDATE Grades SET grade = ? WHERE student_id = ? AND subject_id = ?',
-                 (payload['grade'], payload['student_id'], payload['subject_id'])
-             )
-             if cursor.rowcount > 0:
-                 conn.commit()
-                 return {'status': 'успех', 'message': 'Оценка успешно обновлена.'}
-             else:
-                 return {'status': 'ошибка', 'message': 'Оценка для этого студента/предмета не найдена.'}
-
-        elif command == 'delete_grade':
-             cursor.execute(
-                 'DELETE FROM Grades WHERE student_id = ? AND subject_id = ?',
-                 (payload['student_id'], payload['subject_id'])
-             )
-             if cursor.rowcount > 0:
-                 conn.commit()
-                 return {'status': 'успех', 'message': 'Оценка успешно удалена.'}
-             else:
-                 return {'status': 'ошибка', 'message': 'Оценка для этого студента/предмета не найдена.'}
-
-        elif command == 'get_student_average_grade':
-             # Расчет среднего балла студента по оценкам в таблице Grades
-             sql = """
-             SELECT s.full_name, AVG(g.grade) as calculated_average
-             FROM Students s
-             LEFT JOIN Grades g ON s.id = g.student_id
-             WHERE s.id = ? OR s.full_name = ?
-             GROUP BY s.id;
-             """
-             cursor.execute(sql, (payload.get('student_id'), payload.get('student_name')))
-             result = cursor.fetchone()
-             if result:
-                # Обработка случая, когда у студента нет оценок (функция AVG вернет NULL)
-                avg_grade = result['calculated_average'] if result['calculated_average'] is not None else 'Оценок пока нет'
-                return {'status': 'успех', 'data': {'полное_имя': result['full_name'], 'средний_балл': avg_grade}}
-             else:
-                return {'status': 'ошибка', 'message': 'Студент не найден.'}
-
-
-        elif command == 'get_subject_average_grade':
-             sql = """
-             SELECT sub.subject_name, AVG(g.grade) as average_grade_for_subject
-             FROM Subjects sub
-             LEFT JOIN Grades g ON sub.id = g.subject_id
-             WHERE sub.id = ? OR sub.subject_name = ?
-             GROUP BY sub.id;
-             """
-             cursor.execute(sql, (payload.get('subject_id'), payload.get('subject_name')))
-             result = cursor.fetchone()
-             if result:
-                 # Обработка случая, когда по предмету нет оценок (AVG вернет NULL)
-                 avg_grade = result['average_grade_for_subject'] if result['average_grade_for_subject'] is not None else 'Оценок пока нет'
-                 return {'status': 'успех', 'data': {'название_предмета': result['subject_name'], 'средний_балл': avg_grade}}
-             else:
-                 return {'status': 'ошибка', 'message': 'Предмет не найден.'}
-
-        elif command == 'get_students_below_avg':
+    def release(self, conn):
+        """Возвращает соединение в пул (незавершенная транзакция откатывается)."""
+        with self._lock:
+            self._in_use -= 1
+            taken_at = self._checkout_times.pop(id(conn), None)
+            if taken_at is not None:
+                self._hold_total += time.perf_counter() - taken_at
+        try:
+            if conn.in_transaction:
+                conn.rollback() # Не отдавать следующему запросу чужую транзакцию
+        except sqlite3.Error:
+            logging.warning("Соединение из пула повреждено и будет закрыто.")
+            self._discard(conn)
+            return
+        if self._closed:
+            self._discard(conn)
+        else:
+            self._idle.put(conn)
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._created -= 1
+
+    def close(self):
+        """Закрывает все свободные соединения; занятые закроются при возврате."""
+        self._closed = True
+        while True:
             try:
-                threshold = float(payload['threshold'])
-            except ValueError:
-                return {'status': 'ошибка', 'message': 'Недопустимое значение порога.'}
-
-            sql = """
-             SELECT s.full_name, s.group_name, s.course, AVG(g.grade) as calculated_average
-             FROM Students s
-             JOIN Grades g ON s.id = g.student_id
-             GROUP BY s.id
-             HAVING calculated_average < ?
-             ORDER BY calculated_average;
-             """
-            cursor.execute(sql, (threshold,))
-            results = [dict(row) for row in cursor.fetchall()]
-            return {'status': 'успех', 'data': results}
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+    def stats(self):
+        """Возвращает метрики пула."""
+        with self._lock:
+            checkouts = self._checkouts
+            return {
+                'размер': self.size,
+                'создано': self._created,
+                'занято': self._in_use,
+                'свободно': self._idle.qsize(),
+                'выдач': checkouts,
+                'таймаутов': self._timeouts,
+                'среднее_ожидание_мс': round(self._wait_total / checkouts * 1000, 3) if checkouts else 0.0,
+                'макс_ожидание_мс': round(self._wait_max * 1000, 3),
+                'среднее_удержание_мс': round(self._hold_total / checkouts * 1000, 3) if checkouts else 0.0,
+            }
+
+
+db_pool = None   # Глобальный пул для записи, создается в init_pool() или лениво при первом запросе
+read_pool = None # Пул соединений только для чтения (читающие команды, экспорт, explain)
+_pool_lock = threading.Lock()
+
+def init_pool(size=POOL_SIZE, timeout=POOL_TIMEOUT):
+    """Создает (или пересоздает) глобальные пулы соединений для записи и для чтения."""
+    global db_pool, read_pool
+    with _pool_lock:
+        for pool in (db_pool, read_pool):
+            if pool is not None:
+                pool.close()
+        db_pool = ConnectionPool(size, timeout)
+        read_pool = ConnectionPool(size, timeout, factory=get_read_connection)
+    logging.info(f"Пулы соединений (запись и чтение): до {size} соединений в каждом, ожидание до {timeout} с.")
+    return db_pool
+
+def get_db_pool():
+    """Возвращает глобальный пул соединений для записи, создавая его при необходимости."""
+    global db_pool
+    if db_pool is None:
+        with _pool_lock:
+            if db_pool is None:
+                db_pool = ConnectionPool()
+    return db_pool
+
+def get_read_pool():
+    """Возвращает глобальный пул соединений только для чтения, создавая его при необходимости."""
+    global read_pool
+    if read_pool is None:
+        with _pool_lock:
+            if read_pool is None:
+                read_pool = ConnectionPool(factory=get_read_connection)
+    return read_pool
+
+def close_pools():
+    """Закрывает оба пула соединений."""
+    for pool in (db_pool, read_pool):
+        if pool is not None:
+            pool.close()
+
+# --- Метрики ---
+# Задержки команд хранятся в гистограммах с логарифмически-линейными корзинами (как в HdrHistogram):
+# каждая степень двойки делится на HISTOGRAM_SUB_BUCKETS равных частей, поэтому относительная
+# погрешность квантилей не больше 1/HISTOGRAM_SUB_BUCKETS при любом масштабе - от микросекунд до минут,
+# а память не зависит от числа измерений. Метрики доступны командой stats и файлом в текстовом
+# формате Prometheus (--metrics-file).
+
+HISTOGRAM_SUB_BUCKETS = 32          # Корзин на каждую степень двойки (само число - тоже степень двойки)
+REPORTED_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+METRICS_INTERVAL = 15.0             # Период записи файла метрик, с
+METRICS_PREFIX = 'studentdb'        # Префикс имен метрик Prometheus
+
+class LatencyHistogram:
+    """Гистограмма задержек с логарифмически-линейными корзинами. Значения - в микросекундах."""
+
+    _SUB_BITS = HISTOGRAM_SUB_BUCKETS.bit_length() - 1
+
+    def __init__(self):
+        self.counts = collections.Counter() # индекс корзины -> число измерений
+        self.count = 0
+        self.total = 0 # сумма, мкс
+        self.max = 0
+
+    @classmethod
+    def _index(cls, value):
+        if value < (2 << cls._SUB_BITS):
+            return value # Малые значения - точно, по корзине на микросекунду
+        # Старшие _SUB_BITS + 1 бит: top от HISTOGRAM_SUB_BUCKETS до 2 * HISTOGRAM_SUB_BUCKETS - 1,
+        # то есть HISTOGRAM_SUB_BUCKETS корзин шириной 2**shift на степень двойки
+        shift = value.bit_length() - cls._SUB_BITS - 1
+        return (shift << cls._SUB_BITS) + (value >> shift)
+
+    @classmethod
+    def _upper_bound(cls, index):
+        """Наибольшее значение, попадающее в корзину."""
+        if index < (2 << cls._SUB_BITS):
+            return index
+        shift = (index >> cls._SUB_BITS) - 1
+        top = index - (shift << cls._SUB_BITS)
+        return ((top + 1) << shift) - 1
+
+    def record(self, seconds):
+        value = int(seconds * 1_000_000)
+        self.counts[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Значение квантиля q (0..1) в микросекундах - верхняя граница корзины, не больше максимума."""
+        if not self.count:
+            return 0
+        rank = max(1, int(q * self.count + 0.5))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self._upper_bound(index), self.max)
+        return self.max
+
+
+class ServerMetrics:
+    """Метрики сервера: гистограммы задержек по командам, счетчики и число активных соединений."""
+
+    COUNTERS = ('db_errors', 'json_errors', 'bytes_in', 'bytes_out', 'connections', 'rejected_connections')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {} # команда -> LatencyHistogram
+        self._errors = collections.Counter() # команда -> неуспешных ответов
+        self._counters = dict.fromkeys(self.COUNTERS, 0)
+        self.active_connections = 0
+        self.started = time.time()
+        self.labels = {} # Метки, общие для всех рядов Prometheus
+
+    def observe(self, command, seconds, ok):
+        """Учитывает выполнение команды."""
+        with self._lock:
+            histogram = self._histograms.get(command)
+            if histogram is None:
+                histogram = self._histograms[command] = LatencyHistogram()
+            histogram.record(seconds)
+            if not ok:
+                self._errors[command] += 1
+
+    def add(self, counter, amount=1):
+        with self._lock:
+            self._counters[counter] += amount
+
+    def connection_opened(self):
+        with self._lock:
+            self._counters['connections'] += 1
+            self.active_connections += 1
+
+    def connection_closed(self):
+        with self._lock:
+            self.active_connections -= 1
+
+    def clear(self):
+        """Сбрасывает гистограммы и счетчики (число активных соединений сохраняется)."""
+        with self._lock:
+            self._histograms.clear()
+            self._errors.clear()
+            self._counters = dict.fromkeys(self.COUNTERS, 0)
+            self.started = time.time()
+
+    def command_stats(self):
+        """Сводка по командам: вызовы, ошибки, среднее, квантили и максимум в миллисекундах."""
+        with self._lock:
+            report = {}
+            for command, histogram in sorted(self._histograms.items()):
+                entry = {
+                    'вызовов': histogram.count,
+                    'ошибок': self._errors[command],
+                    'среднее_мс': round(histogram.total / histogram.count / 1000, 3),
+                }
+                for q in REPORTED_QUANTILES:
+                    entry[f'p{q * 100:g}_мс'] = round(histogram.quantile(q) / 1000, 3)
+                entry['макс_мс'] = round(histogram.max / 1000, 3)
+                report[command] = entry
+            return report
+
+    def snapshot(self):
+        """Все метрики одним словарем (ответ команды stats)."""
+        commands = self.command_stats()
+        with self._lock:
+            counters = dict(self._counters)
+            active = self.active_connections
+            uptime = time.time() - self.started
+        return {'время_работы_с': round(uptime, 1), 'активных_соединений': active,
+                'счетчики': counters, 'команды': commands}
+
+    def prometheus_text(self):
+        """Метрики в текстовом формате Prometheus (задержки - как summary с квантилями).
+
+        self.labels добавляются ко всем рядам (например, номер процесса в режиме prefork).
+        """
+        p = METRICS_PREFIX
+        def series(name, **labels):
+            labels = dict(self.labels, **labels)
+            if not labels:
+                return f'{p}_{name}'
+            return f'{p}_{name}{{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+        lines = []
+        with self._lock:
+            lines += [f'# HELP {p}_command_duration_seconds Время выполнения команды.',
+                      f'# TYPE {p}_command_duration_seconds summary']
+            for command, histogram in sorted(self._histograms.items()):
+                for q in REPORTED_QUANTILES:
+                    lines.append(f'{series("command_duration_seconds", command=command, quantile=q)} '
+                                 f'{histogram.quantile(q) / 1e6:.6f}')
+                lines.append(f'{series("command_duration_seconds_sum", command=command)} {histogram.total / 1e6:.6f}')
+                lines.append(f'{series("command_duration_seconds_count", command=command)} {histogram.count}')
+            lines += [f'# HELP {p}_command_errors_total Неуспешные ответы по командам.',
+                      f'# TYPE {p}_command_errors_total counter']
+            for command in sorted(self._histograms):
+                lines.append(f'{series("command_errors_total", command=command)} {self._errors[command]}')
+            for counter in self.COUNTERS:
+                lines += [f'# TYPE {p}_{counter}_total counter', f'{series(counter + "_total")} {self._counters[counter]}']
+            lines += [f'# TYPE {p}_active_connections gauge', f'{series("active_connections")} {self.active_connections}']
+        return '\n'.join(lines) + '\n'
+
+
+metrics = ServerMetrics()
+
+def write_metrics_file(path):
+    """Атомарно записывает метрики в файл (сборщик никогда не прочитает файл наполовину)."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(metrics.prometheus_text())
+    os.replace(tmp_path, path)
+
+def _metrics_writer_loop(stop_event, path, interval):
+    while not stop_event.wait(interval):
+        try:
+            write_metrics_file(path)
+        except OSError as e:
+            logging.warning(f"Не удалось записать файл метрик {path}: {e}")
+
+def start_metrics_writer(path, interval=METRICS_INTERVAL):
+    """Запускает фоновую запись метрик в файл. Возвращает событие для ее остановки."""
+    stop_event = threading.Event()
+    if not path or interval <= 0:
+        return stop_event
+    writer_thread = threading.Thread(target=_metrics_writer_loop, args=(stop_event, path, interval), daemon=True)
+    writer_thread.start()
+    logging.info(f"Метрики записываются в {path} каждые {interval} с.")
+    return stop_event
+
+# --- Кэш результатов ---
+# Ответы читающих команд кэшируются по ключу (команда, payload). Каждая запись помнит версии
+# таблиц, из которых она построена; пишущие команды после фиксации увеличивают версии своих
+# таблиц, и устаревшие записи перестают выдаваться, даже если их срок (TTL) еще не истек.
+
+# Таблицы, от которых зависит результат кэшируемой команды. Читающие команды реестра
+# добавляются сюда при регистрации (см. command()).
+CACHED_COMMANDS = {}
+
+# Таблицы, которые может изменить пишущая команда (с учетом каскадного удаления).
+# Агрегаты оценок считаются частью Grades. Команды реестра добавляются при регистрации.
+WRITE_COMMAND_TABLES = {
+    'import_students': ('Students',),
+    'import_subjects': ('Subjects',),
+    'import_grades': ('Student_Subjects', 'Grades'),
+}
+
+
+class ResultCache:
+    """LRU-кэш ответов с ограничением по сроку жизни и версиями таблиц для инвалидации."""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = collections.OrderedDict() # ключ -> (срок, версии таблиц, ответ)
+        self._versions = collections.defaultdict(int) # таблица -> номер версии
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expired = 0
+        self._stale = 0
+
+    @staticmethod
+    def make_key(command, payload):
+        return command, json.dumps(payload, sort_keys=True, ensure_ascii=False)
+
+    def versions(self, tables):
+        """Снимок версий таблиц; берется до выполнения запроса."""
+        with self._lock:
+            return tuple(self._versions[table] for table in tables)
+
+    def get(self, key, tables):
+        """Возвращает закэшированный ответ или None."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            expires_at, versions, response = entry
+            if expires_at < now:
+                self._expired += 1
+            elif versions != tuple(self._versions[table] for table in tables):
+                self._stale += 1 # Таблицы менялись после построения ответа
+            else:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return response
+            del self._entries[key]
+            self._misses += 1
+            return None
+
+    def put(self, key, versions, response):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, versions, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False) # Вытесняем давно не использованную запись
+                self._evictions += 1
+
+    def invalidate(self, tables):
+        """Увеличивает версии таблиц: все ответы, построенные по ним, становятся устаревшими."""
+        with self._lock:
+            for table in tables:
+                self._versions[table] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'записей': len(self._entries),
+                'максимум_записей': self.max_entries,
+                'ttl_с': self.ttl,
+                'попаданий': self._hits,
+                'промахов': self._misses,
+                'доля_попаданий': round(self._hits / lookups, 4) if lookups else 0.0,
+                'вытеснено': self._evictions,
+                'истекло': self._expired,
+                'устарело': self._stale,
+                'версии_таблиц': dict(self._versions),
+            }
+
+
+result_cache = ResultCache() # Глобальный кэш, параметры задаются в init_cache()
+
+def init_cache(max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+    """Пересоздает глобальный кэш результатов (max_entries=0 отключает кэш)."""
+    global result_cache
+    result_cache = ResultCache(max_entries, ttl)
+    logging.info(f"Кэш результатов: до {max_entries} записей, TTL {ttl} с.")
+    return result_cache
 
+# --- Журнал изменений ---
+# Каждая успешная пишущая команда добавляет событие в таблицу Change_Log в той же транзакции,
+# что и сами изменения: откат команды (в т.ч. внутри пакета) откатывает и событие, а номер
+# события seq отражает порядок фиксации. Подписчик (команда subscribe) получает события потоком
+# после заданного номера и может продолжить с последнего полученного после переподключения.
+# О фиксации подписчиков своего процесса будит ChangeNotifier; записи других процессов
+# (режим prefork) подписчик замечает, проверяя журнал раз в CHANGE_FEED_POLL_INTERVAL.
+
+def record_change(cursor, command, payload):
+    """Добавляет событие в журнал изменений (транзакцию не фиксирует)."""
+    cursor.execute(QUERIES['record_change'], (time.time(), command, json.dumps(payload, ensure_ascii=False)))
+    seq = cursor.lastrowid
+    if seq % CHANGE_LOG_TRIM_EVERY == 0:
+        cursor.execute(QUERIES['trim_changes'], (seq - CHANGE_LOG_RETENTION,))
+
+
+class ChangeNotifier:
+    """Будит подписчиков этого процесса после фиксации изменений."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._listeners = set() # Функции без аргументов (подписчики асинхронного режима)
+        self.version = 0
+        self.closed = False # Процесс останавливается: подписки завершаются
+
+    def notify(self):
+        with self._condition:
+            self.version += 1
+            self._condition.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+
+    def close(self):
+        """Завершает все подписки процесса (при плавной остановке)."""
+        with self._condition:
+            self.closed = True
+        self.notify()
+
+    def wait(self, version, timeout):
+        """Ждет уведомления новее version не дольше timeout секунд."""
+        with self._condition:
+            self._condition.wait_for(lambda: self.version != version, timeout)
+
+    def add_listener(self, listener):
+        with self._condition:
+            self._listeners.add(listener)
+
+    def remove_listener(self, listener):
+        with self._condition:
+            self._listeners.discard(listener)
+
+
+change_notifier = ChangeNotifier()
+
+
+class ChangeFeed:
+    """Бесконечный поток событий журнала изменений (ответ команды subscribe).
+
+    Итерация выдает пакеты событий {'seq', 'ts', 'command', 'payload'}; пустой пакет - сигнал
+    "соединение живо", если изменений не было дольше heartbeat секунд.
+    """
+
+    endless = True # Не собирается в один ответ (см. materialize_response)
+
+    def __init__(self, after_seq, heartbeat=CHANGE_FEED_HEARTBEAT):
+        self.after_seq = after_seq
+        self.heartbeat = heartbeat
+        self.closed = False
+
+    def poll(self):
+        """Читает события после after_seq, не дожидаясь новых."""
+        pool = get_read_pool()
+        conn = pool.acquire()
+        try:
+            rows = conn.execute(QUERIES['read_changes'], (self.after_seq, CHANGE_FEED_BATCH)).fetchall()
+        finally:
+            pool.release(conn)
+        events = [{'seq': seq, 'ts': ts, 'command': command, 'payload': json.loads(payload)}
+                  for seq, ts, command, payload in rows]
+        if events:
+            self.after_seq = events[-1]['seq']
+        return events
+
+    def __iter__(self):
+        last_sent = time.monotonic()
+        while not self.closed and not change_notifier.closed:
+            version = change_notifier.version # До чтения: фиксация во время poll() не потеряется
+            events = self.poll()
+            now = time.monotonic()
+            if events or now - last_sent >= self.heartbeat:
+                last_sent = now
+                yield events
+                continue
+            change_notifier.wait(version, min(CHANGE_FEED_POLL_INTERVAL, self.heartbeat - (now - last_sent)))
+
+    def close(self):
+        self.closed = True
+
+
+def subscribe(payload):
+    """Команда subscribe: превращает соединение в поток событий журнала изменений.
+
+    payload: after_seq - номер последнего полученного события (без него - только новые события),
+    heartbeat - период пустых пакетов, с. Если события после after_seq уже удалены из журнала,
+    возвращается ошибка с номером самого старого события: клиенту нужно заново прочитать данные.
+    """
+    try:
+        heartbeat = max(float(payload.get('heartbeat', CHANGE_FEED_HEARTBEAT)), 1.0)
+        after_seq = payload.get('after_seq')
+        after_seq = None if after_seq is None else int(after_seq)
+    except (TypeError, ValueError):
+        return {'status': 'ошибка', 'message': 'Недопустимое значение after_seq или heartbeat.'}
+    pool = get_read_pool()
+    conn = pool.acquire()
+    try:
+        oldest, latest = conn.execute(QUERIES['change_log_bounds']).fetchone()
+    finally:
+        pool.release(conn)
+    if after_seq is None:
+        after_seq = latest or 0
+    elif oldest is not None and after_seq < oldest - 1:
+        return {'status': 'ошибка', 'message': f'События до №{oldest - 1} включительно уже удалены из журнала.',
+                'data': {'oldest_seq': oldest, 'latest_seq': latest}}
+    return {'status': 'успех', 'after_seq': after_seq, 'latest_seq': latest or 0,
+            'stream': ChangeFeed(after_seq, heartbeat)}
+
+# --- Функции обработки запросов ---
+
+class RowSet:
+    """Результат выборки: имена столбцов и строки-кортежи.
+
+    Строки не превращаются в словари на сервере: при отправке в столбцовом формате имена
+    столбцов передаются один раз, а в обычном словари собираются только при кодировании.
+    """
+
+    __slots__ = ('columns', 'rows')
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+
+    @classmethod
+    def query(cls, cursor, sql, params=()):
+        """Выполняет запрос на отдельном курсоре без row_factory (строки - обычные кортежи)."""
+        plain = cursor.connection.cursor()
+        plain.row_factory = None
+        plain.execute(sql, params)
+        return cls([d[0] for d in plain.description], plain.fetchall())
+
+    def as_dicts(self):
+        return [dict(zip(self.columns, row)) for row in self.rows]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return RowSet(self.columns, self.rows[index])
+        return dict(zip(self.columns, self.rows[index]))
+
+    def __iter__(self):
+        return iter(self.as_dicts())
+
+    def __repr__(self):
+        return f'<{len(self.rows)} строк: {", ".join(self.columns)}>'
+
+
+# Тексты встроенных запросов. Хранятся в одном месте, чтобы команда explain могла
+# проверить план каждого из них, а sqlite3 переиспользовал подготовленные выражения.
+QUERIES = {
+    'add_student': 'INSERT INTO Students (full_name, age, group_name, course, average_grade) VALUES (?, ?, ?, ?, ?)',
+    'delete_student': 'DELETE FROM Students WHERE full_name = ?',
+    'list_students': 'SELECT id, full_name, age, group_name, course, average_grade FROM Students ORDER BY full_name',
+    'find_student': 'SELECT id, full_name, age, group_name, course, average_grade FROM Students WHERE full_name = ?',
+    'add_subject': 'INSERT INTO Subjects (subject_name, teacher) VALUES (?, ?)',
+    'assign_subject': 'INSERT INTO Student_Subjects (student_id, subject_id) VALUES (?, ?)',
+    'unassign_subject': 'DELETE FROM Student_Subjects WHERE student_id = ? AND subject_id = ?',
+    'list_students_subjects': """
+        SELECT s.full_name, sub.subject_name, sub.teacher
+        FROM Students s
+        JOIN Student_Subjects ss ON s.id = ss.student_id
+        JOIN Subjects sub ON ss.subject_id = sub.id
+        ORDER BY s.full_name, sub.subject_name;
+        """,
+    'find_students_by_subject': """
+        SELECT s.full_name, s.group_name, s.course
+        FROM Students s
+        JOIN Student_Subjects ss ON s.id = ss.student_id
+        JOIN Subjects sub ON ss.subject_id = sub.id
+        WHERE sub.id = ? OR sub.subject_name = ?
+        ORDER BY s.full_name;
+        """,
+    'find_subjects_by_student': """
+        SELECT sub.subject_name, sub.teacher
+        FROM Subjects sub
+        JOIN Student_Subjects ss ON sub.id = ss.subject_id
+        JOIN Students s ON ss.student_id = s.id
+        WHERE s.id = ? OR s.full_name = ?
+        ORDER BY sub.subject_name;
+        """,
+    'check_assignment': 'SELECT 1 FROM Student_Subjects WHERE student_id = ? AND subject_id = ?',
+    # Добавляем или обновляем оценку. Не INSERT OR REPLACE: замена удаляет строку без срабатывания
+    # триггера удаления, и агрегаты оценок посчитали бы старую оценку дважды
+    'add_grade': '''INSERT INTO Grades (student_id, subject_id, grade) VALUES (?, ?, ?)
+                    ON CONFLICT(student_id, subject_id) DO UPDATE SET grade = excluded.grade''',
+    'update_grade': 'UPDATE Grades SET grade = ? WHERE student_id = ? AND subject_id = ?',
+    'delete_grade': 'DELETE FROM Grades WHERE student_id = ? AND subject_id = ?',
+    # Средние баллы берутся из агрегатов, которые поддерживают триггеры на Grades (миграция 2)
+    'get_student_average_grade': """
+        SELECT s.full_name, st.avg_grade as calculated_average
+        FROM Students s
+        LEFT JOIN Student_Grade_Stats st ON st.student_id = s.id
+        WHERE s.id = ? OR s.full_name = ?;
+        """,
+    'get_subject_average_grade': """
+        SELECT sub.subject_name, st.avg_grade as average_grade_for_subject
+        FROM Subjects sub
+        LEFT JOIN Subject_Grade_Stats st ON st.subject_id = sub.id
+        WHERE sub.id = ? OR sub.subject_name = ?;
+        """,
+    'get_students_below_avg': """
+        SELECT s.full_name, s.group_name, s.course, st.avg_grade as calculated_average
+        FROM Student_Grade_Stats st
+        JOIN Students s ON s.id = st.student_id
+        WHERE st.avg_grade < ?
+        ORDER BY st.avg_grade;
+        """,
+    # Поиск по индексу Student_Search (миграция 3); rank - bm25 с весами столбцов, меньше = лучше
+    'search_students': """
+        SELECT s.id, s.full_name, s.age, s.group_name, s.course, s.average_grade, round(-fts.rank, 3) AS score
+        FROM Student_Search fts
+        JOIN Students s ON s.id = fts.rowid
+        WHERE Student_Search MATCH ?
+        ORDER BY fts.rank
+        LIMIT ?;
+        """,
+    'search_vocab': 'SELECT term FROM Student_Search_Vocab WHERE term >= ? AND term < ? AND length(term) BETWEEN ? AND ? LIMIT ?',
+    # Журнал изменений (миграция 4)
+    'record_change': 'INSERT INTO Change_Log (ts, command, payload) VALUES (?, ?, ?)',
+    'trim_changes': 'DELETE FROM Change_Log WHERE seq <= ?',
+    'read_changes': 'SELECT seq, ts, command, payload FROM Change_Log WHERE seq > ? ORDER BY seq LIMIT ?',
+    # min() и max() в одном SELECT читали бы всю таблицу; по отдельности - по одной строке индекса
+    'change_log_bounds': 'SELECT (SELECT min(seq) FROM Change_Log), (SELECT max(seq) FROM Change_Log)',
+}
+
+def explain_queries(cursor):
+    """Возвращает EXPLAIN QUERY PLAN для каждого встроенного запроса.
+
+    Шаги вида "SCAN <таблица>" без индекса выносятся в отдельный список 'полный_перебор',
+    чтобы регрессию (пропавший индекс, измененный запрос) было видно сразу. План зависит от
+    статистики ANALYZE: на почти пустых таблицах перебор бывает дешевле индекса.
+    """
+    all_queries = dict(QUERIES)
+    all_queries.update((name, spec['sql'].format(conflict='')) for name, spec in IMPORT_SPECS.items())
+    all_queries.update(EXPORT_QUERIES)
+    report = []
+    for name, sql in all_queries.items():
+        numbered = [int(n) for n in re.findall(r'\?(\d+)', sql)]
+        params = [None] * (max(numbered) if numbered else sql.count('?'))
+        plan = [row['detail'] for row in cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+        full_scans = [step for step in plan
+                      if step.startswith('SCAN ') and ' USING ' not in step and step != 'SCAN CONSTANT ROW'
+                      and ' VIRTUAL TABLE ' not in step] # Поиск FTS5 идет по своему индексу
+        if name.startswith('export_'):
+            full_scans = [] # Экспорт читает таблицу целиком по определению
+        report.append({'запрос': name, 'план': plan, 'полный_перебор': full_scans})
+    return report
+
+# Параметры постраничного list_students
+STUDENT_COLUMNS = ('id', 'full_name', 'age', 'group_name', 'course', 'average_grade')
+LIST_STUDENTS_OPTIONS = ('limit', 'after_name', 'after_id', 'fields', 'group_name', 'course',
+                         'min_average_grade', 'max_average_grade')
+
+def list_students_page(cursor, payload):
+    """Страница списка студентов с фильтрами, выбором столбцов и курсором по ключу.
+
+    Сортировка по (full_name, id); следующая страница начинается строго после курсора
+    {'after_name', 'after_id'}, поэтому стоимость страницы не зависит от ее номера (в отличие от OFFSET).
+    """
+    fields = payload.get('fields') or list(STUDENT_COLUMNS)
+    unknown = [name for name in fields if name not in STUDENT_COLUMNS]
+    if unknown:
+        return {'status': 'ошибка', 'message': f'Неизвестные столбцы: {", ".join(map(str, unknown))}'}
+    try:
+        limit = min(int(payload.get('limit', MAX_PAGE_SIZE)), MAX_PAGE_SIZE)
+    except (TypeError, ValueError):
+        return {'status': 'ошибка', 'message': 'Недопустимое значение limit.'}
+    if limit <= 0:
+        return {'status': 'ошибка', 'message': 'limit должен быть положительным.'}
+
+    conditions = []
+    params = []
+    for key, condition in (('group_name', 'group_name = ?'), ('course', 'course = ?'),
+                           ('min_average_grade', 'average_grade >= ?'), ('max_average_grade', 'average_grade <= ?')):
+        if payload.get(key) is not None:
+            conditions.append(condition)
+            params.append(payload[key])
+    if payload.get('after_name') is not None:
+        if payload.get('after_id') is not None:
+            conditions.append('(full_name, id) > (?, ?)')
+            params.extend((payload['after_name'], payload['after_id']))
+        else:
+            conditions.append('full_name > ?') # full_name уникален, id нужен только для однозначности
+            params.append(payload['after_name'])
+
+    # id и full_name нужны для курсора, даже если клиент их не запрашивал: выбираются последними
+    fields = list(dict.fromkeys(fields))
+    selected = fields + [name for name in ('full_name', 'id') if name not in fields]
+    sql = f"SELECT {', '.join(selected)} FROM Students"
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY full_name, id LIMIT ?'
+    params.append(limit + 1) # Лишняя строка показывает, есть ли следующая страница
+    page = RowSet.query(cursor, sql, params)
+    rows = page.rows
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = {'after_name': last[selected.index('full_name')], 'after_id': last[selected.index('id')]}
+    if len(selected) > len(fields):
+        rows = [row[:len(fields)] for row in rows]
+    return {'status': 'успех', 'data': RowSet(fields, rows), 'next_cursor': next_cursor}
+
+# --- Реестр команд ---
+# Каждая команда - функция handler(cursor, payload), зарегистрированная декоратором command().
+# Регистрация указывает, только ли читает команда и с какими таблицами работает: читающие команды
+# выполняются на соединении только для чтения без фиксации и кэшируются, пишущие после фиксации
+# сбрасывают кэш своих таблиц. Выбор команды - один поиск в словаре, поэтому новые команды не
+# удлиняют путь остальных. Тексты SQL лежат в QUERIES: одна и та же строка при каждом вызове
+# позволяет sqlite3 брать уже подготовленное выражение из кэша соединения (STATEMENT_CACHE_SIZE).
+
+CommandSpec = collections.namedtuple('CommandSpec', 'name handler read_only tables')
+
+COMMANDS = {} # имя команды -> CommandSpec
+
+def command(name, read_only=False, tables=()):
+    """Декоратор: регистрирует обработчик команды в COMMANDS.
+
+    tables - таблицы, которые команда читает (read_only=True) или может изменить.
+    """
+    def register(handler):
+        COMMANDS[name] = CommandSpec(name, handler, read_only, tuple(tables))
+        if read_only:
+            CACHED_COMMANDS[name] = tuple(tables)
         else:
-            return {'status': 'ошибка', 'message': 'Неизвестная команда'}
+            WRITE_COMMAND_TABLES[name] = tuple(tables)
+        return handler
+    return register
+
+def execute_command(cursor, command, payload):
+    """Выполняет одну команду на переданном курсоре.
+
+    Транзакцию не фиксирует: это делает вызывающий код (handle_request или execute_batch).
+    Успешная пишущая команда добавляет событие в журнал изменений. Ошибки БД и отсутствующие поля пробрасываются как исключения.
+    """
+    spec = COMMANDS.get(command)
+    if spec is None:
+        return {'status': 'ошибка', 'message': 'Неизвестная команда'}
+    response = spec.handler(cursor, payload)
+    if not spec.read_only and response.get('status') == 'успех':
+        record_change(cursor, command, payload)
+    return response
+
+@command('add_student', tables=('Students',))
+def add_student(cursor, payload):
+    cursor.execute(
+        QUERIES['add_student'],
+        (payload['full_name'], payload['age'], payload['group_name'], payload['course'], payload['average_grade'])
+    )
+    return {'status': 'успех', 'message': 'Студент успешно добавлен.'}
+
+@command('delete_student', tables=('Students', 'Student_Subjects', 'Grades')) # С учетом каскадного удаления
+def delete_student(cursor, payload):
+    cursor.execute(QUERIES['delete_student'], (payload['full_name'],))
+    if cursor.rowcount > 0:
+        return {'status': 'успех', 'message': f'Студент {payload["full_name"]} удален.'}
+    else:
+        return {'status': 'ошибка', 'message': f'Студент {payload["full_name"]} не найден.'}
+
+@command('update_student', tables=('Students',))
+def update_student(cursor, payload):
+    # Собираем поля для обновления
+    fields_to_update = []
+    values = []
+    for key, value in payload.items():
+        if key != 'full_name_to_update' and value is not None:
+            fields_to_update.append(f"{key} = ?")
+            values.append(value)
+
+    if not fields_to_update:
+         return {'status': 'ошибка', 'message': 'Не указаны поля для обновления.'}
+
+    values.append(payload['full_name_to_update']) # Добавляем имя студента в конец списка значений для условия WHERE
+    sql = f"UPDATE Students SET {', '.join(fields_to_update)} WHERE full_name = ?"
+    cursor.execute(sql, tuple(values))
+
+    if cursor.rowcount > 0: # Проверяем, была ли обновлена хотя бы одна строка
+        return {'status': 'успех', 'message': f'Студент {payload["full_name_to_update"]} обновлен.'}
+    else:
+        return {'status': 'ошибка', 'message': f'Студент {payload["full_name_to_update"]} не найден или изменения не были внесены.'}
+
+@command('list_students', read_only=True, tables=('Students',))
+def list_students(cursor, payload):
+    if not any(key in payload for key in LIST_STUDENTS_OPTIONS):
+        # Без параметров - прежнее поведение: весь список одним ответом
+        return {'status': 'успех', 'data': RowSet.query(cursor, QUERIES['list_students'])}
+    return list_students_page(cursor, payload)
+
+@command('find_student', read_only=True, tables=('Students',))
+def find_student(cursor, payload):
+    cursor.execute(QUERIES['find_student'], (payload['full_name'],))
+    student = cursor.fetchone()
+    if student:
+        return {'status': 'успех', 'data': dict(student)}
+    else:
+        return {'status': 'ошибка', 'message': f'Студент {payload["full_name"]} не найден.'}
+
+SEARCH_WORD = re.compile(r'\w+') # Так же режет текст токенизатор unicode61
+
+def fuzzy_terms(cursor, word):
+    """Слова словаря поискового индекса, похожие на word (опечатки, ё/е и т.п.).
+
+    Кандидаты - слова на ту же букву и близкой длины: диапазон по словарю FTS5 читается без перебора.
+    """
+    rows = cursor.execute(QUERIES['search_vocab'], (word[0], chr(ord(word[0]) + 1),
+                                                    len(word) - 2, len(word) + 2, SEARCH_FUZZY_CANDIDATES))
+    candidates = [row[0] for row in rows]
+    return difflib.get_close_matches(word, candidates, SEARCH_FUZZY_TERMS, SEARCH_FUZZY_CUTOFF)
+
+def search_match_expression(cursor, words, fuzzy):
+    """Собирает выражение MATCH: все слова запроса обязательны, каждое - как префикс.
+
+    В нечетком режиме к слову добавляются похожие слова словаря через OR.
+    Слова берутся в кавычки, поэтому синтаксис FTS5 во вводе пользователя не интерпретируется.
+    """
+    parts = []
+    for word in words:
+        variants = [f'"{word}"*']
+        if fuzzy:
+            variants += [f'"{term}"' for term in fuzzy_terms(cursor, word) if not term.startswith(word)]
+        parts.append(variants[0] if len(variants) == 1 else '(' + ' OR '.join(variants) + ')')
+    return ' '.join(parts)
+
+@command('search_students', read_only=True, tables=('Students', 'Subjects', 'Student_Subjects'))
+def search_students(cursor, payload):
+    """Поиск студентов по началу слов ФИО, группы, названий предметов и фамилий преподавателей.
+
+    payload: query, limit (по умолчанию SEARCH_LIMIT), fuzzy (истинное значение - всегда учитывать
+    опечатки, ложное - никогда, не задан или null - только если точный поиск ничего не нашел).
+    Результаты упорядочены по релевантности (score - чем больше, тем лучше).
+    """
+    words = SEARCH_WORD.findall(str(payload['query']).lower())
+    if not words:
+        return {'status': 'ошибка', 'message': 'Пустой поисковый запрос.'}
+    try:
+        limit = min(int(payload.get('limit', SEARCH_LIMIT)), MAX_PAGE_SIZE)
+    except (TypeError, ValueError):
+        return {'status': 'ошибка', 'message': 'Недопустимое значение limit.'}
+    if limit <= 0:
+        return {'status': 'ошибка', 'message': 'limit должен быть положительным.'}
+
+    auto_fuzzy = payload.get('fuzzy') is None # Не задан - нечеткий поиск только как запасной вариант
+    fuzzy = bool(payload.get('fuzzy'))
+    rows = RowSet.query(cursor, QUERIES['search_students'], (search_match_expression(cursor, words, fuzzy), limit))
+    if not rows and auto_fuzzy:
+        rows = RowSet.query(cursor, QUERIES['search_students'], (search_match_expression(cursor, words, True), limit))
+    return {'status': 'успех', 'data': rows}
+
+@command('add_subject', tables=('Subjects',))
+def add_subject(cursor, payload):
+    cursor.execute(
+        QUERIES['add_subject'],
+        (payload['subject_name'], payload['teacher'])
+    )
+    return {'status': 'успех', 'message': 'Предмет успешно добавлен.'}
+
+@command('assign_subject', tables=('Student_Subjects',))
+def assign_subject(cursor, payload):
+    try:
+        cursor.execute(QUERIES['assign_subject'],
+                       (payload['student_id'], payload['subject_id']))
+        return {'status': 'успех', 'message': 'Предмет успешно назначен.'}
+    except sqlite3.IntegrityError as e:
+         # Проверяем тип ошибки целостности
+         if 'FOREIGN KEY constraint failed' in str(e): # Ошибка внешнего ключа (несуществующий студент или предмет)
+             return {'status': 'ошибка', 'message': 'ID студента или ID предмета не найден.'}
+         elif 'UNIQUE constraint failed' in str(e): # Ошибка уникальности (попытка добавить существующую связь)
+             return {'status': 'ошибка', 'message': 'Этот предмет уже назначен этому студенту.'}
+         else:
+             raise # Перебросить другие (неожиданные) ошибки целостности
+
+@command('unassign_subject', tables=('Student_Subjects',))
+def unassign_subject(cursor, payload):
+    cursor.execute(QUERIES['unassign_subject'],
+                   (payload['student_id'], payload['subject_id']))
+    if cursor.rowcount > 0:
+        return {'status': 'успех', 'message': 'Предмет успешно отменен.'}
+    else:
+        return {'status': 'ошибка', 'message': 'Назначение не найдено (проверьте ID студента/предмета).'}
+
+@command('list_students_subjects', read_only=True, tables=('Students', 'Student_Subjects', 'Subjects'))
+def list_students_subjects(cursor, payload):
+    return {'status': 'успех', 'data': RowSet.query(cursor, QUERIES['list_students_subjects'])}
+
+@command('find_students_by_subject', read_only=True, tables=('Students', 'Student_Subjects', 'Subjects'))
+def find_students_by_subject(cursor, payload):
+    results = RowSet.query(cursor, QUERIES['find_students_by_subject'], (payload.get('subject_id'), payload.get('subject_name')))
+    return {'status': 'успех', 'data': results}
+
+@command('find_subjects_by_student', read_only=True, tables=('Students', 'Student_Subjects', 'Subjects'))
+def find_subjects_by_student(cursor, payload):
+    results = RowSet.query(cursor, QUERIES['find_subjects_by_student'], (payload.get('student_id'), payload.get('student_name')))
+    return {'status': 'успех', 'data': results}
+
+@command('add_grade', tables=('Grades',)) # Агрегаты оценок считаются частью Grades
+def add_grade(cursor, payload):
+    try:
+         # Проверим, изучает ли студент этот предмет
+         cursor.execute(QUERIES['check_assignment'],
+                        (payload['student_id'], payload['subject_id']))
+         if not cursor.fetchone(): # Если запрос ничего не вернул, значит студент не изучает этот предмет
+             return {'status': 'ошибка', 'message': 'Невозможно добавить оценку. Студент не назначен на этот предмет.'}
+
+         # Добавляем или обновляем оценку (если запись существует, оценка заменяется)
+         cursor.execute(
+             QUERIES['add_grade'],
+             (payload['student_id'], payload['subject_id'], payload['grade'])
+         )
+         return {'status': 'успех', 'message': 'Оценка успешно добавлена/обновлена.'}
+    except sqlite3.IntegrityError as e:
+         if 'FOREIGN KEY constraint failed' in str(e):
+              return {'status': 'ошибка', 'message': 'ID студента или ID предмета не найден.'}
+         else:
+              raise # Перебросить другие ошибки целостности
+
+@command('update_grade', tables=('Grades',))
+def update_grade(cursor, payload):
+    # Явное обновление оценки (в отличие от add_grade, не создаст запись, если ее нет)
+    cursor.execute(
+        QUERIES['update_grade'],
+        (payload['grade'], payload['student_id'], payload['subject_id'])
+    )
+    if cursor.rowcount > 0:
+        return {'status': 'успех', 'message': 'Оценка успешно обновлена.'}
+    else:
+        return {'status': 'ошибка', 'message': 'Оценка для этого студента/предмета не найдена.'}
+
+@command('delete_grade', tables=('Grades',))
+def delete_grade(cursor, payload):
+    cursor.execute(
+        QUERIES['delete_grade'],
+        (payload['student_id'], payload['subject_id'])
+    )
+    if cursor.rowcount > 0:
+        return {'status': 'успех', 'message': 'Оценка успешно удалена.'}
+    else:
+        return {'status': 'ошибка', 'message': 'Оценка для этого студента/предмета не найдена.'}
+
+@command('get_student_average_grade', read_only=True, tables=('Students', 'Grades'))
+def get_student_average_grade(cursor, payload):
+    # Средний балл студента берется из агрегатов Student_Grade_Stats (без пересчета AVG по Grades)
+    cursor.execute(QUERIES['get_student_average_grade'], (payload.get('student_id'), payload.get('student_name')))
+    result = cursor.fetchone()
+    if result:
+       # Обработка случая, когда у студента нет оценок (функция AVG вернет NULL)
+       avg_grade = result['calculated_average'] if result['calculated_average'] is not None else 'Оценок пока нет'
+       return {'status': 'успех', 'data': {'полное_имя': result['full_name'], 'средний_балл': avg_grade}}
+    else:
+       return {'status': 'ошибка', 'message': 'Студент не найден.'}
+
+@command('get_subject_average_grade', read_only=True, tables=('Subjects', 'Grades'))
+def get_subject_average_grade(cursor, payload):
+    cursor.execute(QUERIES['get_subject_average_grade'], (payload.get('subject_id'), payload.get('subject_name')))
+    result = cursor.fetchone()
+    if result:
+        # Обработка случая, когда по предмету нет оценок (AVG вернет NULL)
+        avg_grade = result['average_grade_for_subject'] if result['average_grade_for_subject'] is not None else 'Оценок пока нет'
+        return {'status': 'успех', 'data': {'название_предмета': result['subject_name'], 'средний_балл': avg_grade}}
+    else:
+        return {'status': 'ошибка', 'message': 'Предмет не найден.'}
+
+@command('get_students_below_avg', read_only=True, tables=('Students', 'Grades'))
+def get_students_below_avg(cursor, payload):
+    try:
+        threshold = float(payload['threshold'])
+    except ValueError:
+        return {'status': 'ошибка', 'message': 'Недопустимое значение порога.'}
+
+    return {'status': 'успех', 'data': RowSet.query(cursor, QUERIES['get_students_below_avg'], (threshold,))}
 
-    except sqlite3.Error as e:
+@command('rebuild_aggregates', tables=('Grades',))
+def rebuild_aggregates(cursor, payload):
+    # Служебная команда: пересчитать агрегаты оценок с нуля
+    for sql in AGGREGATE_REBUILD_SQL:
+        cursor.execute(sql)
+    return {'status': 'успех', 'message': 'Агрегаты оценок пересчитаны.'}
+
+@command('rebuild_search_index', tables=('Students', 'Subjects', 'Student_Subjects'))
+def rebuild_search_index(cursor, payload):
+    # Служебная команда: перестроить поисковый индекс с нуля (например, после правки БД в обход сервера)
+    for sql in SEARCH_REBUILD_SQL:
+        cursor.execute(sql)
+    return {'status': 'успех', 'message': 'Поисковый индекс перестроен.'}
+
+def error_response(e):
+    """Преобразует исключение при выполнении команды в ответ клиенту."""
+    if isinstance(e, sqlite3.Error):
+        metrics.add('db_errors')
         logging.error(f"Ошибка базы данных: {e}")
-        if conn:
-            conn.rollback() # Откатить транзакцию в случае ошибки БД
         return {'status': 'ошибка', 'message': f'Ошибка базы данных: {e}'}
-    except KeyError as e: # Если в payload отсутствует ожидаемый ключ
+    if isinstance(e, KeyError): # Если в payload отсутствует ожидаемый ключ
         logging.warning(f"Отсутствует ключ в данных: {e}")
         return {'status': 'ошибка', 'message': f'Отсутствует обязательное поле: {e}'}
-    except Exception as e:
-        logging.exception("Произошла непредвиденная ошибка") # Залогировать полную трассировку стека
-        return {'status': 'ошибка', 'message': f'Произошла непредвиденная ошибка сервера: {e}'}
-    finally:
-        if conn: # Убедиться, что соединение с БД всегда закрывается
-            conn.close()
+    if isinstance(e, PoolTimeoutError): # Все соединения заняты
+        logging.warning(f"Пул соединений исчерпан: {e}")
+        return {'status': 'ошибка', 'message': f'Сервер перегружен, повторите запрос позже: {e}'}
+    logging.error("Произошла непредвиденная ошибка", exc_info=e) # Залогировать полную трассировку стека
+    return {'status': 'ошибка', 'message': f'Произошла непредвиденная ошибка сервера: {e}'}
 
-# --- Сетевая часть ---
+def execute_batch(conn, payload):
+    """Выполняет пакет команд в одной транзакции на одном соединении.
 
-def handle_client(conn, addr):
-    """Обрабатывает соединение с одним клиентом."""
-    logging.info(f"Подключен {addr}")
+    payload: {'commands': [{'command': ..., 'payload': {...}}, ...], 'atomic': True}
+    atomic=True - "все или ничего": первая неудачная команда откатывает весь пакет.
+    atomic=False - "по возможности": неудачная команда откатывается до своей точки сохранения,
+    остальные фиксируются.
+    """
+    commands = payload['commands']
+    atomic = payload.get('atomic', True)
+    if not isinstance(commands, list) or not commands:
+        return {'status': 'ошибка', 'message': 'Пакет должен содержать непустой список команд.'}
+    if len(commands) > MAX_BATCH_SIZE:
+        return {'status': 'ошибка', 'message': f'Слишком много команд в пакете (максимум {MAX_BATCH_SIZE}).'}
+
+    cursor = conn.cursor()
+    cursor.execute("BEGIN")
+    results = []
+    succeeded = 0
+    touched_tables = set()
+    for index, item in enumerate(commands):
+        if not isinstance(item, dict) or item.get('command') == 'batch':
+            result = {'status': 'ошибка', 'message': 'Элемент пакета должен быть командой (вложенные пакеты запрещены).'}
+        else:
+            cursor.execute("SAVEPOINT batch_item")
+            try:
+                result = execute_command(cursor, item.get('command'), item.get('payload', {}))
+            except Exception as e:
+                result = error_response(e)
+            if result.get('status') == 'успех':
+                cursor.execute("RELEASE batch_item")
+            else:
+                # Откатываем только изменения этой команды
+                cursor.execute("ROLLBACK TO batch_item")
+                cursor.execute("RELEASE batch_item")
+        results.append(result)
+        if result.get('status') == 'успех':
+            succeeded += 1
+            touched_tables.update(WRITE_COMMAND_TABLES.get(item.get('command'), ()))
+        elif atomic:
+            conn.rollback()
+            return {'status': 'ошибка',
+                    'message': f'Команда №{index + 1} не выполнена, пакет отменен: {result.get("message")}',
+                    'data': results}
+    conn.commit()
+    result_cache.invalidate(touched_tables)
+    change_notifier.notify()
+    return {'status': 'успех', 'message': f'Выполнено команд: {succeeded} из {len(commands)}.', 'data': results}
+
+# --- Массовый импорт и экспорт ---
+# Импорт: строки CSV (первая строка - заголовок с именами столбцов) или JSONL (объект на строку)
+# читаются потоком и вставляются пачками через executemany в одной транзакции.
+# Экспорт: строки выбираются курсором пачками (fetchmany) и отправляются клиенту потоком,
+# таблица целиком в память не загружается.
+
+IMPORT_SPECS = {
+    'import_students': {
+        'columns': ('full_name', 'age', 'group_name', 'course', 'average_grade'),
+        'required': ('full_name',),
+        'sql': 'INSERT {conflict} INTO Students (full_name, age, group_name, course, average_grade) VALUES (?, ?, ?, ?, ?)',
+        'upsert': ' ON CONFLICT(full_name) DO UPDATE SET age = excluded.age, group_name = excluded.group_name,'
+                  ' course = excluded.course, average_grade = excluded.average_grade',
+    },
+    'import_subjects': {
+        'columns': ('subject_name', 'teacher'),
+        'required': ('subject_name',),
+        'sql': 'INSERT {conflict} INTO Subjects (subject_name, teacher) VALUES (?, ?)',
+        'upsert': ' ON CONFLICT(subject_name) DO UPDATE SET teacher = excluded.teacher',
+    },
+    'import_grades': {
+        'columns': ('student_id', 'subject_id', 'grade'),
+        'required': ('student_id', 'subject_id', 'grade'),
+        # Как и add_grade: оценка ставится только по назначенному студенту предмету
+        'sql': 'INSERT {conflict} INTO Grades (student_id, subject_id, grade) SELECT ?1, ?2, ?3'
+               ' WHERE EXISTS (SELECT 1 FROM Student_Subjects WHERE student_id = ?1 AND subject_id = ?2)',
+        'upsert': ' ON CONFLICT(student_id, subject_id) DO UPDATE SET grade = excluded.grade',
+        'assign_sql': 'INSERT OR IGNORE INTO Student_Subjects (student_id, subject_id) VALUES (?, ?)',
+    },
+}
+
+EXPORT_QUERIES = {
+    'export_students': 'SELECT id, full_name, age, group_name, course, average_grade FROM Students ORDER BY id',
+    'export_subjects': 'SELECT id, subject_name, teacher FROM Subjects ORDER BY id',
+    'export_student_subjects': 'SELECT student_id, subject_id FROM Student_Subjects ORDER BY student_id, subject_id',
+    'export_grades': 'SELECT student_id, subject_id, grade FROM Grades ORDER BY student_id, subject_id',
+}
+
+def iter_text_lines(chunks):
+    """Собирает строки текста (с символом перевода строки) из потока байтовых кусков UTF-8."""
+    decoder = codecs.getincrementaldecoder('utf-8-sig')() # -sig: BOM из Excel отбрасывается
+    tail = ''
+    for chunk in chunks:
+        parts = (tail + decoder.decode(chunk)).split('\n')
+        tail = parts.pop() # Последняя строка может продолжиться в следующем куске
+        for part in parts:
+            yield part + '\n'
+    tail += decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+def iter_import_rows(lines, fmt, columns, required):
+    """Превращает строки CSV/JSONL в кортежи значений столбцов columns."""
+    if fmt == 'csv':
+        reader = csv.reader(lines)
+        header = next(reader, None)
+        if header is None:
+            return
+        header = [name.strip() for name in header]
+        missing = [name for name in required if name not in header]
+        if missing:
+            raise ValueError(f"В заголовке CSV нет обязательных столбцов: {', '.join(missing)}")
+        positions = [header.index(name) if name in header else None for name in columns]
+        for line_no, record in enumerate(reader, start=2):
+            if not record:
+                continue # Пустые строки пропускаем
+            row = tuple((record[i].strip() or None) if i is not None and i < len(record) else None for i in positions)
+            if any(row[columns.index(name)] is None for name in required):
+                raise ValueError(f"Строка {line_no}: не заполнено обязательное поле.")
+            yield row
+    elif fmt == 'jsonl':
+        for line_no, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Строка {line_no}: неверный JSON ({e.msg}).")
+            row = tuple(record.get(name) for name in columns)
+            if any(record.get(name) is None for name in required):
+                raise ValueError(f"Строка {line_no}: не заполнено обязательное поле.")
+            yield row
+    else:
+        raise ValueError(f"Неизвестный формат импорта: {fmt} (ожидается csv или jsonl)")
+
+def import_rows(conn, command, payload, chunks):
+    """Загружает строки из потока chunks в таблицу пачками executemany в одной транзакции.
+
+    payload: format ('csv' | 'jsonl'), on_conflict ('abort' | 'ignore' | 'update'),
+    для import_grades также assign (назначить предмет, если он еще не назначен).
+    Без потока данные берутся из payload['data'] (текст целиком).
+    """
+    spec = IMPORT_SPECS[command]
+    fmt = payload.get('format', 'csv')
+    on_conflict = payload.get('on_conflict', 'abort')
+    if on_conflict not in ('abort', 'ignore', 'update'):
+        return {'status': 'ошибка', 'message': f'Неизвестный режим on_conflict: {on_conflict}'}
+    if chunks is None:
+        chunks = [payload['data'].encode('utf-8')]
+    sql = spec['sql'].format(conflict='OR IGNORE' if on_conflict == 'ignore' else '')
+    if on_conflict == 'update':
+        sql += spec['upsert']
+    assign_sql = spec.get('assign_sql') if payload.get('assign') else None
+
+    rows = iter_import_rows(iter_text_lines(chunks), fmt, spec['columns'], spec['required'])
+    cursor = conn.cursor()
+    cursor.execute("BEGIN")
+    total = 0
+    changed = 0
+    started = time.perf_counter()
+    while True:
+        batch = list(itertools.islice(rows, IMPORT_BATCH_ROWS))
+        if not batch:
+            break
+        if assign_sql:
+            cursor.executemany(assign_sql, [row[:2] for row in batch])
+        cursor.executemany(sql, batch)
+        total += len(batch)
+        changed += cursor.rowcount
+    # Строки импорта в журнал не попадают: подписчику достаточно знать, что таблица менялась
+    record_change(cursor, command, {'format': fmt, 'on_conflict': on_conflict, 'строк': total, 'изменено': changed})
+    conn.commit()
+    change_notifier.notify()
+    elapsed = time.perf_counter() - started
+    logging.info(f"{command}: обработано {total} строк, изменено {changed} за {elapsed:.2f} с")
+    return {'status': 'успех', 'message': f'Импортировано строк: {changed} из {total} (пропущено: {total - changed}).',
+            'data': {'строк': total, 'изменено': changed, 'пропущено': total - changed, 'секунд': round(elapsed, 3)}}
+
+def iter_export_batches(sql):
+    """Генератор пачек строк для потоковой выдачи. Соединение берется из пула только на время выдачи."""
+    pool = get_read_pool()
+    conn = pool.acquire()
     try:
+        cursor = conn.cursor()
+        cursor.row_factory = None # Строки сразу кортежами, без sqlite3.Row
+        cursor.execute(sql)
         while True:
-            # Получаем данные от клиента (до 4096 байт)
-            data = conn.recv(4096)
-            if not data: # Если recv вернул пустые байты, клиент закрыл соединение
-                logging.info(f"Клиент {addr} отключился штатно.")
-                break # Выход из цикла обработки этого клиента
+            rows = cursor.fetchmany(STREAM_BATCH_ROWS)
+            if not rows:
+                break
+            yield rows
+    finally:
+        pool.release(conn)
+
+def export_rows(command):
+    """Готовит потоковый ответ экспорта: столбцы в заголовке, строки - пачками массивов."""
+    sql = EXPORT_QUERIES[command]
+    pool = get_read_pool()
+    conn = pool.acquire()
+    try:
+        # Имена столбцов берем из описания запроса, не выполняя его целиком
+        columns = [d[0] for d in conn.execute(sql + ' LIMIT 0').description]
+    finally:
+        pool.release(conn)
+    return {'status': 'успех', 'columns': columns, 'stream': iter_export_batches(sql)}
 
+# --- Резервное копирование ---
+# Снимок снимается sqlite3.Connection.backup по BACKUP_PAGES страниц за шаг с паузой между шагами:
+# блокировка чтения держится только на время шага, и сервер продолжает принимать запись.
+# Если БД меняется через другое соединение, SQLite начинает копирование заново - при постоянной
+# записи оно могло бы не закончиться никогда, поэтому после BACKUP_MAX_RESTARTS перезапусков
+# вся БД копируется заново за один шаг (в режиме WAL писатели при этом не ждут).
+# Копия пишется во временный файл .part и переименовывается только после проверки целостности.
+# Восстановление - при запуске сервера: python server.py --restore <снимок>.
+
+class BackupRestartLimit(Exception):
+    """Пошаговое копирование прервано: слишком много перезапусков из-за записи в БД."""
+
+
+class BackupJob:
+    """Фоновое снятие одного снимка БД; состояние доступно командой backup_status."""
+
+    def __init__(self, path, pages=BACKUP_PAGES, pause=BACKUP_PAUSE):
+        self.path = path
+        self.pages = pages
+        self.pause = pause
+        self.state = 'выполняется'
+        self.error = None
+        self.total_pages = 0
+        self.remaining = None
+        self.restarts = 0
+        self.started = time.time()
+        self.finished = None
+        self.done = threading.Event()
+
+    def _progress(self, status, remaining, total):
+        if self.remaining is not None and remaining > self.remaining:
+            self.restarts += 1 # Источник изменился, SQLite начал заново
+            logging.info(f"Резервная копия: БД изменилась, копирование начато заново ({self.restarts})")
+        self.remaining, self.total_pages = remaining, total
+        if remaining and self.pause:
+            time.sleep(self.pause)
+        if self.restarts >= BACKUP_MAX_RESTARTS:
+            raise BackupRestartLimit()
+
+    def run(self):
+        part = self.path + '.part'
+        try:
+            source = get_db_connection(read_only=True)
             try:
-                # Декодируем (UTF-8 по умолчанию) и парсим JSON запрос
-                request = json.loads(data.decode('utf-8'))
-                logging.info(f"Получено от {addr}: {request}")
+                if os.path.exists(part):
+                    os.remove(part)
+                target = sqlite3.connect(part)
+                try:
+                    try:
+                        source.backup(target, pages=self.pages, progress=self._progress)
+                    except BackupRestartLimit:
+                        logging.warning("Резервная копия: БД постоянно меняется, вся БД копируется заново за один шаг.")
+                        source.backup(target)
+                    target.execute("PRAGMA journal_mode = DELETE;") # Снимок - один файл, без -wal рядом
+                    check = target.execute("PRAGMA quick_check;").fetchone()[0]
+                    if check != 'ok':
+                        raise sqlite3.DatabaseError(f"Копия не прошла проверку целостности: {check}")
+                finally:
+                    target.close()
+            finally:
+                source.close()
+            os.replace(part, self.path)
+            self.remaining = 0
+            self.state = 'готово'
+            logging.info(f"Резервная копия сохранена: {self.path} ({self.total_pages} страниц, "
+                         f"{time.time() - self.started:.2f} с, перезапусков {self.restarts})")
+        except Exception as e:
+            self.state = 'ошибка'
+            self.error = str(e)
+            logging.error(f"Ошибка резервного копирования в {self.path}: {e}")
+            if os.path.exists(part):
+                os.remove(part)
+        finally:
+            self.finished = time.time()
+            self.done.set()
+
+    def status(self):
+        copied = self.total_pages - (self.remaining or 0) if self.total_pages else 0
+        return {
+            'состояние': self.state,
+            'файл': self.path,
+            'страниц': self.total_pages,
+            'осталось_страниц': self.remaining,
+            'процент': round(100.0 * copied / self.total_pages, 1) if self.total_pages else 0.0,
+            'перезапусков': self.restarts,
+            'секунд': round((self.finished or time.time()) - self.started, 3),
+            'ошибка': self.error,
+        }
+
+
+backup_job = None # Последнее (или текущее) резервное копирование этого процесса
+backup_lock = threading.Lock()
+
+def start_backup(payload):
+    """Команда backup: запускает снятие снимка в фоне и сразу отвечает (wait=True - дождаться конца).
+
+    payload: name - имя файла в BACKUP_DIR (по умолчанию с датой и временем), pages, pause.
+    В режиме prefork состояние видно только в процессе, принявшем команду, поэтому там удобнее wait.
+    """
+    global backup_job
+    name = payload.get('name') or time.strftime('student_database-%Y%m%d-%H%M%S.db')
+    if os.path.basename(name) != name or name in ('.', '..'):
+        return {'status': 'ошибка', 'message': 'name - только имя файла, без каталогов.'}
+    try:
+        pages = int(payload.get('pages', BACKUP_PAGES))
+        pause = float(payload.get('pause', BACKUP_PAUSE))
+    except (TypeError, ValueError):
+        return {'status': 'ошибка', 'message': 'Недопустимое значение pages или pause.'}
+    with backup_lock:
+        if backup_job is not None and not backup_job.done.is_set():
+            return {'status': 'ошибка', 'message': 'Резервное копирование уже выполняется.', 'data': backup_job.status()}
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        backup_job = BackupJob(os.path.join(BACKUP_DIR, name), pages if pages > 0 else -1, max(pause, 0.0))
+        threading.Thread(target=backup_job.run, name='backup', daemon=True).start()
+    job = backup_job
+    if payload.get('wait'):
+        job.done.wait()
+        if job.state == 'ошибка':
+            return {'status': 'ошибка', 'message': f'Резервная копия не создана: {job.error}', 'data': job.status()}
+        return {'status': 'успех', 'message': f'Резервная копия сохранена: {job.path}', 'data': job.status()}
+    return {'status': 'успех', 'message': f'Резервное копирование запущено: {job.path}', 'data': job.status()}
+
+def restore_database(snapshot):
+    """Заменяет содержимое DATABASE снимком. Вызывается при запуске, до init_db() и пулов.
+
+    Копирование идет через backup API, поэтому старые файлы журнала (-wal) не мешают.
+    Снимок старой схемы доводится до текущей миграциями в init_db().
+    """
+    if not os.path.isfile(snapshot):
+        raise FileNotFoundError(f"Снимок не найден: {snapshot}")
+    source = sqlite3.connect(pathlib.Path(snapshot).absolute().as_uri() + '?mode=ro', uri=True)
+    try:
+        check = source.execute("PRAGMA quick_check;").fetchone()[0]
+        if check != 'ok':
+            raise sqlite3.DatabaseError(f"Снимок {snapshot} поврежден: {check}")
+        target = sqlite3.connect(DATABASE)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+    finally:
+        source.close()
+    logging.info(f"База данных {DATABASE} восстановлена из снимка {snapshot}")
+
+# Команды вне реестра: служебные и работающие с соединением целиком (пакет, импорт, экспорт)
+SPECIAL_COMMANDS = ('pool_stats', 'cache_stats', 'command_stats', 'stats', 'batch', 'explain', 'subscribe',
+                    'backup', 'backup_status') + tuple(IMPORT_SPECS) + tuple(EXPORT_QUERIES)
+
+def failure_response(conn, command, e):
+    """Откатывает незавершенную транзакцию и преобразует исключение в ответ."""
+    if conn is not None and conn.in_transaction:
+        conn.rollback() # Откатить транзакцию в случае ошибки
+    if isinstance(e, ValueError): # Ошибка в данных (например, при импорте)
+        logging.warning(f"Ошибка в данных запроса {command}: {e}")
+        return {'status': 'ошибка', 'message': f'Ошибка в данных: {e}'}
+    return error_response(e)
+
+def run_command(spec, payload):
+    """Выполняет команду из реестра.
+
+    Читающая команда: ответ из кэша или запрос на соединении только для чтения, без фиксации.
+    Пишущая: соединение для записи, фиксация при успехе и сброс кэша затронутых таблиц.
+    Сама команда и запись в журнал изменений - в execute_command, как и в пакетах.
+    """
+    cache = result_cache
+    if spec.read_only:
+        cache_key = cache.make_key(spec.name, payload)
+        cached = cache.get(cache_key, spec.tables)
+        if cached is not None:
+            return cached
+        cache_versions = cache.versions(spec.tables) # Снимок до запроса: запись, пересекшаяся с записью в БД, сразу устареет
+        pool = get_read_pool()
+    else:
+        pool = get_db_pool()
+    conn = None
+    try:
+        conn = pool.acquire() # Берем готовое соединение из пула вместо открытия нового
+        cursor = conn.cursor()
+        response = execute_command(cursor, spec.name, payload)
+        if response.get('status') != 'успех':
+            if conn.in_transaction:
+                conn.rollback()
+        elif spec.read_only:
+            cache.put(cache_key, cache_versions, response)
+        else:
+            conn.commit()
+            cache.invalidate(spec.tables) # Только после фиксации, иначе кэш заполнится старыми данными
+            change_notifier.notify()
+        return response
+    except Exception as e:
+        return failure_response(conn, spec.name, e)
+    finally:
+        if conn: # Убедиться, что соединение всегда возвращается в пул
+            pool.release(conn)
+
+def run_special_command(command, payload, stream):
+    """Выполняет команду вне реестра (см. SPECIAL_COMMANDS)."""
+    if command == 'pool_stats': # Метрики пулов соединений (соединение из пула не нужно)
+        return {'status': 'успех', 'data': {'запись': get_db_pool().stats(), 'чтение': get_read_pool().stats()}}
+    if command == 'cache_stats': # Статистика кэша результатов
+        if payload.get('clear'):
+            result_cache.clear()
+        return {'status': 'успех', 'data': result_cache.stats()}
+    if command == 'command_stats': # Время выполнения по командам
+        return {'status': 'успех', 'data': metrics.command_stats()}
+    if command == 'stats': # Все метрики сервера, включая пулы и кэш
+        if payload.get('clear'):
+            metrics.clear()
+        data = metrics.snapshot()
+        data['пулы'] = {'запись': get_db_pool().stats(), 'чтение': get_read_pool().stats()}
+        data['кэш'] = result_cache.stats()
+        return {'status': 'успех', 'data': data}
+    if command == 'backup': # Снимок БД в фоне
+        return start_backup(payload)
+    if command == 'backup_status':
+        if backup_job is None:
+            return {'status': 'ошибка', 'message': 'Резервное копирование не запускалось.'}
+        return {'status': 'успех', 'data': backup_job.status()}
+    if command == 'subscribe': # Поток событий журнала изменений
+        try:
+            return subscribe(payload)
+        except Exception as e:
+            return failure_response(None, command, e)
+
+    pool = get_read_pool() if command == 'explain' else get_db_pool()
+    conn = None
+    try:
+        if command in EXPORT_QUERIES:
+            return export_rows(command)
+        conn = pool.acquire()
+        if command == 'batch':
+            return execute_batch(conn, payload)
+        if command in IMPORT_SPECS:
+            response = import_rows(conn, command, payload, stream)
+            result_cache.invalidate(WRITE_COMMAND_TABLES[command])
+            return response
+        if command == 'explain': # Планы выполнения встроенных запросов
+            return {'status': 'успех', 'data': explain_queries(conn.cursor())}
+        return {'status': 'ошибка', 'message': 'Неизвестная команда'}
+    except Exception as e:
+        return failure_response(conn, command, e)
+    finally:
+        if conn:
+            pool.release(conn)
+
+def handle_request(data, stream=None):
+    """Обрабатывает запрос от клиента и вызывает соответствующую функцию БД.
+
+    stream - итератор кусков данных, переданных клиентом вслед за запросом (для импорта).
+    Ответ может содержать 'stream' - итератор пачек строк, который отправляется клиенту потоком.
+    Для потоковых ответов учитывается время до начала выдачи, а не вся передача.
+    """
+    command = data.get('command')
+    payload = data.get('payload', {})
+    if not isinstance(command, str):
+        return {'status': 'ошибка', 'message': 'Неизвестная команда'}
+    start = time.perf_counter()
+    response = None
+    try:
+        spec = COMMANDS.get(command) # Основной путь - один поиск в реестре
+        if spec is not None:
+            response = run_command(spec, payload)
+        elif command in SPECIAL_COMMANDS:
+            response = run_special_command(command, payload, stream)
+        else:
+            return {'status': 'ошибка', 'message': 'Неизвестная команда'} # Неизвестные имена не попадают в статистику
+        return response
+    finally:
+        if response is not None:
+            metrics.observe(command, time.perf_counter() - start, response.get('status') == 'успех')
+
+# --- Протокол обмена ---
+# Кадр: заголовок FRAME_HEADER (магия, версия, тип, длина тела) + тело (JSON в UTF-8).
+# Старые клиенты шлют "голый" JSON без заголовка: сервер различает их по первому байту
+# (JSON не может начинаться с PROTOCOL_MAGIC) и отвечает им по-старому.
+# Большие списки 'data' передаются потоком: кадр FRAME_RESPONSE с 'stream': True,
+# затем кадры FRAME_CHUNK (JSON-массивы по STREAM_BATCH_ROWS строк) и завершающий FRAME_END.
+
+# Формат тел кадров ответа согласуется кадром FRAME_HELLO в начале соединения:
+# клиент присылает {'codecs': [...по предпочтению], 'columnar': true/false}, сервер отвечает
+# {'codec': выбранный, 'columnar': ...}. Без FRAME_HELLO - JSON и строки-словари, как раньше.
+# Запросы клиента всегда в JSON: они маленькие, а объем создают ответы. В столбцовом режиме
+# список 'data' из выборки передается как 'columns' (один раз) + 'data' (массивы значений).
+# orjson - не отдельный формат, а быстрая реализация того же JSON: используется, если установлен.
+
+Codec = collections.namedtuple('Codec', 'name dumps loads')
+
+def _encode_default(obj):
+    """Сериализация объектов, которых не знают кодеки (вложенные выборки - списком словарей)."""
+    if isinstance(obj, RowSet):
+        return obj.as_dicts()
+    raise TypeError(f"Тип {type(obj).__name__} не сериализуется")
+
+if orjson is not None:
+    JSON_CODEC = Codec('json', lambda obj: orjson.dumps(obj, default=_encode_default), orjson.loads)
+else:
+    JSON_CODEC = Codec('json', lambda obj: json.dumps(obj, default=_encode_default).encode('utf-8'),
+                       lambda body: json.loads(body.decode('utf-8')))
+
+CODECS = {'json': JSON_CODEC} # Доступные форматы ответа
+if msgpack is not None:
+    CODECS['msgpack'] = Codec('msgpack', lambda obj: msgpack.packb(obj, default=_encode_default, use_bin_type=True),
+                              lambda body: msgpack.unpackb(body, raw=False))
+
+def negotiate_codec(body):
+    """Разбирает FRAME_HELLO клиента. Возвращает (кодек, столбцовый режим, тело ответа)."""
+    try:
+        hello = json.loads(body.decode('utf-8'))
+        offered = hello.get('codecs') or ['json']
+        columnar = bool(hello.get('columnar'))
+    except (UnicodeDecodeError, ValueError, AttributeError):
+        offered, columnar = ['json'], False
+    codec = next((CODECS[name] for name in offered if name in CODECS), JSON_CODEC)
+    reply = json.dumps({'codec': codec.name, 'columnar': columnar, 'codecs': list(CODECS)}).encode('utf-8')
+    return codec, columnar, reply
+
+def decode_request(body):
+    """Разбирает тело кадра запроса (JSON). Выбрасывает ValueError при неверных данных."""
+    return JSON_CODEC.loads(body) # orjson и json выбрасывают JSONDecodeError (подкласс ValueError)
+
+def encode_frame(frame_type, body=b''):
+    """Собирает кадр протокола из типа и тела."""
+    return FRAME_HEADER.pack(PROTOCOL_MAGIC, PROTOCOL_VERSION, frame_type, len(body)) + body
+
+def recv_exact(conn, size):
+    """Читает ровно size байт. Возвращает b'', если соединение закрыто до начала чтения."""
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(min(65536, size - len(data)))
+        metrics.add('bytes_in', len(chunk))
+        if not chunk:
+            if not data:
+                return b''
+            raise ConnectionError("Соединение закрыто посреди кадра.")
+        data += chunk
+    return data
+
+def send_all(conn, data):
+    """Отправляет данные клиенту целиком с учетом в метриках."""
+    conn.sendall(data)
+    metrics.add('bytes_out', len(data))
+
+def parse_frame_header(header):
+    """Разбирает заголовок кадра. Возвращает (тип, длина тела) или выбрасывает ValueError."""
+    magic, version, frame_type, length = FRAME_HEADER.unpack(header)
+    if magic != PROTOCOL_MAGIC:
+        raise ValueError("Неверная сигнатура кадра.")
+    if version != PROTOCOL_VERSION:
+        raise ValueError(f"Неподдерживаемая версия протокола: {version}")
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Слишком большой кадр: {length} байт")
+    return frame_type, length
+
+def read_frame(conn, prefix=b''):
+    """Читает один кадр (prefix - уже прочитанные байты заголовка). Возвращает (тип, тело) или None при отключении."""
+    header = prefix + recv_exact(conn, FRAME_HEADER.size - len(prefix))
+    if len(header) < FRAME_HEADER.size:
+        return None
+    frame_type, length = parse_frame_header(header)
+    body = recv_exact(conn, length) if length else b''
+    if len(body) < length:
+        raise ConnectionError("Соединение закрыто посреди кадра.")
+    return frame_type, body
+
+def iter_response_frames(response, codec=JSON_CODEC, columnar=False):
+    """Разбивает ответ на кадры; длинный список 'data' или поток 'stream' отправляются пакетами строк."""
+    dumps = codec.dumps
+    stream = response.get('stream')
+    if stream is not None:
+        head = dict(response, stream=True)
+        yield encode_frame(FRAME_RESPONSE, dumps(head))
+        for batch in stream:
+            yield encode_frame(FRAME_CHUNK, dumps(batch))
+        yield encode_frame(FRAME_END)
+        return
+    data = response.get('data')
+    if columnar and isinstance(data, RowSet):
+        response = dict(response, columns=data.columns, data=data.rows)
+        data = data.rows
+    if not isinstance(data, (list, RowSet)) or len(data) <= STREAM_BATCH_ROWS:
+        yield encode_frame(FRAME_RESPONSE, dumps(response))
+        return
+    head = {key: value for key, value in response.items() if key != 'data'}
+    head['stream'] = True
+    head['rows'] = len(data)
+    yield encode_frame(FRAME_RESPONSE, dumps(head))
+    for start in range(0, len(data), STREAM_BATCH_ROWS):
+        yield encode_frame(FRAME_CHUNK, dumps(data[start:start + STREAM_BATCH_ROWS]))
+    yield encode_frame(FRAME_END)
+
+def materialize_response(response):
+    """Собирает потоковый ответ в обычный список 'data' (для старых клиентов без кадров)."""
+    stream = response.get('stream')
+    if stream is None:
+        return response
+    if getattr(stream, 'endless', False): # Бесконечный поток в один ответ не собрать
+        close_response(response)
+        return {'status': 'ошибка', 'message': 'Команда доступна только в протоколе с кадрами.'}
+    response = {key: value for key, value in response.items() if key != 'stream'}
+    response['data'] = [row for batch in stream for row in batch]
+    return response
+
+def close_response(response):
+    """Освобождает ресурсы потокового ответа, если он не был дочитан (например, клиент отключился)."""
+    stream = response.get('stream')
+    if stream is not None and hasattr(stream, 'close'):
+        stream.close()
 
-                # Обрабатываем запрос
-                response = handle_request(request)
+def iter_request_chunks(conn):
+    """Читает куски данных, следующие за запросом с 'stream': True, до кадра FRAME_END."""
+    while True:
+        frame = read_frame(conn)
+        if frame is None:
+            raise ConnectionError("Клиент отключился посреди передачи данных.")
+        frame_type, body = frame
+        if frame_type == FRAME_END:
+            return
+        if frame_type != FRAME_CHUNK:
+            raise ValueError(f"Ожидался кадр с данными, получен тип {frame_type}")
+        yield body
 
-                # Отправляем JSON ответ клиенту (кодируем в UTF-8)
-                conn.sendall(json.dumps(response).encode('utf-8'))
-                logging.info(f"Отправлено {addr}: {response}")
+JSON_LITERALS = ('true', 'false', 'null')
+JSON_NUMBER_CHARS = frozenset('-+0123456789.eE')
 
-            except json.JSONDecodeError: # Если клиент прислал невалидный JSON
-                logging.error(f"От {addr} получен неверный JSON")
-                error_response = {'status': 'ошибка', 'message': 'Неверный формат JSON'}
-                conn.sendall(json.dumps(error_response).encode('utf-8'))
-            except Exception as e: # Обработка других ошибок при обработке запроса
-                 logging.exception(f"Ошибка обработки запроса от {addr}")
-                 error_response = {'status': 'ошибка', 'message': f'Ошибка обработки на сервере: {e}'}
-                 conn.sendall(json.dumps(error_response).encode('utf-8'))
+def is_incomplete_json(text, error):
+    """Может ли ошибка разбора означать, что запрос просто пришел не целиком.
 
+    Пакет может оборваться внутри строки, литерала (true/false/null) или числа; тогда хвост,
+    на котором остановился разбор, - начало допустимого значения, а не мусор.
+    """
+    if error.pos == len(text) or error.msg.startswith('Unterminated string'):
+        return True
+    tail = text[error.pos:]
+    return (any(literal.startswith(tail) for literal in JSON_LITERALS)
+            or all(char in JSON_NUMBER_CHARS for char in tail))
 
-    except ConnectionResetError: # Если клиент разорвал соединение неожиданно
+def split_legacy_requests(buffer):
+    """Выделяет из буфера старого клиента все полные JSON-запросы.
+
+    Возвращает (список запросов или ошибок JSONDecodeError, необработанный остаток буфера).
+    Размер остатка ограничивают вызывающие (LEGACY_BUFFER_LIMIT), поэтому поток мусора,
+    похожего на начало числа, тоже закончится ошибкой.
+    """
+    try:
+        text = buffer.decode('utf-8')
+    except UnicodeDecodeError:
+        return [], buffer # Многобайтовый символ разрезан между пакетами - ждем продолжения
+    decoder = json.JSONDecoder()
+    items = []
+    pos = 0
+    while True:
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+        if pos == len(text):
+            return items, b''
+        try:
+            request, pos = decoder.raw_decode(text, pos)
+            items.append(request)
+        except json.JSONDecodeError as e:
+            if is_incomplete_json(text, e):
+                return items, text[pos:].encode('utf-8') # Запрос пришел не целиком
+            items.append(e) # Мусор: сообщаем об ошибке и отбрасываем буфер
+            return items, b''
+
+# --- Журналирование ---
+# Запись в поток вывода выполняет отдельный поток QueueListener: обработчики запросов только
+# кладут записи в очередь и не ждут медленного терминала или файла. Содержимое запросов и ответов
+# пишется отдельным логгером PAYLOAD_LOGGER на уровне DEBUG: пока он выключен, запись не
+# форматируется вовсе, а включенная - прореживается (PAYLOAD_LOG_SAMPLE) и обрезается.
+
+payload_logger = logging.getLogger(PAYLOAD_LOGGER)
+payload_logger.setLevel(logging.WARNING) # Выключен, пока не вызван setup_logging(log_payloads=True)
+
+def setup_logging(level=logging.INFO, log_payloads=False, sample=PAYLOAD_LOG_SAMPLE, max_chars=PAYLOAD_LOG_MAX_CHARS):
+    """Переводит журнал на очередь с фоновым потоком записи. Возвращает запущенный QueueListener."""
+    global PAYLOAD_LOG_SAMPLE, PAYLOAD_LOG_MAX_CHARS
+    PAYLOAD_LOG_SAMPLE = sample
+    PAYLOAD_LOG_MAX_CHARS = max_chars
+    root = logging.getLogger()
+    root.setLevel(level)
+    log_queue = queue.SimpleQueue()
+    # Настроенные ранее обработчики (basicConfig) переезжают в фоновый поток
+    listener = logging.handlers.QueueListener(log_queue, *root.handlers, respect_handler_level=True)
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    payload_logger.setLevel(logging.DEBUG if log_payloads else logging.WARNING)
+    listener.start()
+    set_log_listener(listener)
+
+    def restart_after_fork():
+        # Поток записи не переживает fork: дочернему процессу (prefork) нужны своя очередь и свой поток
+        child_queue = queue.SimpleQueue()
+        for handler in root.handlers:
+            if isinstance(handler, logging.handlers.QueueHandler):
+                handler.queue = child_queue
+        child_listener = logging.handlers.QueueListener(child_queue, *listener.handlers, respect_handler_level=True)
+        child_listener.start()
+        set_log_listener(child_listener)
+
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=restart_after_fork)
+    return listener
+
+log_listener = None # Текущий поток записи журнала (в дочернем процессе - свой)
+
+def set_log_listener(listener):
+    global log_listener
+    log_listener = listener
+
+def summarize_payload(obj):
+    """Сокращает запрос/ответ для журнала, не форматируя длинные списки целиком."""
+    if not isinstance(obj, dict):
+        return obj
+    summary = dict(obj)
+    data = summary.get('data')
+    if isinstance(data, list) and len(data) > PAYLOAD_LOG_MAX_ROWS:
+        summary['data'] = data[:PAYLOAD_LOG_MAX_ROWS] + [f'... еще {len(data) - PAYLOAD_LOG_MAX_ROWS} строк']
+    if summary.get('stream') is not None and not isinstance(summary['stream'], bool):
+        summary['stream'] = '<поток>'
+    return summary
+
+def log_payloads(addr, request, response):
+    """Пишет запрос и ответ в журнал содержимого, если он включен и запрос попал в выборку."""
+    if not payload_logger.isEnabledFor(logging.DEBUG): # Самая частая ветка: ничего не форматируем
+        return
+    if PAYLOAD_LOG_SAMPLE < 1.0 and random.random() >= PAYLOAD_LOG_SAMPLE:
+        return
+    for label, obj in (('Получено от', request), ('Отправлено', response)):
+        text = str(summarize_payload(obj))
+        if len(text) > PAYLOAD_LOG_MAX_CHARS:
+            text = text[:PAYLOAD_LOG_MAX_CHARS] + f'... ({len(text)} символов)'
+        payload_logger.debug("%s %s: %s", label, addr, text)
+
+# --- Сетевая часть ---
+
+def invalid_json_response(addr):
+    """Ответ на невалидный JSON от клиента."""
+    metrics.add('json_errors')
+    logging.error(f"От {addr} получен неверный JSON")
+    return {'status': 'ошибка', 'message': 'Неверный формат JSON'}
+
+def process_request(request, addr, stream=None):
+    """Выполняет разобранный запрос. Всегда возвращает ответ-словарь.
+
+    Если за запросом следуют куски данных (stream), они дочитываются до конца, даже когда
+    обработчик их не использовал, - иначе следующий кадр соединения будет прочитан неверно.
+    """
+    try:
+        # Обрабатываем запрос
+        response = handle_request(request, stream)
+    except Exception as e: # Обработка других ошибок при обработке запроса
+        logging.exception(f"Ошибка обработки запроса от {addr}")
+        response = {'status': 'ошибка', 'message': f'Ошибка обработки на сервере: {e}'}
+    try:
+        log_payloads(addr, request, response)
+        return response
+    finally:
+        if stream is not None:
+            for _ in stream:
+                pass
+
+def _serve_framed(conn, addr, prefix):
+    """Цикл обработки клиента, использующего протокол с кадрами."""
+    codec, columnar = JSON_CODEC, False # До FRAME_HELLO - прежний формат
+    while True:
+        try:
+            frame = read_frame(conn, prefix)
+        except ValueError as e: # Нарушение протокола: отвечаем ошибкой и закрываем соединение
+            logging.error(f"Ошибка протокола от {addr}: {e}")
+            error_response = {'status': 'ошибка', 'message': f'Ошибка протокола: {e}'}
+            send_all(conn, encode_frame(FRAME_RESPONSE, codec.dumps(error_response)))
+            return
+        prefix = b''
+        if frame is None:
+            logging.info(f"Клиент {addr} отключился штатно.")
+            return
+        frame_type, body = frame
+        if frame_type == FRAME_HELLO:
+            codec, columnar, reply = negotiate_codec(body)
+            send_all(conn, encode_frame(FRAME_HELLO, reply))
+            continue
+        if frame_type != FRAME_REQUEST:
+            response = {'status': 'ошибка', 'message': f'Неожиданный тип кадра: {frame_type}'}
+        else:
+            try:
+                request = decode_request(body)
+            except ValueError: # Если клиент прислал невалидный JSON
+                response = invalid_json_response(addr)
+            else:
+                stream = iter_request_chunks(conn) if isinstance(request, dict) and request.get('stream') else None
+                response = process_request(request, addr, stream)
+        try:
+            for frame_bytes in iter_response_frames(response, codec, columnar):
+                send_all(conn, frame_bytes)
+        finally:
+            close_response(response)
+
+def _serve_legacy(conn, addr, buffer):
+    """Цикл обработки старого клиента (JSON без кадров, один ответ на запрос)."""
+    while True:
+        requests, buffer = split_legacy_requests(buffer)
+        # Запросы, пришедшие в одном пакете, обрабатываются по очереди, а не склеиваются
+        for request in requests:
+            if isinstance(request, json.JSONDecodeError): # Если клиент прислал невалидный JSON
+                response = invalid_json_response(addr)
+            else:
+                response = materialize_response(process_request(request, addr))
+            # Отправляем JSON ответ клиенту (кодируем в UTF-8)
+            send_all(conn, JSON_CODEC.dumps(response))
+        if len(buffer) > LEGACY_BUFFER_LIMIT:
+            error_response = {'status': 'ошибка', 'message': 'Слишком большой запрос'}
+            send_all(conn, json.dumps(error_response).encode('utf-8'))
+            return
+        data = conn.recv(4096)
+        metrics.add('bytes_in', len(data))
+        if not data: # Если recv вернул пустые байты, клиент закрыл соединение
+            logging.info(f"Клиент {addr} отключился штатно.")
+            return
+        buffer += data
+
+def handle_client(conn, addr):
+    """Обрабатывает соединение с одним клиентом."""
+    logging.info(f"Подключен {addr}")
+    metrics.connection_opened()
+    try:
+        # По первому байту определяем протокол: кадры или JSON старого клиента
+        first = conn.recv(1)
+        metrics.add('bytes_in', len(first))
+        if not first:
+            logging.info(f"Клиент {addr} отключился штатно.")
+        elif first == PROTOCOL_MAGIC[:1]:
+            _serve_framed(conn, addr, first)
+        else:
+            _serve_legacy(conn, addr, first)
+    except (ConnectionResetError, ConnectionError): # Если клиент разорвал соединение неожиданно
          logging.warning(f"Соединение с клиентом {addr} сброшено.")
     except Exception as e: # Другие возможные ошибки на уровне сокета/потока
          logging.exception(f"Ошибка обработки клиента {addr}")
     finally:
+        metrics.connection_closed()
         logging.info(f"Закрытие соединения с {addr}")
         conn.close() # Закрыть сокет клиента
 
-def start_server():
-    """Запускает TCP сервер."""
+def prepare_database(pool_size=POOL_SIZE, pool_timeout=POOL_TIMEOUT, profile=DURABILITY_PROFILE,
+                     checkpoint_interval=WAL_CHECKPOINT_INTERVAL, cache_size=CACHE_MAX_ENTRIES, cache_ttl=CACHE_TTL):
+    """Готовит БД к работе сервера. Возвращает событие остановки потока контрольных точек."""
+    init_cache(cache_size, cache_ttl)
+    set_durability_profile(profile)
     init_db() # Инициализировать/проверить БД при старте сервера
+    checkpoint_stop = start_wal_checkpointer(checkpoint_interval) # До создания пула: соединения пула отключают автоматические контрольные точки
+    init_pool(pool_size, pool_timeout) # Постоянные соединения для обработки запросов
+    return checkpoint_stop
+
+def serve_forever(s, connections=None):
+    """Принимает клиентов на слушающем сокете s, по потоку на каждого.
+
+    connections - словарь {сокет клиента: поток}, в котором учитываются открытые соединения
+    (нужен для плавной остановки, см. drain_connections).
+    """
+    while True: # Бесконечный цикл для приема новых клиентов
+        conn, addr = s.accept() # Принять новое соединение (блокирующая операция)
+        # Создаем новый поток для обработки каждого клиента, чтобы сервер не блокировался
+        client_thread = threading.Thread(target=handle_client, args=(conn, addr))
+        client_thread.daemon = True # Устанавливаем поток как демон, чтобы он завершился при выходе основного потока
+        client_thread.start() # Запускаем поток
+        if connections is not None:
+            for finished in [c for c, t in connections.items() if not t.is_alive()]:
+                del connections[finished]
+            connections[conn] = client_thread
+
+def drain_connections(connections, timeout):
+    """Плавно закрывает соединения: новые запросы не читаются, начатые успевают получить ответ.
+
+    SHUT_RD будит потоки, ждущие следующего запроса в recv (он вернет пустые байты), и не мешает
+    отправить ответ на уже прочитанный запрос. Возвращает число потоков, не успевших за timeout.
+    """
+    for conn in list(connections):
+        try:
+            conn.shutdown(socket.SHUT_RD)
+        except OSError: # Соединение уже закрыто
+            pass
+    deadline = time.monotonic() + timeout
+    for thread in connections.values():
+        thread.join(max(0.0, deadline - time.monotonic()))
+    return sum(thread.is_alive() for thread in connections.values())
+
+def start_server(**db_options):
+    """Запускает TCP сервер (поток на каждого клиента). db_options передаются в prepare_database()."""
+    prepare_database(**db_options)
 
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s: # Создание TCP сокета
         s.bind((HOST, PORT)) # Привязка к адресу и порту
         s.listen() # Начало прослушивания входящих соединений
         logging.info(f"Сервер слушает на {HOST}:{PORT}")
-        while True: # Бесконечный цикл для приема новых клиентов
-            conn, addr = s.accept() # Принять новое соединение (блокирующая операция)
-            # Создаем новый поток для обработки каждого клиента, чтобы сервер не блокировался
-            client_thread = threading.Thread(target=handle_client, args=(conn, addr))
-            client_thread.daemon = True # Устанавливаем поток как демон, чтобы он завершился при выходе основного потока
-            client_thread.start() # Запускаем поток
+        serve_forever(s)
+
+# --- Многопроцессный режим (prefork) ---
+# Из-за GIL один процесс загружает примерно одно ядро: разбор и сборка JSON, преобразование строк
+# выборки занимают процессор. В режиме prefork родитель готовит БД и запускает N рабочих процессов,
+# каждый со своим пулом соединений и потоком на клиента. Порт общий: с SO_REUSEPORT каждый процесс
+# открывает свой слушающий сокет и ядро распределяет соединения между ними, без него процессы
+# наследуют один сокет родителя. Родитель следит за процессами и перезапускает упавшие.
+# Все процессы работают с одной БД в режиме WAL: читатели не блокируют писателя и друг друга.
+
+PREFORK_WORKERS = os.cpu_count() or 1
+WORKER_RESTART_DELAY = 1.0   # Пауза перед перезапуском процесса, упавшего сразу после старта, с
+WORKER_MIN_UPTIME = 5.0      # Процесс, проживший меньше, считается упавшим при старте
+WORKER_POLL_INTERVAL = 0.2   # Как часто родитель проверяет завершившиеся процессы, с
+WORKER_STOP_TIMEOUT = SHUTDOWN_TIMEOUT + 5.0 # Сколько родитель ждет процессы при остановке до SIGKILL, с
+
+class WorkerStop(Exception):
+    """SIGTERM рабочему процессу prefork: перестать принимать соединения и завершиться."""
+
+def _raise_worker_stop(signum, frame):
+    raise WorkerStop()
+
+def create_listening_socket(reuse_port):
+    """Создает слушающий сокет на HOST:PORT (reuse_port - с SO_REUSEPORT для нескольких процессов)."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    s.bind((HOST, PORT))
+    s.listen()
+    return s
+
+def _run_worker(index, listen_socket, pool_size, pool_timeout, checkpoint_interval, metrics_file, metrics_interval):
+    """Тело рабочего процесса prefork (выполняется в дочернем процессе после fork)."""
+    global _checkpointer_active
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C обрабатывает родитель и останавливает процессы сам
+    signal.signal(signal.SIGTERM, _raise_worker_stop) # Прерывает accept в serve_forever
+    metrics.labels = {'worker': index}
+    if listen_socket is None:
+        listen_socket = create_listening_socket(reuse_port=True)
+    if index == 0:
+        start_wal_checkpointer(checkpoint_interval) # Контрольные точки делает один процесс
+    else:
+        _checkpointer_active = checkpoint_interval > 0 # Остальные тоже не делают автоматических
+    init_pool(pool_size, pool_timeout)
+    if metrics_file:
+        start_metrics_writer(f'{metrics_file}.{index}', metrics_interval) # У каждого процесса свои метрики
+    logging.info(f"Процесс {index} (pid {os.getpid()}) принимает соединения на {HOST}:{PORT}")
+    connections = {}
+    try:
+        serve_forever(listen_socket, connections)
+    except WorkerStop:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN) # Повторный сигнал не должен прервать ожидание
+    listen_socket.close() # Новые соединения достаются другим процессам (или ждут в очереди родителя)
+    change_notifier.close() # Бесконечные подписки не дождутся конца сами; клиент переподключится
+    unfinished = drain_connections(connections, SHUTDOWN_TIMEOUT)
+    if unfinished:
+        logging.warning(f"Процесс {index}: {unfinished} соединений не завершились за {SHUTDOWN_TIMEOUT} с.")
+    close_pools()
+    logging.info(f"Процесс {index} (pid {os.getpid()}) остановлен.")
+
+def start_prefork_server(workers=PREFORK_WORKERS, reuse_port=True, pool_size=POOL_SIZE, pool_timeout=POOL_TIMEOUT,
+                         profile='wal', checkpoint_interval=WAL_CHECKPOINT_INTERVAL, cache_size=0, cache_ttl=CACHE_TTL,
+                         metrics_file=None, metrics_interval=METRICS_INTERVAL):
+    """Запускает workers рабочих процессов на общем порту и перезапускает упавшие (только Unix)."""
+    if not hasattr(os, 'fork'):
+        raise SystemExit("Режим prefork доступен только в Unix.")
+    if DURABILITY_PROFILES[profile]['journal_mode'] != 'WAL':
+        logging.warning(f"Профиль {profile} заменен на wal: процессам нужен общий журнал WAL.")
+        profile = 'wal'
+    if cache_size:
+        # Запись в одном процессе не сбрасывает кэш других - они отдавали бы устаревшие ответы
+        logging.warning("Кэш результатов в режиме prefork отключен.")
+    init_cache(0, cache_ttl)
+    set_durability_profile(profile)
+    init_db() # Миграции выполняются один раз, до запуска процессов
+
+    reuse_port = reuse_port and hasattr(socket, 'SO_REUSEPORT')
+    listen_socket = None if reuse_port else create_listening_socket(reuse_port=False)
+    logging.info(f"Режим prefork: {workers} процессов, "
+                 f"{'SO_REUSEPORT' if reuse_port else 'общий сокет родителя'}, {HOST}:{PORT}")
+
+    children = {} # pid -> (номер процесса, время запуска)
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                _run_worker(index, listen_socket, pool_size, pool_timeout, checkpoint_interval, metrics_file, metrics_interval)
+                code = 0
+            except Exception:
+                logging.exception(f"Процесс {index} завершился с ошибкой")
+            finally:
+                if log_listener is not None:
+                    log_listener.stop()
+                os._exit(code)
+        children[pid] = (index, time.monotonic())
+
+    def stop(signum, frame):
+        nonlocal stopping
+        if stopping:
+            return
+        logging.info("Остановка: завершаем рабочие процессы.")
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def reap(timeout):
+        """Дожидается процессов после SIGTERM; не успевшие за timeout завершаются SIGKILL."""
+        deadline = time.monotonic() + timeout
+        while children:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid:
+                children.pop(pid, None)
+            elif time.monotonic() < deadline:
+                time.sleep(WORKER_POLL_INTERVAL)
+            else:
+                logging.warning(f"Процессы {sorted(children)} не остановились за {timeout} с, SIGKILL.")
+                for pid in list(children):
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                        os.waitpid(pid, 0)
+                    except (ProcessLookupError, ChildProcessError):
+                        pass
+                    children.pop(pid, None)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(workers):
+        spawn(index)
+    try:
+        # Опрос вместо блокирующего os.wait: обработчик сигнала только ставит флаг,
+        # а цикл сам замечает остановку и переходит к ожиданию процессов с пределом времени
+        while children and not stopping:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                time.sleep(WORKER_POLL_INTERVAL)
+                continue
+            index, started = children.pop(pid, (None, 0.0))
+            if index is None or stopping:
+                continue
+            uptime = time.monotonic() - started
+            logging.error(f"Процесс {index} (pid {pid}) завершился (код {os.waitstatus_to_exitcode(status)}) "
+                          f"через {uptime:.1f} с, перезапуск.")
+            if uptime < WORKER_MIN_UPTIME:
+                time.sleep(WORKER_RESTART_DELAY) # Не перезапускать в цикле процесс, который падает сразу
+            if not stopping:
+                spawn(index)
+    finally:
+        stop(None, None) # Если цикл прервался исключением, процессы еще не получили SIGTERM
+        reap(WORKER_STOP_TIMEOUT)
+        if listen_socket is not None:
+            listen_socket.close()
+        logging.info("Сервер prefork остановлен.")
+
+# --- Асинхронный режим ---
+# Один поток событий обслуживает все соединения, блокирующая работа с SQLite выполняется
+# в ограниченном пуле потоков. Каждое соединение обрабатывает запросы по одному и не читает
+# следующий, пока ответ не ушел клиенту (writer.drain), - это и есть обратное давление.
+
+class AsyncStudentServer:
+    """Асинхронный сервер БД студентов с ограничением числа соединений и плавной остановкой."""
+
+    def __init__(self, host=HOST, port=PORT, max_connections=MAX_CONNECTIONS, db_workers=DB_WORKERS,
+                 idle_timeout=CLIENT_IDLE_TIMEOUT, shutdown_timeout=SHUTDOWN_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix='db')
+        self._server = None
+        self._stop = None
+        self._clients = {} # задача -> True, если она сейчас выполняет запрос
+
+    async def _read_frame(self, reader, prefix):
+        """Читает кадр (аналог read_frame). Возвращает (тип, тело) или None при отключении."""
+        try:
+            header = prefix + await reader.readexactly(FRAME_HEADER.size - len(prefix))
+        except asyncio.IncompleteReadError as e:
+            if not e.partial and not prefix:
+                return None
+            raise ConnectionError("Соединение закрыто посреди кадра.")
+        frame_type, length = parse_frame_header(header)
+        try:
+            body = await reader.readexactly(length) if length else b''
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("Соединение закрыто посреди кадра.")
+        metrics.add('bytes_in', len(header) - len(prefix) + length)
+        return frame_type, body
+
+    async def _execute(self, func, *args):
+        """Выполняет блокирующую функцию (запрос к БД) в пуле потоков."""
+        task = asyncio.current_task()
+        self._clients[task] = True
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self._clients[task] = False
+
+    def _iter_request_chunks(self, reader, loop):
+        """Аналог iter_request_chunks для потока БД: кадры читаются из цикла событий по одному."""
+        while True:
+            frame = asyncio.run_coroutine_threadsafe(self._read_frame(reader, b''), loop).result()
+            if frame is None:
+                raise ConnectionError("Клиент отключился посреди передачи данных.")
+            frame_type, body = frame
+            if frame_type == FRAME_END:
+                return
+            if frame_type != FRAME_CHUNK:
+                raise ValueError(f"Ожидался кадр с данными, получен тип {frame_type}")
+            yield body
+
+    async def _send(self, writer, chunks):
+        for chunk in chunks:
+            writer.write(chunk)
+            metrics.add('bytes_out', len(chunk))
+            await writer.drain() # Не отправляем дальше, пока медленный клиент не заберет данные
+
+    async def _send_response(self, writer, response, codec=JSON_CODEC, columnar=False):
+        """Отправляет ответ кадрами; пачки потокового ответа читаются из БД в пуле потоков."""
+        if response.get('stream') is None:
+            await self._send(writer, iter_response_frames(response, codec, columnar))
+            return
+        if isinstance(response['stream'], ChangeFeed):
+            await self._send_change_feed(writer, response, codec)
+            return
+        frames = iter_response_frames(response, codec, columnar)
+        try:
+            while True:
+                frame_bytes = await self._execute(next, frames, None)
+                if frame_bytes is None:
+                    break
+                await self._send(writer, [frame_bytes])
+        finally:
+            frames.close()
+            close_response(response)
+
+    async def _send_change_feed(self, writer, response, codec):
+        """Поток подписки: ожидание событий не занимает потоки БД, в пуле выполняется только чтение журнала."""
+        feed = response['stream']
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+        listener = lambda: loop.call_soon_threadsafe(changed.set)
+        change_notifier.add_listener(listener)
+        try:
+            await self._send(writer, [encode_frame(FRAME_RESPONSE, codec.dumps(dict(response, stream=True)))])
+            last_sent = loop.time()
+            while not self._stop.is_set():
+                changed.clear() # До чтения: фиксация во время poll() не потеряется
+                events = await self._execute(feed.poll)
+                if events or loop.time() - last_sent >= feed.heartbeat:
+                    await self._send(writer, [encode_frame(FRAME_CHUNK, codec.dumps(events))])
+                    last_sent = loop.time()
+                    continue
+                timeout = min(CHANGE_FEED_POLL_INTERVAL, feed.heartbeat - (loop.time() - last_sent))
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            change_notifier.remove_listener(listener)
+            feed.close()
+
+    async def _serve_framed(self, reader, writer, addr, prefix):
+        codec, columnar = JSON_CODEC, False
+        while True:
+            try:
+                frame = await asyncio.wait_for(self._read_frame(reader, prefix), self.idle_timeout)
+            except ValueError as e:
+                logging.error(f"Ошибка протокола от {addr}: {e}")
+                error_response = {'status': 'ошибка', 'message': f'Ошибка протокола: {e}'}
+                await self._send(writer, [encode_frame(FRAME_RESPONSE, codec.dumps(error_response))])
+                return
+            prefix = b''
+            if frame is None:
+                logging.info(f"Клиент {addr} отключился штатно.")
+                return
+            frame_type, body = frame
+            if frame_type == FRAME_HELLO:
+                codec, columnar, reply = negotiate_codec(body)
+                await self._send(writer, [encode_frame(FRAME_HELLO, reply)])
+                continue
+            if frame_type != FRAME_REQUEST:
+                response = {'status': 'ошибка', 'message': f'Неожиданный тип кадра: {frame_type}'}
+            else:
+                try:
+                    request = decode_request(body)
+                except ValueError:
+                    response = invalid_json_response(addr)
+                else:
+                    stream = None
+                    if isinstance(request, dict) and request.get('stream'):
+                        stream = self._iter_request_chunks(reader, asyncio.get_running_loop())
+                    response = await self._execute(process_request, request, addr, stream)
+            await self._send_response(writer, response, codec, columnar)
+
+    async def _serve_legacy(self, reader, writer, addr, buffer):
+        while True:
+            requests, buffer = split_legacy_requests(buffer)
+            for request in requests:
+                if isinstance(request, json.JSONDecodeError):
+                    response = invalid_json_response(addr)
+                else:
+                    response = await self._execute(lambda: materialize_response(process_request(request, addr)))
+                await self._send(writer, [JSON_CODEC.dumps(response)])
+            if len(buffer) > LEGACY_BUFFER_LIMIT:
+                await self._send(writer, [json.dumps({'status': 'ошибка', 'message': 'Слишком большой запрос'}).encode('utf-8')])
+                return
+            data = await asyncio.wait_for(reader.read(4096), self.idle_timeout)
+            metrics.add('bytes_in', len(data))
+            if not data:
+                logging.info(f"Клиент {addr} отключился штатно.")
+                return
+            buffer += data
+
+    async def handle_client(self, reader, writer):
+        """Обрабатывает соединение с одним клиентом (аналог handle_client)."""
+        addr = writer.get_extra_info('peername')
+        if self._stop.is_set() or len(self._clients) >= self.max_connections:
+            logging.warning(f"Отказ {addr}: достигнут предел соединений ({self.max_connections}) или сервер останавливается.")
+            metrics.add('rejected_connections')
+            writer.close()
+            return
+        task = asyncio.current_task()
+        self._clients[task] = False
+        logging.info(f"Подключен {addr}")
+        metrics.connection_opened()
+        try:
+            first = await asyncio.wait_for(reader.read(1), self.idle_timeout)
+            metrics.add('bytes_in', len(first))
+            if not first:
+                logging.info(f"Клиент {addr} отключился штатно.")
+            elif first == PROTOCOL_MAGIC[:1]:
+                await self._serve_framed(reader, writer, addr, first)
+            else:
+                await self._serve_legacy(reader, writer, addr, first)
+        except asyncio.TimeoutError:
+            logging.info(f"Клиент {addr} отключен по таймауту бездействия.")
+        except asyncio.CancelledError:
+            logging.info(f"Соединение с {addr} прервано остановкой сервера.")
+        except (ConnectionResetError, ConnectionError):
+            logging.warning(f"Соединение с клиентом {addr} сброшено.")
+        except Exception:
+            logging.exception(f"Ошибка обработки клиента {addr}")
+        finally:
+            self._clients.pop(task, None)
+            metrics.connection_closed()
+            logging.info(f"Закрытие соединения с {addr}")
+            writer.close()
+
+    def stop(self):
+        """Запрашивает плавную остановку сервера (можно вызывать из обработчика сигнала)."""
+        self._stop.set()
+
+    async def serve(self):
+        """Принимает клиентов до вызова stop(), затем плавно останавливается."""
+        self._stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError): # Windows: остановка через KeyboardInterrupt
+                pass
+        self._server = await asyncio.start_server(self.handle_client, self.host, self.port,
+                                                  backlog=min(self.max_connections, socket.SOMAXCONN))
+        logging.info(f"Асинхронный сервер слушает на {self.host}:{self.port} (до {self.max_connections} соединений)")
+        try:
+            await self._stop.wait()
+        finally:
+            await self.shutdown()
+
+    async def shutdown(self):
+        """Перестает принимать соединения, дожидается текущих запросов и закрывает ресурсы."""
+        logging.info("Остановка сервера: новые соединения не принимаются.")
+        self._server.close()
+        # Простаивающие соединения закрываем сразу, выполняющим запрос даем время закончить
+        for task, busy in list(self._clients.items()):
+            if not busy:
+                task.cancel()
+        pending = [task for task in self._clients if not task.done()]
+        if pending:
+            done, pending = await asyncio.wait(pending, timeout=self.shutdown_timeout)
+            for task in pending:
+                task.cancel()
+        await self._server.wait_closed()
+        self.executor.shutdown(wait=True)
+        close_pools()
+        logging.info("Сервер остановлен.")
+
+def start_async_server(max_connections=MAX_CONNECTIONS, db_workers=DB_WORKERS, **db_options):
+    """Запускает асинхронный TCP сервер. db_options передаются в prepare_database()."""
+    checkpoint_stop = prepare_database(**db_options)
+    async_server = AsyncStudentServer(HOST, PORT, max_connections=max_connections, db_workers=db_workers)
+    try:
+        asyncio.run(async_server.serve())
+    except KeyboardInterrupt:
+        logging.info("Получен сигнал прерывания, сервер остановлен.")
+    finally:
+        checkpoint_stop.set()
+
+def main():
+    global DATABASE, PORT, BACKUP_DIR
+    parser = argparse.ArgumentParser(description="Сервер БД студентов")
+    parser.add_argument("--port", type=int, default=PORT, help="Порт сервера")
+    parser.add_argument("--database", default=DATABASE, help="Путь к файлу БД")
+    parser.add_argument("--mode", choices=['threaded', 'async', 'prefork'], default='threaded',
+                        help="threaded - поток на клиента, async - asyncio с ограниченным пулом потоков для БД, "
+                             "prefork - несколько процессов на общем порту")
+    parser.add_argument("--workers", type=int, default=PREFORK_WORKERS, help="Рабочих процессов (режим prefork)")
+    parser.add_argument("--no-reuseport", action='store_true',
+                        help="Не использовать SO_REUSEPORT: процессы наследуют общий сокет (режим prefork)")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS, help="Предел одновременных соединений (режим async)")
+    parser.add_argument("--db-workers", type=int, default=DB_WORKERS, help="Потоков для запросов к БД (режим async)")
+    parser.add_argument("--pool-size", type=int, default=POOL_SIZE, help="Максимальное число соединений с БД в пуле")
+    parser.add_argument("--pool-timeout", type=float, default=POOL_TIMEOUT, help="Время ожидания свободного соединения, с")
+    parser.add_argument("--profile", choices=sorted(DURABILITY_PROFILES), default=DURABILITY_PROFILE,
+                        help="Профиль надежности записи: safe (журнал отката), wal, bulk (для импорта)")
+    parser.add_argument("--checkpoint-interval", type=float, default=WAL_CHECKPOINT_INTERVAL,
+                        help="Период фоновой контрольной точки WAL, с (0 - отключить)")
+    parser.add_argument("--cache-size", type=int, default=CACHE_MAX_ENTRIES, help="Записей в кэше результатов (0 - отключить)")
+    parser.add_argument("--cache-ttl", type=float, default=CACHE_TTL, help="Срок жизни записи кэша, с")
+    parser.add_argument("--backup-dir", default=BACKUP_DIR, help="Каталог для снимков команды backup")
+    parser.add_argument("--restore", metavar="SNAPSHOT", help="Перед запуском заменить содержимое БД снимком")
+    parser.add_argument("--metrics-file", help="Файл для периодической записи метрик в формате Prometheus")
+    parser.add_argument("--metrics-interval", type=float, default=METRICS_INTERVAL, help="Период записи файла метрик, с")
+    parser.add_argument("--log-level", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO', help="Уровень журнала")
+    parser.add_argument("--log-payloads", action='store_true', help="Писать в журнал содержимое запросов и ответов")
+    parser.add_argument("--log-sample", type=float, default=PAYLOAD_LOG_SAMPLE,
+                        help="Доля запросов, содержимое которых попадает в журнал (0..1)")
+    parser.add_argument("--log-max-chars", type=int, default=PAYLOAD_LOG_MAX_CHARS, help="Обрезать записи содержимого до стольких символов")
+    args = parser.parse_args()
+    DATABASE, PORT, BACKUP_DIR = args.database, args.port, args.backup_dir
+    log_listener = setup_logging(getattr(logging, args.log_level), args.log_payloads, args.log_sample, args.log_max_chars)
+    if args.restore:
+        restore_database(args.restore)
+    db_options = dict(pool_size=args.pool_size, pool_timeout=args.pool_timeout, profile=args.profile,
+                      checkpoint_interval=args.checkpoint_interval, cache_size=args.cache_size, cache_ttl=args.cache_ttl)
+    if args.mode == 'prefork': # Метрики пишет каждый рабочий процесс в свой файл
+        try:
+            start_prefork_server(args.workers, not args.no_reuseport, metrics_file=args.metrics_file,
+                                 metrics_interval=args.metrics_interval, **db_options)
+        finally:
+            log_listener.stop()
+        return
+    metrics_stop = start_metrics_writer(args.metrics_file, args.metrics_interval)
+    try:
+        if args.mode == 'async':
+            start_async_server(max_connections=args.max_connections, db_workers=args.db_workers, **db_options)
+        else:
+            start_server(**db_options)
+    finally:
+        metrics_stop.set()
+        log_listener.stop() # Дописывает оставшиеся в очереди записи
 
 if __name__ == "__main__": # Точка входа при запуске скрипта напрямую
-    start_server()
+    main()
@@ -0,0 +1,182 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import dh
+
+import client # Рукопожатие и шифрование берем у самого клиента
+
+# Замер запуска сервера "Телескоп" и задержки рукопожатия.
+# Сервер запускается отдельным процессом на своем порту. Время запуска - от старта процесса
+# до момента, когда порт принимает соединения (сюда входят импорт и подготовка параметров DH).
+# Рукопожатия замеряются трех видов: старое (обмен ключами + PBKDF2; сюда входит и ожидание
+# приветствия LEGACY_DETECT_TIMEOUT на сервере), версии 2 (обмен ключами + HKDF) и возобновление
+# по билету (без обмена ключами и без создания ключа сервера). После каждого выполняется одна короткая
+# команда, чтобы убедиться, что ключи совпали.
+# С --throughput вместо этого замеряется пропускная способность форматов сообщений (версия 1 и
+# AEAD) на сообщениях разного размера: зашифровать и расшифровать, в одном процессе, без сети.
+
+HOST = '127.0.0.1'
+PORT = 62101                  # Отдельный порт, чтобы не мешать рабочему серверу
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+SERVER_START_TIMEOUT = 120.0  # Сколько ждать готовности сервера, с
+STARTS = 5
+HANDSHAKES = 50
+HANDSHAKE_KINDS = ('pbkdf2', 'hkdf', 'resume')
+PROBE_COMMAND = 'echo ok'
+MESSAGE_SIZES = (64, 1024, 16 * 1024, 256 * 1024, 4 * 1024 * 1024)
+THROUGHPUT_BYTES = 64 * 1024 * 1024  # Сколько данных прогонять через каждый формат на каждом размере
+
+
+def start_server(port, kex):
+    """Запускает сервер и ждет, пока порт начнет принимать соединения. Возвращает (процесс, время, с)."""
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT, '--port', str(port), '--kex', kex],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = started + SERVER_START_TIMEOUT
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Сервер завершился при запуске (код {process.returncode})")
+        try:
+            socket.create_connection((HOST, port), timeout=0.5).close()
+            return process, time.perf_counter() - started
+        except OSError:
+            time.sleep(0.01)
+    process.kill()
+    raise RuntimeError("Сервер не запустился вовремя")
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def recv_exact(s, size):
+    data = b''
+    while len(data) < size:
+        chunk = s.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Сервер разорвал соединение")
+        data += chunk
+    return data
+
+
+def handshake(port, kind, ticket=None):
+    """Одно рукопожатие и проверочная команда. Возвращает (рукопожатие, команда, билет); время в секундах."""
+    with socket.create_connection((HOST, port)) as s:
+        started = time.perf_counter()
+        if kind == 'pbkdf2':
+            client.generate_keys(client.key_exchange(s))
+            client.aead = None
+        else:
+            ticket, resumed = client.handshake(s, ticket if kind == 'resume' else None)
+            if resumed != (kind == 'resume'):
+                raise RuntimeError("Сервер не принял билет сессии")
+        derived = time.perf_counter()
+
+        command = json.dumps({"command_number": 1, "command_body": PROBE_COMMAND})
+        message = client.encrypt_and_sign(command, client.enc_key, client.hmac_key, client.aead)
+        s.sendall(len(message).to_bytes(4, 'big') + message)
+        size = int.from_bytes(recv_exact(s, 4), 'big')
+        response = client.decrypt_and_verify(recv_exact(s, size), client.enc_key, client.hmac_key, client.aead)
+        if response is None or json.loads(response).get("status") != "success":
+            raise RuntimeError(f"Проверочная команда не выполнена: {response}")
+        return derived - started, time.perf_counter() - derived, ticket
+
+
+def ms(values):
+    """Медиана и 95-й процентиль в миллисекундах."""
+    ordered = sorted(values)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    return f"медиана {statistics.median(ordered) * 1000:8.2f} мс, p95 {p95 * 1000:8.2f} мс"
+
+
+def bench_mode(kex, starts, handshakes):
+    startup = []
+    for _ in range(starts):
+        process, elapsed = start_server(PORT, kex)
+        startup.append(elapsed)
+        stop_server(process)
+
+    print(f"[{kex}]")
+    print(f"  запуск сервера:        {ms(startup)}")
+    process, _ = start_server(PORT, kex)
+    try:
+        for kind in HANDSHAKE_KINDS:
+            samples = []
+            with contextlib.redirect_stdout(io.StringIO()): # Клиент печатает каждый шаг
+                _, _, ticket = handshake(PORT, 'hkdf')
+                for _ in range(handshakes):
+                    elapsed, command, ticket = handshake(PORT, kind, ticket)
+                    samples.append((elapsed, command))
+            elapsed, command = zip(*samples)
+            print(f"  рукопожатие {kind:<7}:  {ms(elapsed)}")
+            print(f"    первая команда:      {ms(command)}")
+    finally:
+        stop_server(process)
+
+
+def bench_throughput(total_bytes):
+    """Пропускная способность зашифровать+расшифровать для каждого формата и размера сообщения."""
+    enc_key, hmac_key = os.urandom(client.ENC_KEY_LEN), os.urandom(client.HMAC_KEY_LEN)
+    formats = (client.MESSAGE_FORMAT_V1,) + tuple(client.AEAD_FORMATS)
+    print(f"{'размер':>10} " + " ".join(f"{f:>20}" for f in formats) + "   (МБ/с)")
+    for size in MESSAGE_SIZES:
+        data = 'x' * size # Сообщения протокола - строки JSON
+        count = max(1, total_bytes // size)
+        row = []
+        for message_format in formats:
+            aead = client.AEAD_FORMATS[message_format](enc_key) if message_format in client.AEAD_FORMATS else None
+            started = time.perf_counter()
+            for _ in range(count):
+                message = client.encrypt_and_sign(data, enc_key, hmac_key, aead)
+                if client.decrypt_and_verify(message, enc_key, hmac_key, aead) is None:
+                    raise RuntimeError(f"Формат {message_format}: сообщение не прошло проверку")
+            row.append(size * count / (time.perf_counter() - started) / 1e6)
+        print(f"{size:>10} " + " ".join(f"{value:>20.1f}" for value in row))
+
+
+def main():
+    global PORT
+    parser = argparse.ArgumentParser(description='Запуск сервера "Телескоп" и задержка рукопожатия')
+    parser.add_argument("--port", type=int, default=PORT, help="Порт тестового сервера")
+    parser.add_argument("--kex", choices=('dh', 'x25519', 'all'), default='all', help="Режим обмена ключами")
+    parser.add_argument("--starts", type=int, default=STARTS, help="Сколько раз запускать сервер")
+    parser.add_argument("--handshakes", type=int, default=HANDSHAKES, help="Сколько рукопожатий выполнить")
+    parser.add_argument("--with-generate", action="store_true",
+                        help="Один раз замерить dh.generate_parameters(2048), как было до готовой группы")
+    parser.add_argument("--throughput", action="store_true",
+                        help="Замерить пропускную способность форматов сообщений вместо рукопожатий")
+    parser.add_argument("--throughput-mb", type=int, default=THROUGHPUT_BYTES // (1024 * 1024),
+                        help="Объем данных на каждый формат и размер, МБ")
+    args = parser.parse_args()
+    PORT = args.port
+
+    if args.throughput:
+        bench_throughput(args.throughput_mb * 1024 * 1024)
+        return
+
+    if args.with_generate:
+        started = time.perf_counter()
+        dh.generate_parameters(generator=2, key_size=2048, backend=default_backend())
+        print(f"[generate_parameters] 2048 бит: {time.perf_counter() - started:.2f} с")
+
+    for kex in (('dh', 'x25519') if args.kex == 'all' else (args.kex,)):
+        bench_mode(kex, args.starts, args.handshakes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+
+import client # Проверяем канал кодом самого клиента
+from benchmark import start_server, stop_server
+
+# Проверка канала "Телескоп" против настоящего сервера, запущенного отдельным процессом на своем порту.
+# Для каждого режима обмена ключами (dh, x25519):
+# - рукопожатия: старое (PEM + PBKDF2), версии 2 (HKDF) с каждым форматом сообщений, возобновление
+#   по билету, неизвестный билет (сервер должен перейти к обмену ключами) и приветствие, пришедшее
+#   после того как сервер принял клиента за старого и отправил PEM;
+# - согласование формата: AEAD-форматы, формат версии 1 (клиент не предлагает форматов) и
+#   неизвестный серверу формат;
+# - передача файла: обычная загрузка в формате версии 1, поток в каждом AEAD-формате, докачка после
+#   разрыва соединения, недокачанный файл длиннее файла на сервере и файл, укороченный во время передачи.
+# Вывод клиента перехватывается; печатается только итог каждой проверки. Код возврата 1 - есть ошибки.
+
+HOST = '127.0.0.1'
+PORT = 62102                          # Отдельный порт, чтобы не мешать рабочему серверу и замерам
+PROBE_COMMAND = 'echo ok'
+LATE_HELLO_DELAY = 0.5                          # Дольше LEGACY_DETECT_TIMEOUT сервера
+IO_TIMEOUT = 30.0                               # Предел ожидания ответа сервера, с: зависание - тоже ошибка
+STREAM_FILE_SIZE = 3 * 1024 * 1024 + 123        # Не кратен размеру блока: последний блок неполный
+DROP_AFTER = 1024 * 1024                        # Сколько байт принять до разрыва соединения
+CHANGED_FILE_SIZE = 64 * 1024 * 1024            # Больше буферов сокетов: сервер не успеет прочитать весь файл
+CHANGED_FILE_TRUNCATE = 1024 * 1024             # До какого размера укоротить файл во время передачи
+
+failures = []
+
+
+def check(name, ok, details=''):
+    print(f"  {'ок    ' if ok else 'ОШИБКА'} {name}" + (f": {details}" if details and not ok else ''))
+    if not ok:
+        failures.append(name)
+
+
+class TapSocket:
+    """Обертка сокета: после limit принятых байт вызывает action или, если его нет, имитирует разрыв."""
+
+    def __init__(self, sock, limit, action=None):
+        self.sock = sock
+        self.limit = limit
+        self.action = action
+        self.received = 0
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+
+    def recv(self, size):
+        if self.received >= self.limit:
+            if self.action is None:
+                return b''
+            self.action()
+            self.action, self.limit = None, float('inf')
+        data = self.sock.recv(int(min(size, self.limit - self.received)))
+        self.received += len(data)
+        return data
+
+
+def connect(port, kind, formats=client.MESSAGE_FORMATS, ticket=None, delay=0):
+    """Соединение с рукопожатием kind ('pbkdf2' - старое, 'hkdf' - версии 2). Возвращает (сокет, билет, возобновлена).
+
+    delay - пауза перед приветствием версии 2 (медленный клиент).
+    """
+    s = socket.create_connection((HOST, port), timeout=IO_TIMEOUT)
+    time.sleep(delay)
+    if kind == 'pbkdf2':
+        client.generate_keys(client.key_exchange(s))
+        client.aead = None
+        return s, None, False
+    session = client.handshake(s, ticket, formats)
+    if session is None:
+        s.close()
+        raise RuntimeError("Рукопожатие не выполнено")
+    return (s,) + session
+
+
+def request(s, command_json):
+    """Отправляет команду и возвращает расшифрованный ответ (None, если ответ не прошел проверку)."""
+    message = client.encrypt_and_sign(json.dumps(command_json), client.enc_key, client.hmac_key, client.aead)
+    s.sendall(len(message).to_bytes(4, 'big') + message)
+    data = client.recv_frame(s)
+    if data is None:
+        raise ConnectionError("Сервер разорвал соединение")
+    return client.decrypt_and_verify(data, client.enc_key, client.hmac_key, client.aead)
+
+
+def message_format():
+    """Формат сообщений, согласованный последним рукопожатием."""
+    return next((name for name, cipher in client.AEAD_FORMATS.items() if isinstance(client.aead, cipher)),
+                client.MESSAGE_FORMAT_V1)
+
+
+def probe(s):
+    """Проверочная команда: ключи сторон совпали и команды выполняются."""
+    response = request(s, {"command_number": 1, "command_body": PROBE_COMMAND})
+    return response is not None and json.loads(response).get("status") == "success"
+
+
+def sha256_file(path):
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def download(s, file_path):
+    """Потоковая загрузка с докачкой, как в клиенте. Возвращает (заголовок, вывод клиента)."""
+    part_path = client.partial_path(file_path)
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        response = request(s, {"command_number": 2, "command_body": file_path, "stream": True, "offset": offset})
+        client.handle_response(response, s, part_path)
+    return json.loads(response), output.getvalue()
+
+
+def check_handshakes(port):
+    with contextlib.redirect_stdout(io.StringIO()):
+        s, _, _ = connect(port, 'pbkdf2')
+        with s:
+            ok = probe(s)
+    check("старое рукопожатие (PBKDF2), формат версии 1", ok)
+
+    for formats in ((f,) for f in client.MESSAGE_FORMATS):
+        with contextlib.redirect_stdout(io.StringIO()):
+            s, ticket, _ = connect(port, 'hkdf', formats)
+            with s:
+                negotiated, ok = message_format(), probe(s)
+            s, _, resumed = connect(port, 'hkdf', formats, ticket)
+            with s:
+                resumed_ok = resumed and message_format() == formats[0] and probe(s)
+        check(f"HKDF, формат {formats[0]}", ok and negotiated == formats[0], f"согласован {negotiated}")
+        check(f"возобновление по билету, формат {formats[0]}", resumed_ok)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        s, ticket, _ = connect(port, 'hkdf', ())
+        with s:
+            negotiated, ok = message_format(), probe(s)
+        s, _, resumed = connect(port, 'hkdf', (), ticket)
+        with s:
+            resumed_ok = resumed and probe(s)
+        s, _, _ = connect(port, 'hkdf', ('unknown-format',) + client.MESSAGE_FORMATS[-1:])
+        with s:
+            fallback, fallback_ok = message_format(), probe(s)
+    check("HKDF без AEAD-форматов - формат версии 1", ok and negotiated == client.MESSAGE_FORMAT_V1, f"согласован {negotiated}")
+    check("возобновление по билету, формат версии 1", resumed_ok)
+    check("неизвестный формат пропускается", fallback_ok and fallback == client.MESSAGE_FORMATS[-1], f"согласован {fallback}")
+
+    unknown = dict(ticket, ticket=os.urandom(16).hex())
+    with contextlib.redirect_stdout(io.StringIO()):
+        s, _, resumed = connect(port, 'hkdf', ticket=unknown)
+        with s:
+            ok = not resumed and probe(s)
+    check("неизвестный билет - полный обмен ключами", ok)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        s, ticket, resumed = connect(port, 'hkdf', delay=LATE_HELLO_DELAY)
+        with s:
+            ok = not resumed and probe(s)
+        s, _, resumed = connect(port, 'hkdf', ticket=ticket, delay=LATE_HELLO_DELAY)
+        with s:
+            resumed_ok = resumed and probe(s)
+    check("опоздавшее приветствие - полный обмен ключами", ok)
+    check("опоздавшее приветствие - возобновление по билету", resumed_ok)
+
+
+def check_transfers(port, work_dir):
+    source = os.path.join(work_dir, 'source.bin')
+    with open(source, 'wb') as f:
+        f.write(os.urandom(STREAM_FILE_SIZE))
+    expected = sha256_file(source)
+    saved = os.path.join(client.DOWNLOAD_DIR, 'source.bin')
+    part_path = client.partial_path(source)
+
+    # Формат версии 1: файл целиком в одном ответе (base64)
+    with contextlib.redirect_stdout(io.StringIO()):
+        s, _, _ = connect(port, 'hkdf', ())
+        with s:
+            response = request(s, {"command_number": 2, "command_body": source})
+            client.handle_response(response, s)
+    check("загрузка в формате версии 1", os.path.isfile(saved) and sha256_file(saved) == expected)
+
+    for message_format in client.MESSAGE_FORMATS:
+        os.remove(saved)
+        with contextlib.redirect_stdout(io.StringIO()):
+            s, ticket, _ = connect(port, 'hkdf', (message_format,))
+        with s:
+            header, _ = download(s, source)
+        check(f"поток, формат {message_format}",
+              header.get("stream") and os.path.isfile(saved) and sha256_file(saved) == expected)
+
+        # Разрыв соединения посреди передачи, затем докачка в новой (возобновленной) сессии
+        os.remove(saved)
+        with contextlib.redirect_stdout(io.StringIO()):
+            s, ticket, _ = connect(port, 'hkdf', (message_format,), ticket)
+        with s:
+            try:
+                download(TapSocket(s, DROP_AFTER), source)
+                dropped = False
+            except ConnectionError:
+                dropped = True
+        partial = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        check(f"разрыв соединения, формат {message_format}", dropped and 0 < partial < STREAM_FILE_SIZE,
+              f"недокачано {partial} байт")
+        with contextlib.redirect_stdout(io.StringIO()):
+            s, _, _ = connect(port, 'hkdf', (message_format,), ticket)
+        with s:
+            header, _ = download(s, source)
+            ok = probe(s) # Сессия пригодна и после потока
+        check(f"докачка, формат {message_format}",
+              header.get("offset") == partial and not header.get("restarted") and not os.path.isfile(part_path)
+              and os.path.isfile(saved) and sha256_file(saved) == expected and ok, f"смещение {header.get('offset')}, заново {header.get('restarted')}")
+
+    # Недокачанный файл длиннее файла на сервере: сервер начинает передачу заново
+    os.remove(saved)
+    with open(part_path, 'wb') as f:
+        f.write(os.urandom(STREAM_FILE_SIZE + 1))
+    with contextlib.redirect_stdout(io.StringIO()):
+        s, _, _ = connect(port, 'hkdf')
+    with s:
+        header, _ = download(s, source)
+    check("недокачанный файл длиннее файла на сервере",
+          header.get("restarted") and header.get("offset") == 0
+          and os.path.isfile(saved) and sha256_file(saved) == expected, f"смещение {header.get('offset')}, заново {header.get('restarted')}")
+
+    # Файл укорачивается во время передачи: поток завершается ошибкой, недокачанное сохраняется
+    changed = os.path.join(work_dir, 'changed.bin')
+    with open(changed, 'wb') as f:
+        f.truncate(CHANGED_FILE_SIZE)
+    changed_part = client.partial_path(changed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        s, _, _ = connect(port, 'hkdf')
+    with s:
+        _, output = download(TapSocket(s, DROP_AFTER, lambda: os.truncate(changed, CHANGED_FILE_TRUNCATE)), changed)
+        ok = probe(s)
+    check("файл изменился во время передачи",
+          "изменился во время передачи" in output and os.path.isfile(changed_part)
+          and not os.path.isfile(os.path.join(client.DOWNLOAD_DIR, 'changed.bin')) and ok, output.strip())
+
+
+def check_mode(kex, port, work_dir):
+    print(f"[{kex}]")
+    process, _ = start_server(port, kex)
+    try:
+        check_handshakes(port)
+        client.DOWNLOAD_DIR = os.path.join(work_dir, f'downloads-{kex}')
+        check_transfers(port, work_dir)
+    except Exception as e: # Остальные проверки режима зависят от прерванной
+        check("проверки режима прерваны", False, f"{type(e).__name__}: {e}")
+    finally:
+        stop_server(process)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Проверка канала "Телескоп": рукопожатия, форматы и передача файлов')
+    parser.add_argument("--port", type=int, default=PORT, help="Порт тестового сервера")
+    parser.add_argument("--kex", choices=('dh', 'x25519', 'all'), default='all', help="Режим обмена ключами")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        for kex in (('dh', 'x25519') if args.kex == 'all' else (args.kex,)):
+            check_mode(kex, args.port, work_dir)
+
+    if failures:
+        print(f"Не пройдено проверок: {len(failures)}")
+        sys.exit(1)
+    print("Все проверки пройдены.")
+
+
+if __name__ == "__main__":
+    main()
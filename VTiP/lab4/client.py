@@ -3,11 +3,18 @@ import os
 import time
 import json
 import base64
+import hashlib
+import re
+import subprocess
+import sys
 from cryptography.hazmat.primitives import hashes, padding
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.exceptions import InvalidSignature, InvalidTag
 from cryptography.hazmat.primitives import hmac
-from cryptography.hazmat.primitives.asymmetric import dh
+from cryptography.hazmat.primitives.asymmetric import dh, x25519
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 
@@ -24,9 +31,32 @@ HMAC_KEY_LEN = 32
 ENC_KEY_LEN = 32
 IV_LEN = 16
 
+# Рукопожатие версии 2 (HKDF и билеты сессий, см. handshake() на сервере)
+HELLO_MAGIC = b'TSv2'
+HANDSHAKE_INFO = b'telescope v2 session keys'
+NONCE_LEN = 16
+RESUMPTION_KEY_LEN = 32
+PEM_PREFIX = b'----'                   # Начало PEM ('-----BEGIN ...') вместо длины кадра
+PEM_END = b'-----END PUBLIC KEY-----\n'
+# Форматы сообщений (см. сервер). Клиент предлагает AEAD-форматы в порядке предпочтения,
+# сервер выбирает первый поддерживаемый; без общего AEAD-формата остается версия 1.
+MESSAGE_FORMAT_V1 = 'chacha20-hmac-sha3'
+AEAD_FORMATS = {'chacha20-poly1305': ChaCha20Poly1305, 'aes-256-gcm': AESGCM}
+MESSAGE_FORMATS = ('aes-256-gcm', 'chacha20-poly1305')
+AEAD_NONCE_LEN = 12
+# Потоковая передача файлов (см. stream_file() на сервере). Недокачанный файл хранится
+# с суффиксом PARTIAL_SUFFIX, и повторная команда 2 продолжает его с того же места.
+STREAM_DATA = b'D'
+STREAM_END = b'E'
+DOWNLOAD_DIR = os.path.join("VTiP", "lab4", "downloads")
+PARTIAL_SUFFIX = '.part'
+# Билет последней сессии хранится между запусками клиента, чтобы переподключаться без обмена ключами
+TICKET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.session_ticket.json')
+
 # Глобальные переменные для ключей
 enc_key = None
 hmac_key = None
+aead = None # Шифр согласованного AEAD-формата (None - формат версии 1)
 
 def generate_keys(shared_secret):
     """Генерирует ключ шифрования и ключ HMAC из общего секрета с помощью PBKDF2HMAC."""
@@ -45,13 +75,178 @@ def generate_keys(shared_secret):
     # print(f"Клиент: Сгенерирован ключ HMAC: {hmac_key.hex()}") # Убрано для краткости
     print("Клиент: Ключи шифрования и HMAC сгенерированы.")
 
-def encrypt_and_sign(data, current_enc_key, current_hmac_key):
-    """Шифрует и подписывает сообщение."""
+def derive_session_keys(secret, salt):
+    """Выводит ключ шифрования, ключ HMAC и секрет возобновления из секрета с помощью HKDF."""
+    hkdf = HKDF(
+        algorithm=hashes.SHA3_256(),
+        length=ENC_KEY_LEN + HMAC_KEY_LEN + RESUMPTION_KEY_LEN,
+        salt=salt,
+        info=HANDSHAKE_INFO,
+        backend=default_backend()
+    )
+    derived_key = hkdf.derive(secret)
+    return (derived_key[:ENC_KEY_LEN],
+            derived_key[ENC_KEY_LEN:ENC_KEY_LEN + HMAC_KEY_LEN],
+            derived_key[ENC_KEY_LEN + HMAC_KEY_LEN:])
+
+def recv_exact(s, size):
+    """Читает ровно size байт; None, если соединение закрылось раньше."""
+    data = b''
+    while len(data) < size:
+        chunk = s.recv(min(4096, size - len(data)))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def recv_frame(s):
+    """Читает сообщение с 4-байтовым префиксом длины; None при разрыве соединения."""
+    size_bytes = recv_exact(s, 4)
+    if size_bytes is None:
+        return None
+    return recv_exact(s, int.from_bytes(size_bytes, 'big'))
+
+def receive_server_key(s):
+    """Получает публичный ключ сервера (PEM) и создает пару ключей клиента того же типа.
+
+    Режим определяется по ключу сервера: ключ X25519 - обмен на Curve25519,
+    иначе - Диффи-Хеллман с параметрами группы, присланными сервером.
+    Возвращает (ключ сервера, закрытый ключ клиента, PEM клиента) или None.
+    """
+    server_public_key_bytes = s.recv(2048) # Размер буфера
+    if not server_public_key_bytes:
+        print("Клиент: Сервер не отправил публичный ключ.")
+        return None
+    server_public_key = serialization.load_pem_public_key(
+        server_public_key_bytes,
+        backend=default_backend()
+    )
+    print("Клиент: Публичный ключ сервера получен.")
+    return (server_public_key,) + generate_client_key(server_public_key)
+
+def generate_client_key(server_public_key):
+    """Создает закрытый ключ клиента того же типа, что и ключ сервера. Возвращает (ключ, PEM)."""
+    if isinstance(server_public_key, x25519.X25519PublicKey):
+        client_private_key = x25519.X25519PrivateKey.generate()
+    else:
+        client_private_key = server_public_key.parameters().generate_private_key()
+    client_public_key_bytes = client_private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    return client_private_key, client_public_key_bytes
+
+def key_exchange(s):
+    """Рукопожатие старой версии: обмен PEM, общий секрет для generate_keys (PBKDF2). Секрет или None."""
+    keys = receive_server_key(s)
+    if keys is None:
+        return None
+    server_public_key, client_private_key, client_public_key_bytes = keys
+    # Отправка публичного ключа клиента серверу
+    s.sendall(client_public_key_bytes)
+    # print("Клиент: Публичный ключ клиента отправлен.") # Убрано для краткости
+
+    # Вычисление общего секрета
+    return client_private_key.exchange(server_public_key)
+
+def recv_handshake_reply(s):
+    """Читает ответ на приветствие. PEM, который сервер успел прислать, не дождавшись
+    приветствия (LEGACY_DETECT_TIMEOUT на сервере), пропускается: ключ сервера придет в ответе."""
+    size_bytes = recv_exact(s, 4)
+    if size_bytes == PEM_PREFIX:
+        pem = size_bytes
+        while not pem.endswith(PEM_END):
+            byte = recv_exact(s, 1)
+            if byte is None:
+                return None
+            pem += byte
+        size_bytes = recv_exact(s, 4)
+    if size_bytes is None:
+        return None
+    return recv_exact(s, int.from_bytes(size_bytes, 'big'))
+
+def handshake(s, ticket=None, formats=MESSAGE_FORMATS):
+    """Рукопожатие версии 2: HKDF и, если есть действующий билет, возобновление сессии.
+
+    Клиент говорит первым: приветствие с nonce, билетом и форматами. Если сервер принял билет,
+    ключи выводятся из секрета возобновления без обмена ключами; иначе в ответе приходит ключ
+    сервера, и клиент отвечает своим.
+    ticket - словарь {"ticket", "secret", "expires"} от прошлой сессии или None.
+    formats - предлагаемые серверу AEAD-форматы сообщений (пустой - формат версии 1).
+    Устанавливает enc_key, hmac_key и aead и возвращает (новый билет, возобновлена ли сессия) или None.
+    """
+    global enc_key, hmac_key, aead
+    if ticket is not None and ticket["expires"] <= time.time():
+        ticket = None
+    client_nonce = os.urandom(NONCE_LEN)
+    hello = {"nonce": client_nonce.hex(), "formats": list(formats)}
+    if ticket is not None:
+        hello["ticket"] = ticket["ticket"]
+    hello_data = json.dumps(hello).encode('utf-8')
+    s.sendall(HELLO_MAGIC + len(hello_data).to_bytes(4, 'big') + hello_data)
+
+    reply_data = recv_handshake_reply(s)
+    if reply_data is None:
+        print("Клиент: Сервер разорвал соединение во время рукопожатия.")
+        return None
+    reply = json.loads(reply_data)
+    resumed = reply["resumed"]
+    if resumed:
+        secret = ticket["secret"]
+    else:
+        server_public_key = serialization.load_pem_public_key(
+            reply["public_key"].encode('ascii'),
+            backend=default_backend()
+        )
+        print("Клиент: Публичный ключ сервера получен.")
+        client_private_key, client_public_key_bytes = generate_client_key(server_public_key)
+        s.sendall(len(client_public_key_bytes).to_bytes(4, 'big') + client_public_key_bytes)
+        secret = client_private_key.exchange(server_public_key)
+    enc_key, hmac_key, resumption_secret = derive_session_keys(
+        secret, client_nonce + bytes.fromhex(reply["nonce"]))
+    message_format = reply.get("format", MESSAGE_FORMAT_V1)
+    aead = AEAD_FORMATS[message_format](enc_key) if message_format in AEAD_FORMATS else None
+
+    # Новый билет заодно подтверждает, что ключи сторон совпали
+    ticket_data = recv_frame(s)
+    ticket_message = decrypt_and_verify(ticket_data, enc_key, hmac_key, aead) if ticket_data else None
+    if ticket_message is None:
+        print("Клиент: Не удалось получить билет сессии.")
+        return None
+    ticket_json = json.loads(ticket_message)
+    print(f"Клиент: {'Сессия возобновлена по билету' if resumed else 'Ключи выведены через HKDF'}, формат {message_format}.")
+    return ({"ticket": ticket_json["ticket"], "secret": resumption_secret,
+             "expires": time.time() + ticket_json["lifetime"]}, resumed)
+
+def load_ticket():
+    """Читает сохраненный билет сессии (None, если его нет или он поврежден)."""
+    try:
+        with open(TICKET_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return {"ticket": data["ticket"], "secret": bytes.fromhex(data["secret"]), "expires": data["expires"]}
+    except (OSError, ValueError, KeyError):
+        return None
+
+def save_ticket(ticket):
+    """Сохраняет билет сессии; файл доступен только владельцу, так как содержит секрет."""
+    try:
+        fd = os.open(TICKET_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({"ticket": ticket["ticket"], "secret": ticket["secret"].hex(),
+                       "expires": ticket["expires"]}, f)
+    except OSError as e:
+        print(f"Клиент: Не удалось сохранить билет сессии: {e}")
+
+def encrypt_and_sign(data, current_enc_key, current_hmac_key, current_aead=None):
+    """Шифрует и подписывает сообщение (current_aead - шифр AEAD-формата или None для версии 1)."""
     if not current_enc_key or not current_hmac_key:
         raise ValueError("Ключи шифрования/HMAC не установлены.")
 
     timestamp = int(time.time())
     timestamp_bytes = timestamp.to_bytes(8, 'big')
+    if current_aead is not None:
+        nonce = os.urandom(AEAD_NONCE_LEN)
+        return timestamp_bytes + nonce + current_aead.encrypt(nonce, data.encode('utf-8'), timestamp_bytes)
     iv = os.urandom(IV_LEN)
 
     # Паддинг ANSIX923
@@ -73,22 +268,35 @@ def encrypt_and_sign(data, current_enc_key, current_hmac_key):
     # print("Клиент: Сообщение зашифровано и подписано.") # Убрано для краткости
     return timestamp_bytes + iv + cipher_text + hmac_tag
 
-def decrypt_and_verify(data, current_enc_key, current_hmac_key):
-    """Расшифровывает и проверяет сообщение."""
+def decrypt_and_verify(data, current_enc_key, current_hmac_key, current_aead=None):
+    """Расшифровывает и проверяет сообщение (current_aead - шифр AEAD-формата или None для версии 1)."""
     if not current_enc_key or not current_hmac_key:
         raise ValueError("Ключи шифрования/HMAC не установлены.")
 
     try:
         timestamp_bytes = data[:8]
-        iv = data[8:8 + IV_LEN]
-        hmac_tag = data[-(HMAC_KEY_LEN):]
-        cipher_text = data[8 + IV_LEN:-(HMAC_KEY_LEN)]
+        if current_aead is not None:
+            # Тег AEAD проверяет и шифротекст, и метку времени (ассоциированные данные)
+            plain_text = current_aead.decrypt(data[8:8 + AEAD_NONCE_LEN], data[8 + AEAD_NONCE_LEN:], timestamp_bytes)
+        else:
+            iv = data[8:8 + IV_LEN]
+            hmac_tag = data[-(HMAC_KEY_LEN):]
+            cipher_text = data[8 + IV_LEN:-(HMAC_KEY_LEN)]
+
+            # Проверка HMAC
+            h = hmac.HMAC(current_hmac_key, hashes.SHA3_256(), backend=default_backend())
+            h.update(timestamp_bytes + iv + cipher_text)
+            h.verify(hmac_tag)
+            # print("Клиент: HMAC верифицирован успешно.") # Убрано для краткости
 
-        # Проверка HMAC
-        h = hmac.HMAC(current_hmac_key, hashes.SHA3_256(), backend=default_backend())
-        h.update(timestamp_bytes + iv + cipher_text)
-        h.verify(hmac_tag)
-        # print("Клиент: HMAC верифицирован успешно.") # Убрано для краткости
+            # Расшифровка ChaCha20
+            cipher = Cipher(algorithms.ChaCha20(current_enc_key, iv), mode=None, backend=default_backend())
+            decryptor = cipher.decryptor()
+            padded_plain_text = decryptor.update(cipher_text) + decryptor.finalize()
+
+            # Удаление паддинга ANSIX923
+            unpadder = padding.ANSIX923(128).unpadder() # Размер блока 128 бит
+            plain_text = unpadder.update(padded_plain_text) + unpadder.finalize()
 
         # Проверка временной метки (опционально, но полезно)
         timestamp = int.from_bytes(timestamp_bytes, 'big')
@@ -97,20 +305,14 @@ def decrypt_and_verify(data, current_enc_key, current_hmac_key):
             print(f"Клиент: Предупреждение: Большая разница во времени с сервером. Получено: {timestamp}, Текущее: {current_time}")
             # Не отклоняем, но предупреждаем
 
-        # Расшифровка ChaCha20
-        cipher = Cipher(algorithms.ChaCha20(current_enc_key, iv), mode=None, backend=default_backend())
-        decryptor = cipher.decryptor()
-        padded_plain_text = decryptor.update(cipher_text) + decryptor.finalize()
-
-        # Удаление паддинга ANSIX923
-        unpadder = padding.ANSIX923(128).unpadder() # Размер блока 128 бит
-        plain_text = unpadder.update(padded_plain_text) + unpadder.finalize()
-
         # print("Клиент: Сообщение расшифровано успешно.") # Убрано для краткости
         return plain_text.decode('utf-8')
-    except hmac.InvalidSignature:
+    except InvalidSignature:
         print("Клиент: Ошибка верификации HMAC!")
         return None
+    except InvalidTag:
+        print("Клиент: Ошибка проверки тега AEAD!")
+        return None
     except ValueError as e:
         print(f"Клиент: Ошибка расшифровки или удаления паддинга: {e}")
         return None
@@ -118,14 +320,83 @@ def decrypt_and_verify(data, current_enc_key, current_hmac_key):
         print(f"Клиент: Неизвестная ошибка при расшифровке: {e}")
         return None
 
-def handle_response(response_data):
-    """Обрабатывает расшифрованный ответ от сервера."""
+def partial_path(file_path):
+    """Путь недокачанного файла для пути на сервере (разделители Windows и POSIX)."""
+    return os.path.join(DOWNLOAD_DIR, re.split(r'[\\/]', file_path)[-1] + PARTIAL_SUFFIX)
+
+def open_chunk(current_aead, transfer_id, data):
+    """Расшифровывает кадр потоковой передачи. Возвращает (вид, смещение, данные); InvalidTag при подделке."""
+    header = data[:9]
+    nonce = data[9:9 + AEAD_NONCE_LEN]
+    return header[:1], int.from_bytes(header[1:], 'big'), current_aead.decrypt(nonce, data[9 + AEAD_NONCE_LEN:], header + transfer_id)
+
+def receive_file(s, header, part_path):
+    """Принимает файл потоком и пишет блоки на диск по мере получения.
+
+    При разрыве соединения или ошибке на сервере недокачанный файл остается для докачки;
+    при несовпадении контрольной суммы он удаляется, и следующая попытка начнется с нуля.
+    """
+    transfer_id = bytes.fromhex(header["transfer"])
+    size, position = header["size"], header["offset"]
+    save_path = os.path.join(DOWNLOAD_DIR, os.path.basename(header["filename"]))
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    checksum = hashlib.sha256()
+    started = time.perf_counter()
+    with open(part_path, 'r+b' if position else 'wb') as f:
+        # Уже скачанное начало тоже входит в контрольную сумму
+        while f.tell() < position:
+            block = f.read(min(header["chunk_size"], position - f.tell()))
+            if not block:
+                raise ValueError("Недокачанный файл короче смещения, подтвержденного сервером")
+            checksum.update(block)
+        f.truncate(position)
+        if header.get("restarted"):
+            print(f"Клиент: Недокачанный файл '{header['filename']}' длиннее файла на сервере, передача начата заново.")
+        elif position:
+            print(f"Клиент: Докачка '{header['filename']}' с позиции {position} из {size} байт.")
+        while True:
+            data = recv_frame(s)
+            if data is None:
+                print(f"Клиент: Соединение разорвано на {position} из {size} байт; повторите команду для докачки.")
+                raise ConnectionError("соединение разорвано")
+            kind, offset, payload = open_chunk(aead, transfer_id, data)
+            if offset != position:
+                raise ValueError(f"Неожиданное смещение блока: {offset} вместо {position}")
+            if kind == STREAM_END:
+                end = json.loads(payload)
+                break
+            f.write(payload)
+            checksum.update(payload)
+            position += len(payload)
+
+    elapsed = time.perf_counter() - started
+    if end["status"] != "success":
+        # Полученные блоки проверены AEAD, поэтому недокачанный файл сохраняется: повторная команда
+        # докачает его, а если файл на сервере изменился, это покажет контрольная сумма
+        print(f"Ошибка передачи файла '{header['filename']}': {end.get('message')} "
+              f"(получено {position} из {size} байт, повторите команду для докачки)")
+    elif end["sha256"] != checksum.hexdigest() or position != size:
+        print(f"Ошибка: контрольная сумма файла '{header['filename']}' не совпала, недокачанный файл удален.")
+        os.remove(part_path)
+    else:
+        os.replace(part_path, save_path)
+        print(f"Файл '{header['filename']}' успешно скачан и сохранен как '{save_path}' "
+              f"({size} байт, {(size - header['offset']) / max(elapsed, 1e-6) / 1e6:.1f} МБ/с, SHA-256 {end['sha256']})")
+
+def handle_response(response_data, s=None, part_path=None):
+    """Обрабатывает расшифрованный ответ от сервера (s и part_path нужны для потоковой передачи файла)."""
     try:
         response_json = json.loads(response_data)
         status = response_json.get("status")
         print("-" * 30)
         if status == "success":
-            if "message" in response_json:
+            if response_json.get("stream"):
+                try:
+                    receive_file(s, response_json, part_path)
+                except (InvalidTag, ValueError, OSError) as e:
+                    # Кадры передачи остались в сокете - продолжать сессию нельзя
+                    raise ConnectionError(f"Передача файла прервана: {e}") from e
+            elif "message" in response_json:
                 print("Ответ сервера:")
                 print(response_json["message"])
             elif "filename" in response_json and "data" in response_json:
@@ -134,9 +405,8 @@ def handle_response(response_data):
                 try:
                     file_data = base64.b64decode(file_data_b64)
                     # Сохраняем в подпапку VTiP/lab4/downloads
-                    save_dir = os.path.join("VTiP", "lab4", "downloads")
-                    os.makedirs(save_dir, exist_ok=True)
-                    save_path = os.path.join(save_dir, filename)
+                    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+                    save_path = os.path.join(DOWNLOAD_DIR, filename)
                     with open(save_path, 'wb') as f:
                         f.write(file_data)
                     print(f"Файл '{filename}' успешно скачан и сохранен как '{save_path}'")
@@ -180,6 +450,8 @@ def handle_response(response_data):
         print("Сырой ответ:")
         print(response_data)
         print("-" * 30)
+    except ConnectionError:
+        raise
     except Exception as e:
         print(f"Ошибка при обработке ответа: {e}")
         print("-" * 30)
@@ -194,34 +466,12 @@ def main():
             s.connect((SERVER_HOST, SERVER_PORT))
             print("Клиент: Соединение установлено.")
 
-            # 1. Обмен ключами Диффи-Хеллмана
-            # Получение публичного ключа сервера
-            server_public_key_bytes = s.recv(2048) # Размер буфера
-            if not server_public_key_bytes:
-                print("Клиент: Сервер не отправил публичный ключ.")
+            # 1-2. Обмен ключами (Диффи-Хеллман или X25519 - выбирает сервер) или возобновление
+            # сессии по билету, затем генерация ключей шифрования и HMAC
+            session = handshake(s, load_ticket())
+            if session is None:
                 return
-            server_public_key = serialization.load_pem_public_key(
-                server_public_key_bytes,
-                backend=default_backend()
-            )
-            print("Клиент: Публичный ключ сервера получен.")
-
-            # Генерация пары ключей клиента на основе параметров сервера
-            client_private_key = server_public_key.parameters().generate_private_key()
-            client_public_key_bytes = client_private_key.public_key().public_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PublicFormat.SubjectPublicKeyInfo
-            )
-            # Отправка публичного ключа клиента серверу
-            s.sendall(client_public_key_bytes)
-            # print("Клиент: Публичный ключ клиента отправлен.") # Убрано для краткости
-
-            # Вычисление общего секрета
-            shared_secret = client_private_key.exchange(server_public_key)
-            # print(f"Клиент: Общий секрет вычислен (первые 16 байт): {shared_secret[:16].hex()}...") # Убрано для краткости
-
-            # 2. Генерация ключей шифрования и HMAC
-            generate_keys(shared_secret)
+            save_ticket(session[0])
 
             # 3. Цикл взаимодействия с пользователем
             while True:
@@ -263,17 +513,21 @@ def main():
                 command_json = {"command_number": command_number}
                 if command_body:
                     command_json["command_body"] = command_body
+                part_path = None
+                if command_number == 2 and aead is not None:
+                    # Потоковая передача (только в AEAD-формате) с докачкой недокачанного файла
+                    part_path = partial_path(command_body)
+                    command_json["stream"] = True
+                    command_json["offset"] = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
 
                 command_str = json.dumps(command_json)
                 print(f"Клиент: Отправка команды: {command_str}")
 
                 # Шифрование и подпись
-                encrypted_command = encrypt_and_sign(command_str, enc_key, hmac_key)
+                encrypted_command = encrypt_and_sign(command_str, enc_key, hmac_key, aead)
 
-                # Отправка размера и данных
-                command_size_bytes = len(encrypted_command).to_bytes(4, 'big')
-                s.sendall(command_size_bytes)
-                s.sendall(encrypted_command)
+                # Отправка размера и данных одним вызовом (два маленьких пакета задерживает алгоритм Нейгла)
+                s.sendall(len(encrypted_command).to_bytes(4, 'big') + encrypted_command)
                 print(f"Клиент: Зашифрованная команда ({len(encrypted_command)} байт) отправлена: {encrypted_command.hex()}") # Выводим всю команду
 
                 # Получение ответа
@@ -297,10 +551,10 @@ def main():
                 print(f"Клиент: Получен зашифрованный ответ ({len(encrypted_response)} байт): {encrypted_response.hex()}") # Выводим весь ответ
 
                 # Расшифровка и проверка
-                response_data = decrypt_and_verify(encrypted_response, enc_key, hmac_key)
+                response_data = decrypt_and_verify(encrypted_response, enc_key, hmac_key, aead)
 
                 if response_data:
-                    handle_response(response_data)
+                    handle_response(response_data, s, part_path)
                 else:
                     print("Клиент: Не удалось обработать ответ от сервера.")
 
@@ -3,20 +3,51 @@ import os
 import time
 import json
 import base64
+import hashlib
 import subprocess
+import argparse
+import secrets
+import select
+import signal
+import threading
+import concurrent.futures
 import sys # Добавлено для определения платформы
+from collections import OrderedDict
 from cryptography.hazmat.primitives import hashes, padding
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.exceptions import InvalidSignature, InvalidTag
 from cryptography.hazmat.primitives import hmac
-from cryptography.hazmat.primitives.asymmetric import dh
+from cryptography.hazmat.primitives.asymmetric import dh, x25519
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 import mss # Для снимков экрана
 
-# Параметры Диффи-Хеллмана (можно использовать стандартные группы)
-# Используем предопределенные параметры группы 2048-бит MODP (RFC 3526)
-parameters = dh.generate_parameters(generator=2, key_size=2048, backend=default_backend())
+# Параметры Диффи-Хеллмана: стандартная группа 14 (2048-бит MODP, RFC 3526, раздел 3), g = 2.
+# Раньше параметры генерировались при импорте (dh.generate_parameters) - от секунд до минут
+# до того, как сервер начинал слушать порт. Готовая группа загружается мгновенно, а ее
+# безопасность не хуже: модуль - безопасное простое число, проверенное сообществом.
+RFC3526_GROUP14_P = int(
+    'FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD1'
+    '29024E088A67CC74020BBEA63B139B22514A08798E3404DD'
+    'EF9519B3CD3A431B302B0A6DF25F14374FE1356D6D51C245'
+    'E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED'
+    'EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3D'
+    'C2007CB8A163BF0598DA48361C55D39A69163FA8FD24CF5F'
+    '83655D23DCA3AD961C62F356208552BB9ED529077096966D'
+    '670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B'
+    'E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9'
+    'DE2BCBF6955817183995497CEA956AE515D2261898FA0510'
+    '15728E5A8AACAA68FFFFFFFFFFFFFFFF', 16)
+RFC3526_GROUP14_G = 2
+parameters = dh.DHParameterNumbers(RFC3526_GROUP14_P, RFC3526_GROUP14_G).parameters(default_backend())
+
+# Режим обмена ключами: 'dh' - группа выше, 'x25519' - эллиптическая кривая Curve25519
+# (ключи в десятки раз быстрее). Клиент определяет режим по типу присланного ключа.
+KEX_MODES = ('dh', 'x25519')
+kex_mode = 'dh'
 
 # Константы
 HOST = '127.0.0.1'  # Слушаем на локальном хосте
@@ -26,6 +57,48 @@ HMAC_KEY_LEN = 32   # Длина ключа HMAC (SHA3_256 -> 32 байта)
 ENC_KEY_LEN = 32    # Длина ключа шифрования (ChaCha20 -> 32 байта)
 IV_LEN = 16         # Длина IV для ChaCha20 (рекомендуется 16 байт)
 
+# Рукопожатие версии 2: вывод ключей через HKDF и билеты сессий.
+# Общий секрет DH/X25519 и так имеет высокую энтропию, поэтому 100 000 итераций PBKDF2
+# (около 0.5 с процессора на каждом конце) ему не нужны - достаточно HKDF.
+# Клиент версии 2 говорит первым, поэтому при возобновлении по билету ключ сервера не нужен вовсе.
+# Старый клиент ждет PEM сервера: если за LEGACY_DETECT_TIMEOUT клиент ничего не прислал, сервер
+# отправляет PEM и ведет прежнее рукопожатие с PBKDF2.
+HELLO_MAGIC = b'TSv2'           # Признак приветствия версии 2 (PEM начинается с '-----')
+LEGACY_DETECT_TIMEOUT = 0.1     # Сколько ждать приветствия, прежде чем считать клиента старым, с
+HANDSHAKE_INFO = b'telescope v2 session keys'
+NONCE_LEN = 16                  # Случайные числа клиента и сервера (соль HKDF)
+RESUMPTION_KEY_LEN = 32         # Секрет для возобновления следующей сессии
+MAX_HELLO_SIZE = 16384          # Ограничение на размер приветствия
+TICKET_LIFETIME = 3600          # Срок жизни билета сессии, с
+TICKET_CACHE_SIZE = 10000       # Максимум билетов в кэше (вытесняются самые старые)
+
+# Параллельная обработка клиентов: каждая сессия - в потоке из пула. Команды (subprocess, чтение
+# файлов, снимок экрана) в основном ждут ввода-вывода, поэтому GIL им почти не мешает.
+MAX_SESSIONS = 16               # Предел одновременных сессий; сверх него соединения отклоняются
+SHUTDOWN_TIMEOUT = 30.0         # Сколько ждать завершения выполняющихся команд при остановке, с
+SHUTDOWN_KILL_GRACE = 5.0       # Сколько ждать сессии после принудительного завершения их команд, с
+COMMAND_TIMEOUT = 300.0         # Предел времени выполнения команды 1, с
+ACCEPT_POLL_INTERVAL = 0.5      # Как часто цикл accept проверяет флаг остановки, с
+
+# Форматы сообщений. Версия 1 (старые клиенты и клиенты, не приславшие "formats"):
+# метка времени(8) + IV(16) + ChaCha20(данные с паддингом ANSIX923) + HMAC-SHA3-256(32).
+# AEAD-форматы: метка времени(8) + nonce(12) + шифротекст с тегом(16), метка времени -
+# ассоциированные данные. Один проход по данным вместо трех и без паддинга.
+MESSAGE_FORMAT_V1 = 'chacha20-hmac-sha3'
+AEAD_FORMATS = {'chacha20-poly1305': ChaCha20Poly1305, 'aes-256-gcm': AESGCM}
+AEAD_NONCE_LEN = 12
+
+# Потоковая передача файла (команда 2 с "stream": true, только в AEAD-формате). После обычного
+# ответа-заголовка {"stream", "transfer", "size", "offset", "chunk_size", "restarted"} идут кадры
+# вид(1) + смещение(8) + nonce(12) + AEAD(данные); ассоциированные данные - вид, идентификатор
+# передачи и смещение, поэтому кадры нельзя переставить, повторить или подставить из другой передачи.
+# Последний кадр (вид STREAM_END) содержит JSON с итоговым размером и SHA-256 всего файла.
+# Память - один блок вместо файла целиком в base64, размер файла не ограничен 4 ГБ.
+FILE_CHUNK_SIZE = 256 * 1024
+STREAM_DATA = b'D'
+STREAM_END = b'E'
+TRANSFER_ID_LEN = 8
+
 def generate_keys(shared_secret):
     """Генерирует ключ шифрования и ключ HMAC из общего секрета с помощью PBKDF2HMAC."""
     kdf = PBKDF2HMAC(
@@ -43,19 +116,214 @@ def generate_keys(shared_secret):
     print("Сервер: Ключи шифрования и HMAC сгенерированы.")
     return enc_key, hmac_key
 
-def decrypt_and_verify(data, enc_key, hmac_key):
-    """Расшифровывает и проверяет сообщение."""
+def derive_session_keys(secret, salt):
+    """Выводит ключ шифрования, ключ HMAC и секрет возобновления из секрета с помощью HKDF."""
+    hkdf = HKDF(
+        algorithm=hashes.SHA3_256(),
+        length=ENC_KEY_LEN + HMAC_KEY_LEN + RESUMPTION_KEY_LEN,
+        salt=salt,
+        info=HANDSHAKE_INFO,
+        backend=default_backend()
+    )
+    derived_key = hkdf.derive(secret)
+    return (derived_key[:ENC_KEY_LEN],
+            derived_key[ENC_KEY_LEN:ENC_KEY_LEN + HMAC_KEY_LEN],
+            derived_key[ENC_KEY_LEN + HMAC_KEY_LEN:])
+
+class TicketCache:
+    """Кэш билетов сессий: билет -> (секрет возобновления, срок действия).
+
+    Билет - случайная строка, сам секрет клиенту повторно не передается.
+    Билет одноразовый: при возобновлении он изымается, и клиент получает новый.
+    """
+
+    def __init__(self, lifetime=TICKET_LIFETIME, capacity=TICKET_CACHE_SIZE):
+        self.lifetime = lifetime
+        self.capacity = capacity
+        self.tickets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def issue(self, resumption_secret):
+        ticket = secrets.token_hex(16)
+        now = time.monotonic()
+        with self.lock:
+            self._purge(now)
+            self.tickets[ticket] = (resumption_secret, now + self.lifetime)
+            while len(self.tickets) > self.capacity:
+                self.tickets.popitem(last=False)
+        return ticket
+
+    def redeem(self, ticket):
+        """Изымает билет и возвращает его секрет или None, если билет неизвестен или истек."""
+        with self.lock:
+            entry = self.tickets.pop(ticket, None)
+        if entry is None or entry[1] < time.monotonic():
+            return None
+        return entry[0]
+
+    def _purge(self, now):
+        # Билеты добавляются по порядку с одинаковым сроком, поэтому истекшие - в начале
+        while self.tickets:
+            ticket, (_, expires) = next(iter(self.tickets.items()))
+            if expires >= now:
+                break
+            del self.tickets[ticket]
+
+ticket_cache = TicketCache()
+
+def load_dh_parameters(path):
+    """Загружает параметры DH из PEM-файла (например, созданного `openssl dhparam`) вместо группы 14."""
+    global parameters
+    with open(path, 'rb') as f:
+        parameters = serialization.load_pem_parameters(f.read(), backend=default_backend())
+    print(f"Сервер: Параметры DH загружены из {path} ({parameters.parameter_numbers().p.bit_length()} бит).")
+
+def generate_private_key():
+    """Создает одноразовый закрытый ключ сервера для текущего режима обмена ключами."""
+    if kex_mode == 'x25519':
+        return x25519.X25519PrivateKey.generate()
+    return parameters.generate_private_key()
+
+def recv_exact(conn, size):
+    """Читает ровно size байт; None, если соединение закрылось раньше."""
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(min(4096, size - len(data)))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def frame(data):
+    """Сообщение с 4-байтовым префиксом длины."""
+    return len(data).to_bytes(4, 'big') + data
+
+def recv_frame(conn):
+    """Читает кадр рукопожатия (не больше MAX_HELLO_SIZE); None при разрыве соединения или слишком длинном кадре."""
+    size_bytes = recv_exact(conn, 4)
+    size = int.from_bytes(size_bytes or b'', 'big')
+    if size_bytes is None or size > MAX_HELLO_SIZE:
+        return None
+    return recv_exact(conn, size)
+
+def server_key_pem(server_private_key):
+    """Публичный ключ сервера в формате PEM."""
+    return server_private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+
+def handshake(conn):
+    """Рукопожатие с клиентом. Возвращает (enc_key, hmac_key, aead) или None.
+
+    Клиент версии 2 первым присылает HELLO_MAGIC + длина + JSON {"nonce", ["ticket"], ["formats"]}.
+    Если билет действителен, ключ сервера не создается: ключи выводятся через HKDF из секрета
+    возобновления, и сервер отвечает кадром {"resumed", "nonce", "format"}. Иначе в ответе есть
+    еще "public_key" (PEM сервера), клиент отвечает кадром со своим PEM, и ключи выводятся из
+    общего секрета. Последним сервер отправляет зашифрованный (уже в выбранном формате) кадр с
+    новым билетом.
+    Старый клиент молчит, пока не получит PEM сервера; его узнаем по тишине в течение
+    LEGACY_DETECT_TIMEOUT и ведем прежнее рукопожатие: обмен PEM, затем PBKDF2 (generate_keys).
+    Приветствие, опоздавшее после отправки PEM, обрабатывается как обычно - уже созданным ключом.
+    aead - шифр выбранного AEAD-формата или None для формата версии 1.
+    """
+    server_private_key = None
+    readable, _, _ = select.select([conn], [], [], LEGACY_DETECT_TIMEOUT)
+    if not readable:
+        # Клиент ждет ключ сервера - вероятно, старый
+        server_private_key = generate_private_key()
+        conn.sendall(server_key_pem(server_private_key))
+        # print("Сервер: Публичный ключ отправлен клиенту.") # Убрано для краткости
+
+    head = recv_exact(conn, len(HELLO_MAGIC))
+    if head is None:
+        print("Сервер: Клиент не отправил публичный ключ.")
+        return None
+
+    if head != HELLO_MAGIC:
+        if server_private_key is None:
+            print("Сервер: Некорректное приветствие клиента.")
+            return None
+        # Старый клиент: остаток PEM и PBKDF2
+        client_public_key = serialization.load_pem_public_key(
+            head + conn.recv(2048), # Размер буфера может потребоваться увеличить
+            backend=default_backend()
+        )
+        # Вычисление общего секрета (тип ключа клиента должен совпадать с режимом сервера)
+        shared_secret = server_private_key.exchange(client_public_key)
+        return generate_keys(shared_secret) + (None,)
+
+    size_bytes = recv_exact(conn, 4)
+    hello_size = int.from_bytes(size_bytes or b'', 'big')
+    if not size_bytes or hello_size > MAX_HELLO_SIZE:
+        print("Сервер: Некорректное приветствие клиента.")
+        return None
+    hello_data = recv_exact(conn, hello_size)
+    if hello_data is None:
+        print("Сервер: Клиент разорвал соединение во время рукопожатия.")
+        return None
+    hello = json.loads(hello_data)
+    client_nonce = bytes.fromhex(hello["nonce"])
+    server_nonce = os.urandom(NONCE_LEN)
+    # Первый предложенный клиентом AEAD-формат, который знает сервер
+    message_format = next((f for f in hello.get("formats", ()) if f in AEAD_FORMATS), MESSAGE_FORMAT_V1)
+    reply = {"resumed": False, "nonce": server_nonce.hex(), "format": message_format}
+
+    resumption_secret = ticket_cache.redeem(hello["ticket"]) if hello.get("ticket") else None
+    if resumption_secret is not None:
+        secret = resumption_secret
+        reply["resumed"] = True
+        reply_frame = frame(json.dumps(reply).encode('utf-8'))
+    else:
+        # Билета нет или он недействителен: полный обмен ключами
+        if server_private_key is None:
+            server_private_key = generate_private_key()
+        reply["public_key"] = server_key_pem(server_private_key).decode('ascii')
+        conn.sendall(frame(json.dumps(reply).encode('utf-8')))
+        client_key_data = recv_frame(conn)
+        if client_key_data is None:
+            print("Сервер: Клиент не отправил публичный ключ.")
+            return None
+        client_public_key = serialization.load_pem_public_key(client_key_data, backend=default_backend())
+        secret = server_private_key.exchange(client_public_key)
+        reply_frame = b''
+    enc_key, hmac_key, next_resumption_secret = derive_session_keys(secret, client_nonce + server_nonce)
+    aead = AEAD_FORMATS[message_format](enc_key) if message_format in AEAD_FORMATS else None
+    print(f"Сервер: {'Сессия возобновлена по билету' if resumption_secret else 'Ключи выведены через HKDF'}, формат {message_format}.")
+
+    ticket = ticket_cache.issue(next_resumption_secret)
+    ticket_message = encrypt_and_sign(json.dumps({"ticket": ticket, "lifetime": ticket_cache.lifetime}),
+                                      enc_key, hmac_key, aead)
+    # Ответ и билет одним вызовом: иначе второй маленький пакет ждет ACK первого (Nagle + delayed ACK, ~40 мс)
+    conn.sendall(reply_frame + frame(ticket_message))
+    return enc_key, hmac_key, aead
+
+def decrypt_and_verify(data, enc_key, hmac_key, aead=None):
+    """Расшифровывает и проверяет сообщение (aead - шифр согласованного AEAD-формата или None для версии 1)."""
     try:
         timestamp_bytes = data[:8]
-        iv = data[8:8 + IV_LEN]
-        hmac_tag = data[-(HMAC_KEY_LEN):]
-        cipher_text = data[8 + IV_LEN:-(HMAC_KEY_LEN)]
+        if aead is not None:
+            # Тег AEAD проверяет и шифротекст, и метку времени (ассоциированные данные)
+            plain_text = aead.decrypt(data[8:8 + AEAD_NONCE_LEN], data[8 + AEAD_NONCE_LEN:], timestamp_bytes)
+        else:
+            iv = data[8:8 + IV_LEN]
+            hmac_tag = data[-(HMAC_KEY_LEN):]
+            cipher_text = data[8 + IV_LEN:-(HMAC_KEY_LEN)]
+
+            # Проверка HMAC
+            h = hmac.HMAC(hmac_key, hashes.SHA3_256(), backend=default_backend())
+            h.update(timestamp_bytes + iv + cipher_text)
+            h.verify(hmac_tag)
+            # print("Сервер: HMAC верифицирован успешно.") # Убрано для краткости
+
+            # Расшифровка ChaCha20
+            cipher = Cipher(algorithms.ChaCha20(enc_key, iv), mode=None, backend=default_backend())
+            decryptor = cipher.decryptor()
+            padded_plain_text = decryptor.update(cipher_text) + decryptor.finalize()
 
-        # Проверка HMAC
-        h = hmac.HMAC(hmac_key, hashes.SHA3_256(), backend=default_backend())
-        h.update(timestamp_bytes + iv + cipher_text)
-        h.verify(hmac_tag)
-        # print("Сервер: HMAC верифицирован успешно.") # Убрано для краткости
+            # Удаление паддинга ANSIX923
+            unpadder = padding.ANSIX923(128).unpadder() # Используем 128 бит для согласованности с клиентом
+            plain_text = unpadder.update(padded_plain_text) + unpadder.finalize()
 
         # Проверка временной метки (например, отклонение не более 60 секунд)
         timestamp = int.from_bytes(timestamp_bytes, 'big')
@@ -64,20 +332,14 @@ def decrypt_and_verify(data, enc_key, hmac_key):
             print(f"Сервер: Ошибка временной метки. Получено: {timestamp}, Текущее: {current_time}")
             return None # Отклоняем старые сообщения
 
-        # Расшифровка ChaCha20
-        cipher = Cipher(algorithms.ChaCha20(enc_key, iv), mode=None, backend=default_backend())
-        decryptor = cipher.decryptor()
-        padded_plain_text = decryptor.update(cipher_text) + decryptor.finalize()
-
-        # Удаление паддинга ANSIX923
-        unpadder = padding.ANSIX923(128).unpadder() # Используем 128 бит для согласованности с клиентом
-        plain_text = unpadder.update(padded_plain_text) + unpadder.finalize()
-
         # print("Сервер: Сообщение расшифровано успешно.") # Убрано для краткости
         return plain_text.decode('utf-8')
-    except hmac.InvalidSignature:
+    except InvalidSignature:
         print("Сервер: Ошибка верификации HMAC!")
         return None
+    except InvalidTag:
+        print("Сервер: Ошибка проверки тега AEAD!")
+        return None
     except ValueError as e:
         print(f"Сервер: Ошибка расшифровки или удаления паддинга: {e}")
         return None
@@ -85,10 +347,13 @@ def decrypt_and_verify(data, enc_key, hmac_key):
         print(f"Сервер: Неизвестная ошибка при расшифровке: {e}")
         return None
 
-def encrypt_and_sign(data, enc_key, hmac_key):
-    """Шифрует и подписывает сообщение."""
+def encrypt_and_sign(data, enc_key, hmac_key, aead=None):
+    """Шифрует и подписывает сообщение (aead - шифр согласованного AEAD-формата или None для версии 1)."""
     timestamp = int(time.time())
     timestamp_bytes = timestamp.to_bytes(8, 'big')
+    if aead is not None:
+        nonce = os.urandom(AEAD_NONCE_LEN)
+        return timestamp_bytes + nonce + aead.encrypt(nonce, data.encode('utf-8'), timestamp_bytes)
     iv = os.urandom(IV_LEN)
 
     # Паддинг ANSIX923
@@ -108,8 +373,107 @@ def encrypt_and_sign(data, enc_key, hmac_key):
     # print("Сервер: Сообщение зашифровано и подписано.") # Убрано для краткости
     return timestamp_bytes + iv + cipher_text + hmac_tag
 
-def execute_command(command_data):
-    """Выполняет команду на сервере."""
+def seal_chunk(aead, transfer_id, kind, offset, data):
+    """Кадр потоковой передачи: вид + смещение + nonce + AEAD(data)."""
+    header = kind + offset.to_bytes(8, 'big')
+    nonce = os.urandom(AEAD_NONCE_LEN)
+    return header + nonce + aead.encrypt(nonce, data, header + transfer_id)
+
+def stream_file(session, file_path, offset):
+    """Отправляет файл блоками начиная с offset. Возвращает JSON с ошибкой или None, если файл отправлен.
+
+    Ошибка до заголовка - обычный ответ; после заголовка поток всегда завершается кадром STREAM_END.
+    """
+    try:
+        f = open(file_path, 'rb')
+    except OSError as e:
+        return json.dumps({"status": "error", "message": f"Ошибка чтения файла: {e}"})
+    with f:
+        try:
+            size = os.fstat(f.fileno()).st_size
+            # Недокачанный файл длиннее файла на сервере (файл заменили): докачка невозможна, передаем заново
+            restarted = not 0 <= offset <= size
+            if restarted:
+                offset = 0
+            # Контрольная сумма - по всему файлу, поэтому при докачке учитываем и уже переданное начало
+            checksum = hashlib.sha256()
+            while f.tell() < offset:
+                block = f.read(min(FILE_CHUNK_SIZE, offset - f.tell()))
+                if not block: # Файл укоротился после fstat; повторная команда начнет передачу заново
+                    return json.dumps({"status": "error", "message": "Файл изменился во время передачи"})
+                checksum.update(block)
+        except OSError as e:
+            return json.dumps({"status": "error", "message": f"Ошибка чтения файла: {e}"})
+
+        transfer_id = os.urandom(TRANSFER_ID_LEN)
+        header = {"status": "success", "stream": True, "filename": os.path.basename(file_path),
+                  "transfer": transfer_id.hex(), "size": size, "offset": offset, "chunk_size": FILE_CHUNK_SIZE,
+                  "restarted": restarted}
+        session.conn.sendall(frame(encrypt_and_sign(json.dumps(header), session.enc_key, session.hmac_key, session.aead)))
+        print(f"Сервер: Передача файла {file_path}: {size} байт, с позиции {offset}.")
+
+        position = offset
+        read_error = None
+        while position < size:
+            try:
+                chunk = f.read(min(FILE_CHUNK_SIZE, size - position))
+            except OSError as e: # Ошибки сокета не перехватываем: соединение все равно потеряно
+                read_error = e
+                break
+            if not chunk: # Файл укоротился во время передачи
+                break
+            checksum.update(chunk)
+            session.conn.sendall(frame(seal_chunk(session.aead, transfer_id, STREAM_DATA, position, chunk)))
+            position += len(chunk)
+
+        if read_error is not None:
+            end = {"status": "error", "size": position, "message": f"Ошибка чтения файла: {read_error}"}
+        elif position == size:
+            end = {"status": "success", "size": position, "sha256": checksum.hexdigest()}
+        else:
+            end = {"status": "error", "size": position, "message": "Файл изменился во время передачи"}
+        session.conn.sendall(frame(seal_chunk(session.aead, transfer_id, STREAM_END, position,
+                                              json.dumps(end).encode('utf-8'))))
+        print(f"Сервер: Передача файла {file_path} завершена ({position - offset} байт).")
+    return None
+
+def kill_process_tree(process):
+    """Завершает процесс команды вместе с дочерними (shell=True запускает команду через оболочку)."""
+    if process.poll() is not None:
+        return
+    try:
+        if os.name == 'nt':
+            subprocess.run(['taskkill', '/F', '/T', '/PID', str(process.pid)], capture_output=True, check=False)
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+def run_shell_command(command_body, session=None):
+    """Выполняет команду оболочки с пределом COMMAND_TIMEOUT. Возвращает (stdout, stderr).
+
+    Процесс запускается в своей группе и запоминается в сессии, чтобы остановка сервера
+    (Session.interrupt) могла завершить его вместе с дочерними процессами.
+    """
+    group_options = ({'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP} if os.name == 'nt'
+                     else {'start_new_session': True})
+    process = subprocess.Popen(command_body, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               text=True, encoding='cp866', errors='replace', **group_options)
+    if session is not None:
+        session.process = process
+    try:
+        output, error_output = process.communicate(timeout=COMMAND_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        kill_process_tree(process)
+        process.communicate()
+        raise
+    finally:
+        if session is not None:
+            session.process = None
+    return output or "", error_output or ""
+
+def execute_command(command_data, session=None):
+    """Выполняет команду на сервере. Возвращает JSON ответа или None, если ответ уже отправлен потоком."""
     try:
         command_json = json.loads(command_data)
         command_number = command_json.get("command_number")
@@ -123,11 +487,11 @@ def execute_command(command_data):
             try:
                 # Выполняем команду и получаем вывод
                 # Используем 'cp866' для корректного декодирования вывода cmd в Windows (русская локаль)
-                result = subprocess.run(command_body, shell=True, capture_output=True, text=True, encoding='cp866', errors='replace', check=False)
-                output = result.stdout if result.stdout else ""
-                error_output = result.stderr if result.stderr else ""
+                output, error_output = run_shell_command(command_body, session)
                 response_message = f"Вывод команды:\n{output}\nОшибки:\n{error_output}"
                 return json.dumps({"status": "success", "message": response_message})
+            except subprocess.TimeoutExpired:
+                return json.dumps({"status": "error", "message": f"Команда не завершилась за {COMMAND_TIMEOUT:g} с и была остановлена"})
             except Exception as e:
                 return json.dumps({"status": "error", "message": f"Ошибка выполнения команды: {e}"})
 
@@ -135,6 +499,8 @@ def execute_command(command_data):
             if not command_body:
                 return json.dumps({"status": "error", "message": "Не указан путь к файлу для команды 2"})
             file_path = command_body
+            if os.path.isfile(file_path) and command_json.get("stream") and session is not None and session.aead is not None:
+                return stream_file(session, file_path, int(command_json.get("offset", 0)))
             if os.path.isfile(file_path):
                 try:
                     with open(file_path, 'rb') as f:
@@ -170,45 +536,46 @@ def execute_command(command_data):
         return json.dumps({"status": "error", "message": f"Общая ошибка обработки команды: {e}"})
 
 
-def handle_client(conn, addr):
+class Session:
+    """Состояние одного соединения: сокет, адрес, ключи сессии и признак выполнения команды."""
+
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.enc_key = None
+        self.hmac_key = None
+        self.aead = None
+        self.busy = False
+        self.closing = False # Сервер останавливается: завершить сессию после текущей команды
+        self.process = None  # Выполняющаяся команда 1 (subprocess.Popen)
+
+    def interrupt(self):
+        """Прерывает ожидание в recv/sendall и выполняющуюся команду из другого потока (при остановке)."""
+        process = self.process
+        if process is not None:
+            kill_process_tree(process)
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def handle_client(session):
     """Обрабатывает соединение с клиентом."""
+    addr = session.addr
     print(f"Сервер: Подключение от {addr}")
     try:
-        # 1. Обмен ключами Диффи-Хеллмана
-        # Генерация приватного ключа сервера
-        server_private_key = parameters.generate_private_key()
-        # Получение публичного ключа сервера в формате PEM
-        server_public_key_bytes = server_private_key.public_key().public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo
-        )
-        # Отправка публичного ключа сервера клиенту
-        conn.sendall(server_public_key_bytes)
-        # print("Сервер: Публичный ключ отправлен клиенту.") # Убрано для краткости
-
-        # Получение публичного ключа клиента
-        client_public_key_bytes = conn.recv(2048) # Размер буфера может потребоваться увеличить
-        if not client_public_key_bytes:
-            print("Сервер: Клиент не отправил публичный ключ.")
+        # 1-2. Обмен ключами (Диффи-Хеллман или X25519, см. kex_mode) или возобновление сессии,
+        # затем генерация ключей шифрования и HMAC
+        keys = handshake(session.conn)
+        if keys is None:
             return
-        client_public_key = serialization.load_pem_public_key(
-            client_public_key_bytes,
-            backend=default_backend()
-        )
-        # print("Сервер: Публичный ключ клиента получен.") # Убрано для краткости
-
-        # Вычисление общего секрета
-        shared_secret = server_private_key.exchange(client_public_key)
-        # print(f"Сервер: Общий секрет вычислен (первые 16 байт): {shared_secret[:16].hex()}...") # Убрано для краткости
-
-        # 2. Генерация ключей шифрования и HMAC
-        enc_key, hmac_key = generate_keys(shared_secret)
+        session.enc_key, session.hmac_key, session.aead = keys
 
         # 3. Цикл обработки команд
         while True:
             # Получение данных от клиента (размер может варьироваться)
             # Сначала получаем размер сообщения (например, 4 байта)
-            size_bytes = conn.recv(4)
+            size_bytes = session.conn.recv(4)
             if not size_bytes:
                 print("Сервер: Клиент разорвал соединение (не получены данные о размере).")
                 break
@@ -217,7 +584,7 @@ def handle_client(conn, addr):
             # Получаем само сообщение
             encrypted_data = b''
             while len(encrypted_data) < message_size:
-                chunk = conn.recv(min(4096, message_size - len(encrypted_data)))
+                chunk = session.conn.recv(min(4096, message_size - len(encrypted_data)))
                 if not chunk:
                     print("Сервер: Клиент разорвал соединение (не получены полные данные).")
                     return # Выходим, если соединение разорвано во время чтения
@@ -230,28 +597,32 @@ def handle_client(conn, addr):
             print(f"Сервер: Получено зашифрованное сообщение ({len(encrypted_data)} байт): {encrypted_data.hex()}") # Выводим все сообщение
 
             # Расшифровка и проверка
-            command_data = decrypt_and_verify(encrypted_data, enc_key, hmac_key)
+            command_data = decrypt_and_verify(encrypted_data, session.enc_key, session.hmac_key, session.aead)
 
             if command_data:
-                # Выполнение команды
-                response_data = execute_command(command_data)
+                # Выполнение команды (при остановке сервера занятой сессии дается время ее закончить)
+                session.busy = True
+                try:
+                    response_data = execute_command(command_data, session)
+                finally:
+                    session.busy = False
                 # print(f"Сервер: Результат выполнения: {response_data[:200]}...") # Убрано для краткости
 
-                # Шифрование и отправка ответа
-                encrypted_response = encrypt_and_sign(response_data, enc_key, hmac_key)
+                if response_data is not None: # None - файл уже отправлен потоком (stream_file)
+                    # Шифрование и отправка ответа
+                    encrypted_response = encrypt_and_sign(response_data, session.enc_key, session.hmac_key, session.aead)
 
-                # Отправляем размер ответа, затем сам ответ
-                response_size_bytes = len(encrypted_response).to_bytes(4, 'big')
-                conn.sendall(response_size_bytes)
-                conn.sendall(encrypted_response)
-                print(f"Сервер: Зашифрованный ответ ({len(encrypted_response)} байт) отправлен: {encrypted_response.hex()}") # Выводим весь ответ
+                    # Размер ответа и сам ответ одним вызовом (см. handshake - иначе задержка ~40 мс)
+                    session.conn.sendall(frame(encrypted_response))
+                    print(f"Сервер: Зашифрованный ответ ({len(encrypted_response)} байт) отправлен: {encrypted_response.hex()}") # Выводим весь ответ
+                if session.closing:
+                    print(f"Сервер: Сессия {addr} завершена из-за остановки сервера.")
+                    break
             else:
                 # Отправляем сообщение об ошибке расшифровки/проверки
                 error_message = json.dumps({"status": "error", "message": "Ошибка обработки входящего сообщения на сервере"})
-                encrypted_error = encrypt_and_sign(error_message, enc_key, hmac_key)
-                error_size_bytes = len(encrypted_error).to_bytes(4, 'big')
-                conn.sendall(error_size_bytes)
-                conn.sendall(encrypted_error)
+                encrypted_error = encrypt_and_sign(error_message, session.enc_key, session.hmac_key, session.aead)
+                session.conn.sendall(frame(encrypted_error))
                 print(f"Сервер: Сообщение об ошибке отправлено клиенту: {encrypted_error.hex()}") # Выводим сообщение об ошибке
                 # Можно разорвать соединение при серьезных ошибках
                 # break
@@ -264,25 +635,90 @@ def handle_client(conn, addr):
         print(f"Сервер: Произошла ошибка при обработке клиента {addr}: {e}")
     finally:
         print(f"Сервер: Закрытие соединения с {addr}")
-        conn.close()
-
-def start_server():
-    """Запускает сервер."""
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind((HOST, PORT))
-        s.listen()
-        print(f'Сервер системы "Телескоп" запущен и слушает на {HOST}:{PORT}')
-        while True:
+        session.conn.close()
+
+class TelescopeServer:
+    """Сервер с пулом потоков: до max_sessions сессий одновременно, плавная остановка по stop()."""
+
+    def __init__(self, host=HOST, port=PORT, max_sessions=MAX_SESSIONS, shutdown_timeout=SHUTDOWN_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.max_sessions = max_sessions
+        self.shutdown_timeout = shutdown_timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_sessions, thread_name_prefix='session')
+        self.sessions = {} # Session -> Future
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def stop(self, *_):
+        """Запрашивает плавную остановку (можно вызывать из обработчика сигнала)."""
+        self._stop.set()
+
+    def serve(self):
+        """Принимает клиентов до вызова stop(), затем плавно останавливается."""
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind((self.host, self.port))
+            s.listen()
+            s.settimeout(ACCEPT_POLL_INTERVAL) # Чтобы замечать stop() без нового соединения
+            print(f'Сервер системы "Телескоп" запущен и слушает на {self.host}:{self.port} '
+                  f'(обмен ключами: {kex_mode}, до {self.max_sessions} сессий)')
             try:
-                conn, addr = s.accept()
-                # Обработка клиента в отдельном потоке/процессе была бы лучше для >1 клиента,
-                # но для простоты делаем последовательно.
-                handle_client(conn, addr)
-            except KeyboardInterrupt:
-                print("\nСервер: Получен сигнал прерывания. Завершение работы...")
-                break
-            except Exception as e:
-                print(f"Сервер: Ошибка при принятии соединения: {e}")
+                while not self._stop.is_set():
+                    try:
+                        conn, addr = s.accept()
+                    except socket.timeout:
+                        continue
+                    except OSError as e:
+                        print(f"Сервер: Ошибка при принятии соединения: {e}")
+                        continue
+                    conn.settimeout(None) # Принятый сокет наследует таймаут слушающего
+                    self._start_session(conn, addr)
+            finally:
+                self.shutdown()
+
+    def _start_session(self, conn, addr):
+        with self.lock:
+            if len(self.sessions) >= self.max_sessions:
+                print(f"Сервер: Отказ {addr}: достигнут предел сессий ({self.max_sessions}).")
+                conn.close()
+                return
+            session = Session(conn, addr)
+            self.sessions[session] = self.executor.submit(self._run_session, session)
+
+    def _run_session(self, session):
+        try:
+            handle_client(session)
+        finally:
+            with self.lock:
+                self.sessions.pop(session, None)
+
+    def shutdown(self):
+        """Закрывает простаивающие сессии сразу, выполняющим команду дает shutdown_timeout на завершение."""
+        print("Сервер: Остановка: новые соединения не принимаются.")
+        with self.lock:
+            sessions = dict(self.sessions)
+        for session in sessions:
+            session.closing = True
+            if not session.busy:
+                session.interrupt()
+        done, pending = concurrent.futures.wait(sessions.values(), timeout=self.shutdown_timeout)
+        if pending:
+            print(f"Сервер: {len(pending)} сессий не завершились за {self.shutdown_timeout} с, команды и соединения прерываются.")
+            for session in sessions:
+                session.interrupt()
+            done, pending = concurrent.futures.wait(pending, timeout=SHUTDOWN_KILL_GRACE)
+        if pending:
+            print(f"Сервер: {len(pending)} сессий так и не завершились.")
+        self.executor.shutdown(wait=not pending)
+        print("Сервер: Остановлен.")
+
+def start_server(max_sessions=MAX_SESSIONS, shutdown_timeout=SHUTDOWN_TIMEOUT):
+    """Запускает сервер; Ctrl+C или SIGTERM - плавная остановка."""
+    server = TelescopeServer(HOST, PORT, max_sessions=max_sessions, shutdown_timeout=shutdown_timeout)
+    signal.signal(signal.SIGINT, server.stop)
+    signal.signal(signal.SIGTERM, server.stop)
+    server.serve()
 
 if __name__ == "__main__":
     # Установка зависимостей (если нужно)
@@ -294,4 +730,18 @@ if __name__ == "__main__":
         print("pip install cryptography mss")
         # Используем sys.exit вместо exit() для большей стандартности
         sys.exit(1)
-    start_server()
+    parser = argparse.ArgumentParser(description='Сервер системы "Телескоп"')
+    parser.add_argument("--port", type=int, default=PORT, help="Порт сервера")
+    parser.add_argument("--kex", choices=KEX_MODES, default=kex_mode, help="Обмен ключами: dh (RFC 3526, группа 14) или x25519")
+    parser.add_argument("--dh-params", metavar="PEM", help="Файл с параметрами DH вместо группы 14 (режим dh)")
+    parser.add_argument("--max-sessions", type=int, default=MAX_SESSIONS, help="Предел одновременных сессий")
+    parser.add_argument("--shutdown-timeout", type=float, default=SHUTDOWN_TIMEOUT, help="Сколько ждать выполняющихся команд при остановке, с")
+    parser.add_argument("--command-timeout", type=float, default=COMMAND_TIMEOUT, help="Предел времени выполнения команды 1, с")
+    parser.add_argument("--ticket-lifetime", type=int, default=TICKET_LIFETIME, help="Срок жизни билета сессии, с (0 - без возобновления)")
+    args = parser.parse_args()
+    ticket_cache.lifetime = args.ticket_lifetime
+    PORT, kex_mode = args.port, args.kex
+    COMMAND_TIMEOUT = args.command_timeout
+    if args.dh_params:
+        load_dh_parameters(args.dh_params)
+    start_server(max_sessions=args.max_sessions, shutdown_timeout=args.shutdown_timeout)